@@ -0,0 +1,235 @@
+"""
+admission.py
+Admission control and deadlines of the scoring requests, so an overloaded worker answers fast instead of queueing forever
+
+Admission:
+ -> At most SCORE_REQUESTS scoring requests are worked on at once in every worker process
+ -> Up to SCORE_QUEUE more may wait for a slot, for at most QUEUE_WAIT seconds. Any other request is rejected at once
+ -> Rejected requests get a 503 with a Retry-After hint, the mean time recent requests took to be served
+Deadlines:
+ -> Every admitted request gets a deadline, REQUEST_DEADLINE seconds after it arrived, including the wait for a slot
+ -> The deadline is kept in a context variable, like the timings of metrics.py, so it is carried into the tasks and
+    executor calls of the request without being passed around
+ -> Spotify calls (rate limiter and HTTP), the scoring of every chunk and the wait for the intent check it, and raise
+    DeadlineExceeded once it has passed, so the work of a request stops with it
+Size:
+ -> Requests for more than MAX_TRACKS songs are refused. A playlist is checked once its first page gives its size
+ -> Batch requests with more than MAX_PROMPTS prompts are refused before any work is done
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import math
+import os
+import time
+
+# Number of scoring requests worked on at once, per worker process
+SCORE_REQUESTS = int(os.environ.get("SCORE_REQUESTS", 8))
+# Number of scoring requests allowed to wait for a slot
+SCORE_QUEUE = int(os.environ.get("SCORE_QUEUE", 16))
+# Seconds a request may wait for a slot before it is rejected
+QUEUE_WAIT = float(os.environ.get("QUEUE_WAIT", 2))
+# Seconds a request may take, from its arrival, before its work is stopped
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 30))
+# Largest number of songs scored for one request
+MAX_TRACKS = int(os.environ.get("MAX_TRACKS", 10000))
+# Largest number of prompts of one batch request
+MAX_PROMPTS = int(os.environ.get("MAX_PROMPTS", 100))
+
+# Deadline of the request being served, in time.monotonic() seconds
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be served in time. The client should try again after retry_after seconds
+    Parameters required: message, seconds to wait before retrying
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Rejected(Overloaded):
+    """
+    Raised when every slot is taken and the queue is full, or no slot came free in time
+    """
+
+
+class DeadlineExceeded(Overloaded):
+    """
+    Raised when the deadline of the request has passed
+    """
+
+
+class TooManyTracks(Exception):
+    """
+    Raised when a request asks for more songs than MAX_TRACKS
+    Parameters required: number of songs asked for, largest number allowed
+    """
+
+    def __init__(self, count: int, limit: int):
+        super().__init__("%d songs requested, at most %d are allowed" % (count, limit))
+        self.count = count
+        self.limit = limit
+
+
+# Function to give the request being served a deadline
+def start_deadline(seconds: float = REQUEST_DEADLINE) -> float:
+    """
+    Parameters required: seconds from now
+    Return data: the deadline, in time.monotonic() seconds
+    """
+    deadline = time.monotonic() + seconds
+    _deadline.set(deadline)
+    return deadline
+
+
+# Function to get the seconds left before the deadline
+def remaining() -> float:
+    """
+    Parameters required: None
+    Return data: seconds left (can be negative), None if the request has no deadline
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# Function to stop the work of a request whose deadline has passed
+def check() -> None:
+    """
+    Raises DeadlineExceeded if the deadline has passed
+    Parameters required: None
+    Return data: None
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("The request took too long", get_gate().retry_after())
+
+
+# Function to await something for no longer than the deadline allows
+async def within(awaitable):
+    """
+    Parameters required: coroutine or future
+    Return data: its result
+    Raises DeadlineExceeded, cancelling the awaitable, if the deadline passes first
+    """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(
+            "The request took too long", get_gate().retry_after()
+        ) from None
+
+
+# Function to refuse a request for too many songs
+def check_tracks(count: int, limit: int = None) -> None:
+    """
+    Raises TooManyTracks if count is above the limit
+    Parameters required: number of songs of the request, largest number allowed (defaults to MAX_TRACKS)
+    Return data: None
+    """
+    limit = MAX_TRACKS if limit is None else limit
+    if count > limit:
+        raise TooManyTracks(count, limit)
+
+
+class Gate:
+    """
+    Limit on the scoring requests worked on at once, with a short bounded queue in front of it
+    Parameters required: number of requests worked on at once, number allowed to wait, seconds they may wait
+    """
+
+    def __init__(
+        self,
+        limit: int = SCORE_REQUESTS,
+        queue: int = SCORE_QUEUE,
+        wait: float = QUEUE_WAIT,
+    ):
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.in_flight = 0
+        self.waiting = 0
+        # Mean seconds a request took to be served, moved a bit towards every new request
+        self.service_time = 1.0
+        self._counters = {"admitted": 0, "rejected": 0, "timed_out": 0}
+        # Created on first use, inside the event loop that uses it
+        self._semaphore = None
+
+    # Function to get the seconds a rejected client should wait before trying again
+    def retry_after(self) -> int:
+        # Time for the requests ahead of it to be served, at least a second
+        backlog = (self.in_flight + self.waiting) / max(self.limit, 1)
+        return max(1, math.ceil(self.service_time * backlog))
+
+    # Function to hold a slot while a request is served
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """
+        Async context manager that waits for a free slot, for no longer than the queue wait and the deadline allow
+        Raises Rejected if the queue is full or no slot came free in time
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if self.in_flight >= self.limit and self.waiting >= self.queue:
+            self._counters["rejected"] += 1
+            raise Rejected("The server is busy", self.retry_after())
+        wait = self.wait
+        left = remaining()
+        if left is not None:
+            wait = max(min(wait, left), 0)
+        if not self._semaphore.locked():
+            # A slot is free, taking it does not wait
+            await self._semaphore.acquire()
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), wait)
+            except asyncio.TimeoutError:
+                self._counters["timed_out"] += 1
+                raise Rejected("The server is busy", self.retry_after()) from None
+            finally:
+                self.waiting -= 1
+        self._counters["admitted"] += 1
+        self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            self.service_time += 0.1 * (time.monotonic() - start - self.service_time)
+
+    # Function to get the state and counters of the gate
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with the requests being served and waiting, the limits,
+            and the admitted, rejected (queue full) and timed_out (no slot in time) counters
+        """
+        stats = dict(self._counters)
+        stats.update(
+            {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "limit": self.limit,
+                "queue": self.queue,
+                "service_time": self.service_time,
+            }
+        )
+        return stats
+
+
+# Gate used by the whole process
+_gate = Gate()
+
+
+# Function to get the process wide gate of the scoring requests
+def get_gate() -> Gate:
+    return _gate
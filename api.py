@@ -1,22 +1,108 @@
 # Hiding linting error in importing BaseModel
 # pylint: disable=no-name-in-module
-from typing import Optional
+import asyncio
+import contextlib
+import hmac
+import math
+import os
+import threading
+import time
+import traceback
+from typing import List, Optional
 
+import admission
+import cache
 import main
+import metrics
+import ratelimit
+import registry
+import resilience
+import schema
+import spotifyclient
 import spotipy
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 
+# Seconds a scoring request waits for the models to be loaded before it is rejected
+READY_WAIT = float(os.environ.get("READY_WAIT", 10))
+# Number of times loading the models is tried before the worker reports itself dead on '/live'
+LOAD_ATTEMPTS = int(os.environ.get("LOAD_ATTEMPTS", 5))
+# Seconds waited before trying to load the models again, doubling with every failed attempt
+LOAD_BACKOFF = float(os.environ.get("LOAD_BACKOFF", 2))
+# Seconds between checks for a model version promoted by another worker, 0 turns the checks off
+MODEL_POLL = float(os.environ.get("MODEL_POLL", 30))
+# Whether responses carry the time spent in every stage in their Server-Timing header, on unless set to 0
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") != "0"
+# Token '/models/reload' and '/models/rollback' require in their X-Admin-Token header. Unset, both are turned off
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
 
 # Creating a class for the received data
+# budget is the latency budget in seconds: once it runs out, the best match among the songs scored so far is returned
 class req(BaseModel):
     prompt: str
     songlist: str
+    budget: Optional[float] = None
 
 
 class req_playlist(BaseModel):
     prompt: str
     playlist: str
+    budget: Optional[float] = None
+
+
+class req_batch(BaseModel):
+    prompts: List[str]
+    playlist: Optional[str] = None
+    songlist: Optional[str] = None
+    budget: Optional[float] = None
+
+
+class req_reload(BaseModel):
+    version: Optional[str] = None
+
+
+# Function to start loading the models when the server starts, and stop polling for new ones when it stops
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Loading, or training, the models can take long. It is done in a background thread, so the server binds its port
+    and answers '/live' and '/' right away. '/ready' tells when the models are in place
+    A failed load is tried again LOAD_ATTEMPTS times. After that '/live' fails, so the worker gets restarted
+    Workers forked by serve.py start with the models already loaded, and share them
+    """
+    loop = asyncio.get_running_loop()
+    app.state.models_loaded = asyncio.Event()
+    app.state.load_failed = False
+
+    # Function run by the background thread
+    def load():
+        for attempt in range(LOAD_ATTEMPTS):
+            try:
+                main.load_models()
+            except Exception as e:
+                print(
+                    "Could not load the models (attempt %d of %d): %s"
+                    % (attempt + 1, LOAD_ATTEMPTS, e)
+                )
+                traceback.print_exc()
+                if attempt + 1 < LOAD_ATTEMPTS:
+                    time.sleep(LOAD_BACKOFF * 2**attempt)
+                continue
+            loop.call_soon_threadsafe(app.state.models_loaded.set)
+            return
+        app.state.load_failed = True
+
+    if main.Models is not None:
+        # Loaded by serve.py before this worker was forked
+        app.state.models_loaded.set()
+    else:
+        threading.Thread(target=load, name="model-loader", daemon=True).start()
+    poller = asyncio.ensure_future(poll_for_models()) if MODEL_POLL > 0 else None
+    yield
+    if poller is not None:
+        poller.cancel()
 
 
 # FastAPI Object
@@ -24,8 +110,164 @@ app = FastAPI(
     title="Cadence API",
     description="This API is the backend for Cadence app",
     redocs_url="/api/v2/redocs",
+    lifespan=lifespan,
 )
 
+
+# Function to time every request
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """
+    Records the latency of every request by path and status, and collects the time its stages took (see metrics.py)
+    """
+    timings = metrics.start_request()
+    start = time.perf_counter()
+    response = await call_next(request)
+    path = request.scope.get("route").path if request.scope.get("route") else "other"
+    metrics.observe_histogram(
+        "cadence_request_seconds", time.perf_counter() - start, path=path
+    )
+    metrics.count("cadence_requests_total", path=path, status=response.status_code)
+    if SERVER_TIMING and timings:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+
+# Function to keep the models in line with the version promoted in the registry
+async def poll_for_models():
+    """
+    Runs for the lifetime of the server. A version promoted by another worker, or by a retraining job,
+    is loaded in a background thread and swapped in without stopping the requests being served
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(MODEL_POLL)
+        try:
+            await loop.run_in_executor(None, main.check_for_new_models)
+        except Exception as e:
+            print("Could not swap in new models: " + str(e))
+
+
+# Function to hold a scoring request until the models are loaded
+async def wait_for_models() -> Optional[JSONResponse]:
+    """
+    Waits up to READY_WAIT seconds for the models
+    Return Data: None if the models are ready, else a 503 response to send back
+    """
+    if main.load_error is None:
+        try:
+            await asyncio.wait_for(app.state.models_loaded.wait(), READY_WAIT)
+            return None
+        except asyncio.TimeoutError:
+            pass
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Models are not loaded yet, try again later"},
+        headers={"Retry-After": "5"},
+    )
+
+
+# Function to check that a request may change the models in use
+def not_admin(token: Optional[str]) -> Optional[JSONResponse]:
+    """
+    Parameters Required: X-Admin-Token header of the request
+    Return Data: None if it holds the admin token, else a 403 response to send back
+    """
+    if not ADMIN_TOKEN:
+        return JSONResponse(
+            status_code=403,
+            content={"error": "Model administration is turned off, set ADMIN_TOKEN"},
+        )
+    # Compared in constant time, so the token cannot be guessed from response times
+    if token is None or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return JSONResponse(
+            status_code=403, content={"error": "Missing or wrong admin token"}
+        )
+    return None
+
+
+# Function to answer a request that spotify kept rate limiting, or failing
+def spotify_busy(e: spotipy.exceptions.SpotifyException) -> JSONResponse:
+    """
+    The calls were already retried, so the client is asked to come back once spotify lets calls through again,
+    instead of getting an internal error
+    Parameters required: error raised by the spotify call (429, 5xx, or resilience.CircuitOpen)
+    Return Data: 503 response to send back
+    """
+    if isinstance(e, resilience.CircuitOpen):
+        wait = e.retry_after
+    else:
+        wait = ratelimit.get_limiter().stats()["blocked_for"]
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Spotify is not answering requests, try again later"},
+        headers={"Retry-After": str(max(1, math.ceil(wait)))},
+    )
+
+
+# Function to answer a request that could not be served in time
+def overloaded(e: admission.Overloaded) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(e) + ", try again later"},
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
+
+
+# Function to answer a request for too many songs
+def too_many_tracks(e: admission.TooManyTracks) -> JSONResponse:
+    return JSONResponse(
+        status_code=413,
+        content={"error": "Too many songs in the request", "errormessage": str(e)},
+    )
+
+
+# Function to answer a batch request without any prompt
+def no_prompts() -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={
+            "error": "No prompts in the request",
+            "errormessage": "Send at least one prompt",
+        },
+    )
+
+
+# Function to answer a batch request with more prompts than admission.MAX_PROMPTS
+def too_many_prompts(count: int) -> JSONResponse:
+    return JSONResponse(
+        status_code=413,
+        content={
+            "error": "Too many prompts in the request",
+            "errormessage": "%d prompts sent, at most %d are allowed"
+            % (count, admission.MAX_PROMPTS),
+        },
+    )
+
+
+# Function to serve a scoring request within the admission limits
+async def admitted(call, *args) -> dict:
+    """
+    Gives the request its deadline, then waits for a slot (see admission.py)
+    Parameters required: async function serving the request, and its arguments
+    Return Data: what the function returned
+    Raises admission.Overloaded if the request could not be admitted or served in time
+    """
+    admission.start_deadline()
+    try:
+        async with admission.get_gate().admit():
+            return await call(*args)
+    except admission.Rejected:
+        metrics.count("cadence_rejected_total", reason="busy")
+        raise
+    except admission.DeadlineExceeded:
+        metrics.count("cadence_rejected_total", reason="deadline")
+        raise
+    except admission.TooManyTracks:
+        metrics.count("cadence_rejected_total", reason="too_many_tracks")
+        raise
+
+
 # Function to run backend on a playlist url
 @app.post("/playlist")
 async def get_song_playlist(data: req_playlist):
@@ -34,18 +276,38 @@ async def get_song_playlist(data: req_playlist):
     The POST data required is in the form:
         {
             prompt: "example prompt",
-            playlist: "playlist url"
+            playlist: "playlist url",
+            budget: 2.5
         }
+    budget is optional. Given, the best match among the songs scored within that many seconds is returned,
+    and 'considered' in the response tells how many of the 'total' songs were scored
     """
+    # Holding the request until the models are loaded
+    not_ready = await wait_for_models()
+    if not_ready is not None:
+        return not_ready
     # Converting received data to dict to make it accessable
     retdata = dict(data)
     try:
-        return main.apicall_playlist(retdata["prompt"], retdata["playlist"])
+        return await admitted(
+            main.apicall_playlist_async,
+            retdata["prompt"],
+            retdata["playlist"],
+            retdata["budget"],
+        )
+    except admission.Overloaded as e:
+        return overloaded(e)
+    except admission.TooManyTracks as e:
+        return too_many_tracks(e)
     except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 429 or e.http_status >= 500:
+            return spotify_busy(e)
         if e.http_status == 404 or e.http_status == 400:
             return {"error": "Check validity of given playlist url", "errormessage": e}
         else:
             return {"error": "internal", "errormessage": e}
+    except schema.IncompleteFeatures as e:
+        return {"error": "Incomplete audio features for a song", "errormessage": str(e)}
     except Exception as e:
         return {"error": "internal", "errormessage": e}
 
@@ -61,11 +323,26 @@ async def get_song(data: req):
             playlist: "playlist url"
         }
     """
+    # Holding the request until the models are loaded
+    not_ready = await wait_for_models()
+    if not_ready is not None:
+        return not_ready
     # Converting received data to dict to make it accessable
     retdata = dict(data)
     try:
-        return main.apicall_songlist(retdata["prompt"], retdata["songlist"])
+        return await admitted(
+            main.apicall_songlist_async,
+            retdata["prompt"],
+            retdata["songlist"],
+            retdata["budget"],
+        )
+    except admission.Overloaded as e:
+        return overloaded(e)
+    except admission.TooManyTracks as e:
+        return too_many_tracks(e)
     except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 429 or e.http_status >= 500:
+            return spotify_busy(e)
         if e.http_status == 404 or e.http_status == 400:
             return {"error": "Check validity of given track IDs", "errormessage": e}
         else:
@@ -74,6 +351,71 @@ async def get_song(data: req):
         return {"error": "Check if all song IDs are valid", "errormessage": e}
     except IndexError as e:
         return {"error": "Check format of input", "errormessage": e}
+    except schema.IncompleteFeatures as e:
+        return {"error": "Incomplete audio features for a song", "errormessage": str(e)}
+    except Exception as e:
+        return {"error": "internal", "errormessage": e}
+
+
+# Function to run backend on many prompts against one playlist url or list of song IDs
+@app.post("/batch")
+async def get_song_batch(data: req_batch):
+    """
+    This function is triggered when a POST request is received at '/batch'
+    The POST data required is in the form:
+        {
+            prompts: ["example prompt", "another prompt"],
+            playlist: "playlist url"
+        }
+    or, with songs instead of a playlist:
+        {
+            prompts: ["example prompt", "another prompt"],
+            songlist: "song id;song id;"
+        }
+    Both forms take an optional budget in seconds, as on '/playlist'
+    At least one and at most admission.MAX_PROMPTS prompts are taken
+    """
+    # Refusing empty and oversized batches before waiting for anything
+    if not data.prompts:
+        return no_prompts()
+    if len(data.prompts) > admission.MAX_PROMPTS:
+        return too_many_prompts(len(data.prompts))
+    # Holding the request until the models are loaded
+    not_ready = await wait_for_models()
+    if not_ready is not None:
+        return not_ready
+    # Converting received data to dict to make it accessable
+    retdata = dict(data)
+    if (retdata["playlist"] is None) == (retdata["songlist"] is None):
+        return {"error": "Give either a playlist url or a list of song IDs"}
+    try:
+        return await admitted(
+            main.apicall_batch_async,
+            retdata["prompts"],
+            retdata["playlist"],
+            retdata["songlist"],
+            retdata["budget"],
+        )
+    except admission.Overloaded as e:
+        return overloaded(e)
+    except admission.TooManyTracks as e:
+        return too_many_tracks(e)
+    except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 429 or e.http_status >= 500:
+            return spotify_busy(e)
+        if e.http_status == 404 or e.http_status == 400:
+            return {
+                "error": "Check validity of given playlist url or track IDs",
+                "errormessage": e,
+            }
+        else:
+            return {"error": "internal", "errormessage": e}
+    except TypeError as e:
+        return {"error": "Check if all song IDs are valid", "errormessage": e}
+    except IndexError as e:
+        return {"error": "Check format of input", "errormessage": e}
+    except schema.IncompleteFeatures as e:
+        return {"error": "Incomplete audio features for a song", "errormessage": str(e)}
     except Exception as e:
         return {"error": "internal", "errormessage": e}
 
@@ -82,3 +424,141 @@ async def get_song(data: req):
 @app.get("/")
 async def check_status():
     return {"status": "online"}
+
+
+# Get method to check if the server process is alive, answers even while the models are loading
+@app.get("/live")
+async def check_live():
+    # Every attempt to load the models failed, the worker is of no use until it is restarted
+    if app.state.load_failed:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "failed", "errormessage": str(main.load_error)},
+        )
+    return {"status": "alive"}
+
+
+# Get method to check if the server can score requests
+@app.get("/ready")
+async def check_ready():
+    if main.models_ready():
+        return {"status": "ready"}
+    if app.state.load_failed:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "failed", "errormessage": str(main.load_error)},
+        )
+    if main.load_error is not None:
+        # Loading failed, and is being tried again
+        return JSONResponse(
+            status_code=503,
+            content={"status": "loading", "errormessage": str(main.load_error)},
+        )
+    return JSONResponse(status_code=503, content={"status": "loading"})
+
+
+# Get method to list the model versions
+@app.get("/models")
+async def get_models():
+    """
+    This function is triggered when a GET request is received at '/models'
+    It returns the version serving requests in this worker, the version promoted in the registry,
+    the versions that can be rolled back to, and every version saved
+    """
+    return {
+        "active": main.model_version(),
+        "current": registry.current_version(),
+        "history": registry.history(),
+        "versions": registry.list_versions(),
+    }
+
+
+# Function to swap in another version of the models
+@app.post("/models/reload")
+async def reload_models(data: req_reload, x_admin_token: str = Header(None)):
+    """
+    This function is triggered when a POST request is received at '/models/reload'
+    The POST data is in the form:
+        {
+            version: "version name"
+        }
+    Without a version, the version promoted in the registry is loaded
+    The request must carry the admin token in its X-Admin-Token header
+    """
+    refused = not_admin(x_admin_token)
+    if refused is not None:
+        return refused
+    loop = asyncio.get_running_loop()
+    try:
+        version = await loop.run_in_executor(None, main.reload_models, data.version)
+    except ValueError as e:
+        return {"error": "Check the given model version", "errormessage": str(e)}
+    except Exception as e:
+        return {"error": "internal", "errormessage": str(e)}
+    return {"version": version}
+
+
+# Function to go back to the models used before the current ones
+@app.post("/models/rollback")
+async def rollback_models(x_admin_token: str = Header(None)):
+    """
+    This function is triggered when a POST request is received at '/models/rollback'
+    The request must carry the admin token in its X-Admin-Token header
+    """
+    refused = not_admin(x_admin_token)
+    if refused is not None:
+        return refused
+    loop = asyncio.get_running_loop()
+    try:
+        version = await loop.run_in_executor(None, main.rollback_models)
+    except ValueError as e:
+        return {
+            "error": "No earlier model version to roll back to",
+            "errormessage": str(e),
+        }
+    except Exception as e:
+        return {"error": "internal", "errormessage": str(e)}
+    return {"version": version}
+
+
+# Get method to get the metrics in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    """
+    This function is triggered when a GET request is received at '/metrics'
+    It returns the stage latency histograms, spotify and request counters, the counters of the local caches,
+    the state of the spotify rate limiter, and the scoring requests being served and waiting
+    """
+    return PlainTextResponse(
+        metrics.render(
+            {
+                "features": cache.get_feature_store().stats(),
+                "predictions": cache.get_prediction_cache().stats(),
+                "intents": cache.get_intent_cache().stats(),
+                "playlists": cache.get_playlist_results().stats(),
+            },
+            ratelimit.get_limiter().stats(),
+            admission.get_gate().stats(),
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+# Get method to check how well the local caches are doing
+@app.get("/stats")
+async def get_stats():
+    """
+    This function is triggered when a GET request is received at '/stats'
+    It returns the hit, miss and eviction counters of the local caches, so they can be sized,
+    the queue of spotify calls waiting for the rate limiter, the scoring requests being served and waiting,
+    and the hedges, retries and circuit breaker of the chunked spotify calls
+    """
+    return {
+        "features": cache.get_feature_store().stats(),
+        "predictions": cache.get_prediction_cache().stats(),
+        "intents": cache.get_intent_cache().stats(),
+        "playlists": cache.get_playlist_results().stats(),
+        "spotify": ratelimit.get_limiter().stats(),
+        "admission": admission.get_gate().stats(),
+        "resilience": spotifyclient.get_async_client().resilient.stats(),
+    }
@@ -0,0 +1,588 @@
+"""
+cache.py
+Local caches used by the server backend, so that repeated work is not sent to Spotify again
+
+Track features:
+ -> Audio features of a track (acousticness, energy, tempo etc.) almost never change, so they are kept indefinitely
+ -> Name, Artist and Popularity come from the tracks endpoint. Popularity changes over time, so it expires after a TTL
+ -> Records live in an in-memory LRU, backed by a SQLite file so they survive restarts and are shared between workers
+ -> Only tracks that miss both layers are fetched from Spotify
+
+Predictions:
+ -> The class probabilities of a track only depend on its audio features and the trained model
+ -> They are kept in memory under (model fingerprint, track ID), so repeated songs are not scored again
+ -> When a different model is bound, every prediction made by the old one is dropped
+
+Intents:
+ -> Prompts are short and repeat a lot ("Gym time", "Sleep"), so parsed prompts are kept the same way,
+    under (fingerprint of the NLU model and keyword lexicon, normalized prompt)
+
+Playlists:
+ -> Spotify gives every version of a playlist a snapshot_id, which changes whenever its songs change
+ -> The track IDs of a playlist are kept in the SQLite file under its snapshot_id. A request only asks Spotify for the
+    current snapshot_id, and pages through the playlist again only if it changed. Name, Artist and Popularity of the
+    songs are saved from the pages as track details, and their class probabilities are kept by the prediction cache
+ -> Many users pick songs from the same popular playlists, often at the same time
+ -> The scored songs of a playlist are keyed by (playlist ID, snapshot_id, model version). Concurrent requests
+    for the same key share one running fetch and score job, and its result is kept for a short time
+ -> A changed playlist gets a new snapshot_id from Spotify, so it is never served from an older result
+ -> A request with a latency budget can answer from the songs the running job scored so far, while the job goes on
+    for the other requests. Once no request waits on a job any more it is cancelled, so it does not keep scoring
+    outside the admission limit of admission.py
+ -> The job does not inherit the deadline of the request that started it, so a request joining with more time left
+    is not cut short. It runs until the last of its requests stops waiting, that is, up to the latest of their deadlines
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Function to turn any form of track reference into a bare track ID
+def track_key(track: str) -> str:
+    """
+    Spotify accepts bare IDs, URIs (spotify:track:<id>) and URLs (https://open.spotify.com/track/<id>?si=..)
+    The cache always stores the bare ID, so all three forms share one entry. Works the same for playlist IDs
+    Parameters required: track ID, URI or URL
+    Return data: bare track ID
+    """
+    track = track.strip().split("?")[0]
+    return track.replace("/", ":").rstrip(":").split(":")[-1]
+
+
+class FeatureStore:
+    """
+    Persistent store of track features, keyed by bare track ID
+    Parameters required: path of the SQLite file, number of tracks held in memory, seconds after which Popularity is stale,
+        and bytes of the SQLite file read through a memory map
+    """
+
+    def __init__(
+        self,
+        path: str = "featurecache.sqlite",
+        capacity: int = 20000,
+        popularity_ttl: int = 24 * 60 * 60,
+        mmap_size: int = 256 * 1024 * 1024,
+    ):
+        self.path = path
+        self.capacity = capacity
+        self.popularity_ttl = popularity_ttl
+        self._lock = threading.Lock()
+        # In-memory LRU of id -> record, most recently used at the end
+        self._memory = OrderedDict()
+        # Counters of every table: audio features and track details share the tracks table of SQLite,
+        # but are looked up and go stale separately
+        self._counters = {
+            "features": {"hits": 0, "misses": 0},
+            "tracks": {"hits": 0, "misses": 0, "expired": 0},
+            "playlists": {"hits": 0, "misses": 0},
+        }
+        self._evictions = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets several worker processes read while one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Reading through a memory map, every worker process shares the same pages of the file in the OS cache
+        # instead of holding its own copy of them
+        self._db.execute("PRAGMA mmap_size=%d" % mmap_size)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "id TEXT PRIMARY KEY, features TEXT, name TEXT, artist TEXT, "
+            "popularity INTEGER, popularity_at REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS playlists ("
+            "id TEXT PRIMARY KEY, snapshot_id TEXT, tracks TEXT, saved_at REAL)"
+        )
+        self._db.commit()
+
+    # Function to put a record in the in-memory LRU, evicting the oldest if it is full
+    def _remember(self, key: str, record: dict) -> None:
+        self._memory[key] = record
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+            self._evictions += 1
+
+    # Function to get records from memory, falling back to SQLite for the rest
+    def _load(self, keys: list) -> dict:
+        records = {}
+        absent = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                records[key] = self._memory[key]
+            else:
+                absent.append(key)
+        # SQLite limits the number of bound parameters, so query in chunks
+        for count in range(0, len(absent), 500):
+            chunk = absent[count : count + 500]
+            rows = self._db.execute(
+                "SELECT id, features, name, artist, popularity, popularity_at FROM tracks "
+                "WHERE id IN (%s)" % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            for row in rows:
+                record = {
+                    "features": json.loads(row[1]) if row[1] else None,
+                    "Name": row[2],
+                    "Artist": row[3],
+                    "Popularity": row[4],
+                    "popularity_at": row[5],
+                }
+                records[row[0]] = record
+                self._remember(row[0], record)
+        return records
+
+    # Function to get cached audio features
+    def get_features(self, keys: list) -> dict:
+        """
+        Parameters required: list of bare track IDs
+        Return data: dictionary of track ID -> copy of its audio features, for the IDs that are cached
+        """
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            records = self._load(keys)
+            found = {
+                key: dict(record["features"])
+                for key, record in records.items()
+                if record["features"] is not None
+            }
+            self._counters["features"]["hits"] += len(found)
+            self._counters["features"]["misses"] += len(keys) - len(found)
+        return found
+
+    # Function to get cached track details whose Popularity is still fresh
+    def get_tracks(self, keys: list) -> dict:
+        """
+        Parameters required: list of bare track IDs
+        Return data: dictionary of track ID -> {"Name", "Artist", "Popularity"}, for the IDs that are cached and not stale
+        """
+        keys = list(dict.fromkeys(keys))
+        oldest = time.time() - self.popularity_ttl
+        found = {}
+        with self._lock:
+            for key, record in self._load(keys).items():
+                if record["popularity_at"] is None:
+                    continue
+                if record["popularity_at"] < oldest:
+                    # Counted once, not on every lookup until the track is fetched again
+                    if not record.get("expired"):
+                        record["expired"] = True
+                        self._counters["tracks"]["expired"] += 1
+                    continue
+                found[key] = {
+                    "Name": record["Name"],
+                    "Artist": record["Artist"],
+                    "Popularity": record["Popularity"],
+                }
+            self._counters["tracks"]["hits"] += len(found)
+            self._counters["tracks"]["misses"] += len(keys) - len(found)
+        return found
+
+    # Function to save audio features returned by spotify.audio_features
+    def put_features(self, features: list) -> None:
+        """
+        Parameters required: list of audio feature dictionaries (None entries are skipped)
+        Return data: None
+        """
+        features = [i for i in features if i]
+        with self._lock:
+            # Records that are not in memory are read back from SQLite in full on their next lookup
+            for feature in features:
+                if feature["id"] in self._memory:
+                    self._memory[feature["id"]]["features"] = dict(feature)
+            self._db.executemany(
+                "INSERT INTO tracks (id, features) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET features = excluded.features",
+                [(i["id"], json.dumps(i)) for i in features],
+            )
+            self._db.commit()
+
+    # Function to save track details returned by spotify.tracks
+    def put_tracks(self, tracks: list) -> None:
+        """
+        Parameters required: list of track objects from the tracks endpoint (None entries are skipped)
+        Return data: None
+        """
+        now = time.time()
+        rows = [
+            (i["id"], i["name"], i["artists"][0]["name"], i["popularity"], now)
+            for i in tracks
+            if i
+        ]
+        with self._lock:
+            for row in rows:
+                if row[0] in self._memory:
+                    self._memory[row[0]].update(
+                        {
+                            "Name": row[1],
+                            "Artist": row[2],
+                            "Popularity": row[3],
+                            "popularity_at": now,
+                            "expired": False,
+                        }
+                    )
+            self._db.executemany(
+                "INSERT INTO tracks (id, name, artist, popularity, popularity_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+                "name = excluded.name, artist = excluded.artist, "
+                "popularity = excluded.popularity, popularity_at = excluded.popularity_at",
+                rows,
+            )
+            self._db.commit()
+
+    # Function to get the track IDs saved for a playlist
+    def get_playlist(self, playlist_id: str, snapshot_id: str) -> list:
+        """
+        Parameters required: bare playlist ID, and its snapshot_id as spotify gives it now
+        Return data: list of bare track IDs in playlist order, None if the playlist was not saved for this snapshot
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT snapshot_id, tracks FROM playlists WHERE id = ?",
+                (playlist_id,),
+            ).fetchone()
+            if row is None or row[0] != snapshot_id:
+                self._counters["playlists"]["misses"] += 1
+                return None
+            self._counters["playlists"]["hits"] += 1
+        return json.loads(row[1])
+
+    # Function to save the track IDs of a playlist
+    def put_playlist(self, playlist_id: str, snapshot_id: str, track_ids: list) -> None:
+        """
+        Only the latest snapshot of a playlist is kept
+        Parameters required: bare playlist ID, snapshot_id the tracks were read at, list of bare track IDs in playlist order
+        Return data: None
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO playlists (id, snapshot_id, tracks, saved_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET snapshot_id = excluded.snapshot_id, "
+                "tracks = excluded.tracks, saved_at = excluded.saved_at",
+                (playlist_id, snapshot_id, json.dumps(track_ids), time.time()),
+            )
+            self._db.commit()
+
+    # Function to get the cache counters
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with the hits and misses counters of the features, tracks (with the expired counter)
+            and playlists tables, each under its name, the evictions counter, and the number of tracks in memory
+        """
+        with self._lock:
+            stats = {table: dict(i) for table, i in self._counters.items()}
+            stats["evictions"] = self._evictions
+            stats["size"] = len(self._memory)
+            stats["capacity"] = self.capacity
+        return stats
+
+
+class FingerprintCache:
+    """
+    In-memory LRU of values computed by a model, keyed by (model fingerprint, key)
+    Parameters required: number of values held in memory
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.fingerprint = None
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    # Function to set the model whose values are cached
+    def bind(self, fingerprint: str) -> None:
+        """
+        Drops every cached value if the fingerprint differs from the one currently bound
+        Parameters required: fingerprint of the model about to be used
+        Return data: None
+        """
+        with self._lock:
+            if fingerprint != self.fingerprint:
+                if self.fingerprint is not None:
+                    self._counters["invalidations"] += 1
+                self._rows.clear()
+                self.fingerprint = fingerprint
+
+    # Function to get cached values
+    def get(self, fingerprint: str, keys: list) -> dict:
+        """
+        Parameters required: fingerprint of the model, list of keys
+        Return data: dictionary of key -> value, for the keys that are cached
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._rows.get((fingerprint, key))
+                if row is not None:
+                    self._rows.move_to_end((fingerprint, key))
+                    found[key] = row
+            self._counters["hits"] += len(found)
+            self._counters["misses"] += len(keys) - len(found)
+        return found
+
+    # Function to save values
+    def put(self, fingerprint: str, keys: list, rows) -> None:
+        """
+        Parameters required: fingerprint of the model, list of keys, values in the same order
+        Return data: None
+        """
+        with self._lock:
+            # Values from a model that has since been replaced are not worth keeping
+            if fingerprint != self.fingerprint:
+                return
+            for key, row in zip(keys, rows):
+                self._rows[(fingerprint, key)] = row
+                self._rows.move_to_end((fingerprint, key))
+            while len(self._rows) > self.capacity:
+                self._rows.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    # Function to get the cache counters
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with hits, misses, evictions and invalidations counters, and the number of values held
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._rows)
+            stats["capacity"] = self.capacity
+        return stats
+
+
+class PredictionCache(FingerprintCache):
+    """
+    Class probability rows of the ML model, keyed by (model fingerprint, track ID)
+    Parameters required: number of rows held in memory
+    """
+
+    def __init__(self, capacity: int = 100000):
+        super().__init__(capacity)
+
+
+class IntentCache(FingerprintCache):
+    """
+    Parsed prompts of the NLU model, keyed by (model fingerprint, normalized prompt)
+    Also keeps the time spent parsing prompts that were not cached, for every path that answered them
+    Parameters required: number of prompts held in memory
+    """
+
+    def __init__(self, capacity: int = 10000):
+        super().__init__(capacity)
+        # Number of prompts and seconds spent, for every path that can answer a prompt
+        self._parses = {}
+
+    # Function to record how long parsing prompts took
+    def record_parse(self, path: str, count: int, seconds: float) -> None:
+        """
+        Parameters required: path that answered ("lexicon" or "snips"), number of prompts, seconds spent on them
+        Return data: None
+        """
+        with self._lock:
+            parses = self._parses.setdefault(path, [0, 0.0])
+            parses[0] += count
+            parses[1] += seconds
+
+    # Function to get the cache counters, hit ratio and parse latency
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+            stats["parses"] = {
+                path: {
+                    "count": count,
+                    "seconds_mean": seconds / count if count else 0.0,
+                }
+                for path, (count, seconds) in self._parses.items()
+            }
+        return stats
+
+
+class SingleFlight:
+    """
+    Runs one job at a time for every key, sharing it between the callers that ask for the same key while it runs,
+    and keeps its result for ttl seconds. Results are held in an LRU, failed jobs are not kept
+    Used from the event loop only, so it does not need a lock
+    Parameters required: seconds a result is kept, number of results held in memory
+    """
+
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = capacity
+        # key -> (time the result expires, result), most recently used at the end
+        self._results = OrderedDict()
+        # key -> [task of the running job, progress object of the job, number of callers waiting on it]
+        self._running = {}
+        self._counters = {
+            "hits": 0,
+            "joined": 0,
+            "misses": 0,
+            "evictions": 0,
+            "abandoned": 0,
+        }
+
+    # Function to get the result of a job, running it only if no caller is running it already
+    async def run(self, key, job):
+        """
+        Parameters required: key of the job, function with no arguments returning the coroutine of the job
+        Return data: result of the job, shared with every caller of the same key
+        """
+        return await self.start(key, job)[0]
+
+    # Function to start a job, or join the one running, without waiting for its result
+    def start(self, key, job, progress=None) -> tuple:
+        """
+        The progress object is anything the job fills in while it runs, so callers can look at its work so far.
+        Callers that join a running job get the progress object of the caller that started it
+        Cancelling the returned future leaves the job; the job itself is cancelled once every caller waiting on it left,
+        so no job runs on for requests that are no longer served. The job does not see the context variables of the
+        caller that started it, so a caller with a deadline must bound its own wait (see admission.within)
+        Parameters required: key of the job, function with no arguments returning the coroutine of the job,
+            progress object filled in by that coroutine
+        Return data: tuple of (future of the result, progress object of the job), the progress object being None for
+            a kept result
+        """
+        entry = self._results.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._results.move_to_end(key)
+            self._counters["hits"] += 1
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(entry[1])
+            return future, None
+        running = self._running.get(key)
+        if running is not None:
+            self._counters["joined"] += 1
+        else:
+            self._counters["misses"] += 1
+            # The job runs in an empty context, so it does not carry the deadline (see admission.py) or the timings
+            # (see metrics.py) of the caller that happened to start it. It is bounded by its callers instead: each one
+            # stops waiting at its own deadline, and the job is cancelled once the last one left
+            task = contextvars.Context().run(asyncio.ensure_future, job())
+            running = self._running[key] = [task, progress, 0]
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return self._join(running), running[1]
+
+    # Function to wait on a running job, as one more of its callers
+    def _join(self, running: list) -> asyncio.Future:
+        """
+        Parameters required: entry of the running job
+        Return data: future of its result, cancelled on its own without cancelling the job for the other callers
+        """
+        task = running[0]
+        future = asyncio.get_running_loop().create_future()
+        running[2] += 1
+
+        def copy(done: asyncio.Task) -> None:
+            if future.done():
+                return
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+        def leave(done: asyncio.Future) -> None:
+            running[2] -= 1
+            # The last caller gave up, nobody is left to use the result
+            if done.cancelled() and running[2] == 0 and not task.done():
+                self._counters["abandoned"] += 1
+                task.cancel()
+
+        task.add_done_callback(copy)
+        future.add_done_callback(leave)
+        return future
+
+    # Function to keep the result of a finished job
+    def _finish(self, key, task: asyncio.Task) -> None:
+        del self._running[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._results[key] = (time.monotonic() + self.ttl, task.result())
+        self._results.move_to_end(key)
+        while len(self._results) > self.capacity:
+            self._results.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    # Function to get the counters
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with hits, joined (callers that shared a running job), misses, evictions and abandoned
+            (jobs cancelled as every caller left) counters, and the number of jobs running and results held
+        """
+        stats = dict(self._counters)
+        stats["running"] = len(self._running)
+        stats["size"] = len(self._results)
+        stats["capacity"] = self.capacity
+        return stats
+
+
+# Function to normalize a prompt before looking it up
+def normalize_prompt(prompt: str) -> str:
+    """
+    Prompts that only differ in case or spacing ("Gym time", " gym  TIME ") share one cache entry
+    Parameters required: prompt
+    Return data: normalized prompt
+    """
+    return " ".join(prompt.lower().split())
+
+
+# Caches used by the whole process, created on first use
+_feature_store = None
+_feature_store_lock = threading.Lock()
+_prediction_cache = PredictionCache()
+_intent_cache = IntentCache()
+# Seconds the scored songs of a playlist are kept, can be set with the PLAYLIST_TTL environment variable
+_playlist_results = SingleFlight(float(os.environ.get("PLAYLIST_TTL", 300)), 256)
+
+
+# Function to get the process wide feature store
+def get_feature_store() -> FeatureStore:
+    """
+    Returns the process wide FeatureStore, creating it on the first call
+    Parameters required: None
+    Return data: FeatureStore object
+    """
+    global _feature_store
+    if _feature_store is None:
+        with _feature_store_lock:
+            if _feature_store is None:
+                _feature_store = FeatureStore()
+    return _feature_store
+
+
+# Function to get the process wide prediction cache
+def get_prediction_cache() -> PredictionCache:
+    """
+    Parameters required: None
+    Return data: PredictionCache object
+    """
+    return _prediction_cache
+
+
+# Function to get the process wide intent cache
+def get_intent_cache() -> IntentCache:
+    """
+    Parameters required: None
+    Return data: IntentCache object
+    """
+    return _intent_cache
+
+
+# Function to get the process wide results of scored playlists
+def get_playlist_results() -> SingleFlight:
+    """
+    Parameters required: None
+    Return data: SingleFlight object
+    """
+    return _playlist_results
@@ -0,0 +1,193 @@
+"""
+lexicon.py
+Keyword classifier that answers obvious prompts before they reach the Snips NLU engine
+
+Most alarm labels give away their intent with a single word ("Gym time", "Sleep", "study"). Parsing them with Snips still
+runs the whole engine, including builtin entity extraction. The lexicon is built from the same yaml files the engine is
+trained on:
+ -> Every entity value, and every word of an utterance, is recorded with the intents it appears in, and the number of
+    utterances of each intent it appears in
+ -> Words and phrases that appear in more than one intent are ambiguous, and are not used to decide
+ -> Only the name of an intent, and words and phrases found in at least MIN_SUPPORT of its utterances, decide a prompt.
+    A word seen in a single training line ("wake" in "Need to wake up for yoga") is too weak to answer a prompt alone
+ -> A prompt is answered only if a deciding word points to one single intent, and no other known word of the prompt
+    points to a different intent
+ -> Anything else (no deciding words, or words of different intents) is left to Snips
+The lexicon only finds the intent. Prompts it answers are returned without slots.
+Every model version keeps a copy of the training files it was built from (see registry.py), and its lexicon is built from
+that copy when the version is loaded, so the lexicon always matches the Snips engine it answers for.
+"""
+
+import hashlib
+import os
+import re
+from typing import Optional
+
+import yaml
+
+# Words too common to say anything about an intent
+STOPWORDS = {
+    "a",
+    "an",
+    "and",
+    "at",
+    "by",
+    "do",
+    "for",
+    "go",
+    "going",
+    "have",
+    "i",
+    "im",
+    "in",
+    "me",
+    "my",
+    "need",
+    "of",
+    "on",
+    "some",
+    "the",
+    "to",
+    "up",
+    "very",
+    "with",
+}
+
+# Number of utterances of an intent a word or phrase must appear in to decide a prompt on its own
+MIN_SUPPORT = 2
+
+# Matches slot annotations in utterances, like [work](jogging)
+SLOT_PATTERN = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
+
+
+# Function to split text into lowercase words
+def tokenize(text: str) -> list:
+    return re.findall(r"[a-z0-9']+", text.lower().replace("'", ""))
+
+
+class Lexicon:
+    """
+    Trie of words and phrases, each leading to the intents it appears in and how strongly they support it
+    Build it with Lexicon.from_yaml_files()
+    """
+
+    def __init__(self):
+        # Nested dictionaries of word -> node. A node that ends a phrase holds, under the key None, a dictionary of
+        # intent -> number of utterances of the intent the phrase appears in
+        self.trie = {}
+        # Hash of the training files the lexicon was built from
+        self.fingerprint = None
+
+    # Function to add a phrase of an intent to the trie
+    def add(self, words: list, intent: str, support: int = 0) -> None:
+        """
+        Parameters required: words of the phrase, intent it appears in, number of utterances it adds support from
+        Return data: None
+        """
+        if not words:
+            return
+        node = self.trie
+        for word in words:
+            node = node.setdefault(word, {})
+        intents = node.setdefault(None, {})
+        intents[intent] = intents.get(intent, 0) + support
+
+    # Function to build the lexicon from snips training files
+    @classmethod
+    def from_yaml_files(cls, paths: list) -> "Lexicon":
+        """
+        Parameters required: list of paths to snips nlu yaml files
+        Return data: Lexicon object
+        """
+        documents = []
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            with open(path) as file:
+                text = file.read()
+            digest.update(text.encode())
+            documents.extend(i for i in yaml.safe_load_all(text) if i)
+        entities = {i["name"]: i for i in documents if i.get("type") == "entity"}
+        lexicon = cls()
+        for intent in (i for i in documents if i.get("type") == "intent"):
+            name = intent["name"]
+            slots = {i["name"]: i["entity"] for i in intent.get("slots", [])}
+            # The name of the intent always decides for it
+            lexicon.add(tokenize(name), name, MIN_SUPPORT)
+            used = set()
+            for utterance in intent.get("utterances", []):
+                # Every phrase is counted once per utterance
+                phrases = set()
+                # Builtin entities (times, cities..) are not specific to an intent
+                for slot, value in SLOT_PATTERN.findall(utterance):
+                    entity = slots.get(slot, slot)
+                    if not entity.startswith("snips/"):
+                        used.add(entity)
+                        phrases.add(tuple(tokenize(value)))
+                words = tokenize(
+                    SLOT_PATTERN.sub(
+                        lambda i: ""
+                        if slots.get(i.group(1), "").startswith("snips/")
+                        else i.group(2),
+                        utterance,
+                    )
+                )
+                phrases.update(
+                    (i,) for i in words if i not in STOPWORDS and not i.isdigit()
+                )
+                for phrase in phrases:
+                    lexicon.add(list(phrase), name, 1)
+            # Values of the custom entities this intent uses, including synonyms. They are known words of the intent,
+            # but a value listed once is not support from an utterance
+            for entity in used:
+                for value in entities.get(entity, {}).get("values", []):
+                    for synonym in value if isinstance(value, list) else [value]:
+                        lexicon.add(tokenize(str(synonym)), name)
+        lexicon.fingerprint = digest.hexdigest()
+        return lexicon
+
+    # Function to build the lexicon from a directory of snips training files
+    @classmethod
+    def from_directory(cls, directory: str) -> "Lexicon":
+        """
+        Parameters required: directory holding the yaml files
+        Return data: Lexicon object
+        """
+        return cls.from_yaml_files(
+            [os.path.join(directory, i) for i in os.listdir(directory) if ".yaml" in i]
+        )
+
+    # Function to find the intent of a prompt, if it is obvious
+    def classify(self, prompt: str) -> Optional[str]:
+        """
+        Parameters required: prompt
+        Return data: intent name if a deciding word or phrase of the prompt points to it, and no known one points to
+            another intent, else None
+        """
+        words = tokenize(prompt)
+        # Intents of every known phrase, and of the phrases that can decide
+        known = set()
+        deciding = set()
+        position = 0
+        while position < len(words):
+            # Walking the trie for the longest phrase starting at this word
+            node = self.trie
+            match = None
+            length = 0
+            for offset in range(position, len(words)):
+                node = node.get(words[offset])
+                if node is None:
+                    break
+                if None in node:
+                    match = node[None]
+                    length = offset - position + 1
+            if match is None:
+                position += 1
+                continue
+            # Phrases shared by several intents do not help to decide
+            if len(match) == 1:
+                intent, support = next(iter(match.items()))
+                known.add(intent)
+                if support >= MIN_SUPPORT:
+                    deciding.add(intent)
+            position += length
+        return deciding.pop() if len(deciding) == 1 and known == deciding else None
@@ -2,7 +2,7 @@
 main.py
 Main program to act as the server backend for the application
 Pre-requisites:
- - Pre-trained model pickle file
+ - Pre-trained models, kept in the versioned model registry (see registry.py)
 
 Flow of the main program:
  -> Listen to incoming messages from firebase
@@ -15,28 +15,60 @@ Flow of the main program:
  -> Select one random song out of the choices, and return the chosen song ID to firebase in given format
 """
 
+import asyncio
+import json
 import os
 import pickle
-import random
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
 
 import numpy as np
 import pandas as pd
 import spotipy
-import spotipy.oauth2 as oauth2
-import yaml
 from snips_nlu import SnipsNLUEngine
 from snips_nlu.dataset import dataset
 from snips_nlu.default_configs import CONFIG_EN
-from snips_nlu.exceptions import PersistingError
 from xgboost import XGBClassifier
 
+import admission
+import cache
+import metrics
+import modelstore
+import ratelimit
+import registry
+import schema
+import spotifyclient
+
+# Global variable to hold the NLU and ML models (a registry.ModelSet), as they can be accessed from anywhere
+# Set by load_models, and replaced as a whole by reload_models, so every request uses the models of one version
+Models = None
+# Lock held while models are being swapped
+_swap_lock = threading.Lock()
+# Error raised by the last call to load_models, if it failed
+load_error = None
+
+# Bounded pool for the CPU bound work of the API (intent detection and prediction), so the event loop stays free
+# The number of threads can be set with the CADENCE_WORKERS environment variable
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("CADENCE_WORKERS", 4)))
+# Thread the API reads and writes the feature store on, so SQLite never blocks the event loop
+# The store has one connection behind a lock, so more threads would only wait on each other
+store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="featurestore")
+# Number of pages of a playlist fetched at once, can be set with the PAGE_CONCURRENCY environment variable
+PAGE_CONCURRENCY = int(os.environ.get("PAGE_CONCURRENCY", 5))
+# Number of chunks of songs fetched and scored at once, can be set with the SCORE_CONCURRENCY environment variable
+SCORE_CONCURRENCY = int(os.environ.get("SCORE_CONCURRENCY", 4))
+# Seconds between checks for the first scored chunk, once the latency budget of a request has run out without one
+FIRST_CHUNK_POLL = 0.02
+
 
 # Function to create NLP model
 def create_nlp_model() -> SnipsNLUEngine:
     """
-    This function trains a new ML model from the given dataset. It then saves the model in the root directory of the project with the file name: nlpumodel
-    This function will only be called once, at the start of the program, if nlumodel file is not detected in the current directory
+    This function trains a new NLU model from the yaml files in the nlputrain directory
+    It is called by build_models, which saves the model as part of a new version in the model registry
     Parameters required: None
     Return data: Trained SnipsNLUEngine object
     """
@@ -51,82 +83,194 @@ def create_nlp_model() -> SnipsNLUEngine:
     # Training the engine with given dataset
     engine.fit(data)
 
-    # Persisting the engine so it can be used easily later
-    # Persisting engine is saved in nlumodel folder
-    try:
-        engine.persist("nlumodel")
-    except PersistingError:
-        print("Old NLP file still exists. Deleting..")
-        # Removing old model files using shutil
-        shutil.rmtree("nlumodel")
-        engine.persist("nlumodel")
-
-    print("NLP model has been created and saved in directory: nlumodel")
+    print("NLP model has been created")
     # Returning trained engine
     return engine
 
 
 # Function to detect intent of string
-def detect_intent(string: str) -> dict:
+def detect_intent(string: str, models: registry.ModelSet = None) -> dict:
     """
     This function detects the intent and the slots a string contains, if it is provided with a trained model and a string
-    Parameters required: SnipsNLUEngine object, string
-    Return data: Dictionary with keys ['intent','slotflag','slots']
+    Parameters required: string, and the models to use (defaults to the models in use)
+    Return data: Dictionary with keys ['intent','slotflag','slots','path']
 
     If slots are not detected, slotflag will be returned as False and vice versa
     """
-    global NLUModel
-    # Parsing the given string using the pretrained model
-    output = NLUModel.parse(string)
-    # Obtaining intent from parsed string
-    intent = output["intent"]["intentName"]
-    # Checking for slots
-    slotflag = True if output["slots"] != [] else False
-    # Obtaining slots from parsed string
-    slots = output["slots"]
+    return detect_intents([string], models)[0]
+
+
+# Function to detect intents of many strings at once
+def detect_intents(strings: list, models: registry.ModelSet = None) -> list:
+    """
+    This function detects the intent and slots of every given string, parsing each distinct prompt only once
+    Prompts that were parsed before by the same model are taken from the intent cache
+    Prompts whose intent is obvious from their words are answered by the lexicon (see lexicon.py), the rest by Snips
+    Parameters required: list of strings, and the models to use (defaults to the models in use)
+    Return data: List of dictionaries with keys ['intent','slotflag','slots','path'], in the same order as the strings
+        path is "lexicon" or "snips", depending on which one answered
+    """
+    models = models or Models
+    # Prompts cached for an earlier model or lexicon are keyed by their fingerprint, and are never found here
+    fingerprint = models.intent_fingerprint
+    intents = cache.get_intent_cache()
+    keys = [cache.normalize_prompt(i) for i in strings]
+    found = intents.get(fingerprint, list(dict.fromkeys(keys)))
+    # First string of every prompt that is not cached
+    missing = {}
+    for key, string in zip(keys, strings):
+        if key not in found:
+            missing.setdefault(key, string)
+    if missing:
+        parsed = []
+        # Obvious prompts are answered by the keyword lexicon of the models, without slots
+        keywords = models.lexicon
+        start = time.perf_counter()
+        fast = [keywords.classify(i) for i in missing.values()]
+        intents.record_parse("lexicon", len(fast), time.perf_counter() - start)
+        metrics.observe("lexicon", time.perf_counter() - start)
+        start = time.perf_counter()
+        for string, intent in zip(missing.values(), fast):
+            if intent is not None:
+                parsed.append(
+                    {
+                        "intent": intent,
+                        "slotflag": False,
+                        "slots": [],
+                        "path": "lexicon",
+                    }
+                )
+                continue
+            # Parsing the given string using the pretrained model
+            output = models.nlu.parse(string)
+            # Obtaining intent, slots, and checking for slots from parsed string
+            parsed.append(
+                {
+                    "intent": output["intent"]["intentName"],
+                    "slotflag": True if output["slots"] != [] else False,
+                    "slots": output["slots"],
+                    "path": "snips",
+                }
+            )
+        intents.record_parse("snips", fast.count(None), time.perf_counter() - start)
+        if None in fast:
+            metrics.observe("snips", time.perf_counter() - start)
+        intents.put(fingerprint, list(missing), parsed)
+        found.update(zip(missing, parsed))
     # Returning obtained information
-    return {"intent": intent, "slotflag": slotflag, "slots": slots}
+    return [found[i] for i in keys]
 
 
 # Function to get new Spotify Object
 def newSpotifyObject() -> spotipy.client.Spotify:
     """
-    This function creates a new spotify object using the creds.yaml file in the root folder to authenticate the object
+    This function returns the shared spotify object, authenticated using the creds.yaml file in the root folder
+    The object is cached for the whole process, and its token is only refreshed when it is about to expire (see spotifyclient.py)
     Parameters required: None
     Return data: Authenticated Spotify Object (spotipy.client.Spotify)
     """
-    # Initializing Spotify Credentials
-    with open("creds.yaml") as file:
-        creds = yaml.load(file)
-
-    cli_id = creds["spotify client id"]
-    cli_sec = creds["spotify client secret"]
-
-    # Creating spotify auth object to authenticate spotify object
-    auth = oauth2.SpotifyClientCredentials(client_id=cli_id, client_secret=cli_sec)
-    # Get access token from spotify
-    token = auth.get_access_token(as_dict=False)
-    # Create spotify object
-    spotify = spotipy.Spotify(auth=token)
-    # Returning Spotify Object
-    return spotify
+    return spotifyclient.get_client()
 
 
 # Function to get playlist tracks
 def get_playlist_tracks(spotify: spotipy.client.Spotify, playlist_id: str) -> list:
     """
     This function takes an authenticated Spotify client, and a playlist ID, and returns a list of song details of every song in the playlist
-    Parameters required: Authenticated Spotify Client, and playlist ID or URL
+    The songs of the playlist are saved under its snapshot_id (see cache.py). They are only downloaded again
+    if the playlist changed since, or if the saved Popularity of its songs is stale
+    Parameters required: Authenticated Spotify Client (None to use the shared client), and playlist ID or URL
     Return Data: List of song details in the playlist
     """
+    with metrics.stage("playlist"):
+        if spotify is None:
+            spotify = newSpotifyObject()
+        # Asking only for the snapshot_id is a single small call
+        snapshot_id = spotify.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+        saved = saved_playlist(playlist_id, snapshot_id)
+        if saved is not None:
+            saved, found = saved
+            return {
+                "IDs": ["spotify:track:" + i for i in saved],
+                "Name": [found[i]["Name"] for i in saved],
+                "Artist": [found[i]["Artist"] for i in saved],
+                "Popularity": [found[i]["Popularity"] for i in saved],
+            }
+        # Get first 100 or lesser songs' details
+        results = spotify.playlist_items(playlist_id)
+        # Check if there are more songs for which details need to be obtained
+        tracks = results["items"]
+        while results["next"]:
+            # Get next 100 songs' details, and append to the list of results already obtained
+            results = spotify.next(results)
+            tracks.extend(results["items"])
+        details = playlist_details(tracks)
+        remember_playlist_tracks(tracks)
+        cache.get_feature_store().put_playlist(
+            cache.track_key(playlist_id),
+            snapshot_id,
+            [cache.track_key(i) for i in details["IDs"]],
+        )
+        # Return all track IDs
+        return details
+
+
+# Function to get the songs saved for a snapshot of a playlist
+def saved_playlist(playlist_id: str, snapshot_id: str) -> tuple:
+    """
+    The saved songs are only used while the Popularity of every one of them is fresh. Otherwise paging through the
+    playlist again refreshes 100 songs per call, where the tracks endpoint only takes 50
+    Parameters required: playlist ID or URL, and its current snapshot_id
+    Return Data: tuple of (bare track IDs in playlist order, dictionary of track ID -> ['Name','Artist','Popularity']),
+        None if the playlist has to be fetched again
+    """
+    store = cache.get_feature_store()
+    saved = store.get_playlist(cache.track_key(playlist_id), snapshot_id)
+    if saved is None:
+        return None
+    found = store.get_tracks(saved)
+    if not all(i in found for i in saved):
+        return None
+    return saved, found
+
+
+# Function to get playlist tracks without blocking the event loop
+async def fetch_playlist_tracks(
+    client: spotifyclient.AsyncSpotify,
+    playlist_id: str,
+    concurrency: int = PAGE_CONCURRENCY,
+) -> dict:
+    """
+    Async version of get_playlist_tracks, used by the API and create_dataset
+    The first page tells how many songs the playlist has, so every other page is requested at the same time,
+    with at most `concurrency` pages in flight
+    Parameters required: AsyncSpotify client, playlist ID or URL, and number of pages to fetch at once
+    Return Data: Dictionary of song details in the playlist
+    """
     # Get first 100 or lesser songs' details
-    results = spotify.playlist_items(playlist_id)
-    # Check if there are more songs for which details need to be obtained
+    results = await client.playlist_items(playlist_id)
     tracks = results["items"]
-    while results["next"]:
-        # Get next 100 songs' details, and append to the list of results already obtained
-        results = spotify.next(results)
+    limit = results["limit"]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Function to get one page, waiting for a free slot first
+    async def page(offset: int) -> dict:
+        async with semaphore:
+            return await client.playlist_items(playlist_id, limit=limit, offset=offset)
+
+    # Pages are returned in the order they were requested, so the playlist order is kept
+    offsets = range(results["offset"] + limit, results["total"], limit)
+    for results in await asyncio.gather(*[page(i) for i in offsets]):
         tracks.extend(results["items"])
+    return playlist_details(tracks)
+
+
+# Function to extract song details from playlist items
+def playlist_details(tracks: list) -> dict:
+    """
+    This function takes the items of a playlist and extracts the ID, name, main artist and popularity of every song
+    Parameters required: List of playlist items
+    Return Data: Dictionary with keys ['IDs','Name','Artist','Popularity'], each holding a list in playlist order
+    """
     # Create new list to hold track IDs
     track_id = {}
     # Extract each track detail from the extracted information, and append to track_id list
@@ -146,10 +290,22 @@ def get_playlist_tracks(spotify: spotipy.client.Spotify, playlist_id: str) -> li
             track_id["Popularity"].append(
                 i["track"]["popularity"]
             )  # Get popularity of songs
-    # Return all track IDs
     return track_id
 
 
+# Function to save the song details found in playlist items
+def remember_playlist_tracks(tracks: list) -> None:
+    """
+    Playlist items hold the same track objects as the tracks endpoint, so their Name, Artist and Popularity
+    are saved to the feature store and are not fetched again when the songs are scored
+    Parameters required: List of playlist items
+    Return Data: None
+    """
+    cache.get_feature_store().put_tracks(
+        [i["track"] for i in tracks if i["track"]["id"] != None]
+    )
+
+
 # Function to get all features of a given list of song ids
 def get_audio_features(spotify: spotipy.client.Spotify, track_ids: list) -> list:
     """
@@ -157,215 +313,408 @@ def get_audio_features(spotify: spotipy.client.Spotify, track_ids: list) -> list
     ["acousticness", "danceability", "durationms", "energy", "instrumentalness", "key", "liveness", "loudness", "mode", "speechiness"\
         , "tempo", "timesignature", "valence"]
     Getting more than 100 songs will result in a bad request error
-    Parameters Required: Authenticated Spotify Client, and list of song IDs
+    Parameters Required: Authenticated Spotify Client (None to use the shared client), and list of song IDs
+    Return Data: List of dictionary containing song features
+    """
+    with metrics.stage("features"):
+        if spotify is None:
+            spotify = newSpotifyObject()
+        # Looking up the local feature store first, so only unseen songs are sent to spotify
+        store = cache.get_feature_store()
+        keys = [cache.track_key(i) for i in track_ids]
+        found = store.get_features(keys)
+        missing = [i for i in dict.fromkeys(keys) if i not in found]
+        for count in range(0, len(missing), 100):
+            # Get 100 songs' features at a time. Getting any more will result in bad result error
+            chunk = missing[count : count + 100]
+            fetched = spotify.audio_features(chunk)
+            store.put_features(fetched)
+            # Songs without features are returned as None, same as spotify does
+            found.update(zip(chunk, fetched))
+    # Returning features in the same order as the given IDs
+    return [found[i] for i in keys]
+
+
+# Function to get the details kept of a track object
+def track_details(track: dict) -> dict:
+    """
+    Parameters Required: track object, as returned by spotify.tracks (None for a song that does not exist)
+    Return Data: Dictionary with keys ['Name','Artist','Popularity'], None for a song that does not exist
+    """
+    if not track:
+        return None
+    return {
+        "Name": track["name"],
+        "Artist": track["artists"][0]["name"],
+        "Popularity": track["popularity"],
+    }
+
+
+# Function to get name, main artist and popularity of a given list of song ids
+def get_track_details(spotify: spotipy.client.Spotify, track_ids: list) -> list:
+    """
+    This function gets the name, main artist and popularity of spotify songs, fifty songs at a time
+    Getting more than 50 songs will result in a bad request error
+    Parameters Required: Authenticated Spotify Client (None to use the shared client), and list of song IDs
+    Return Data: List of dictionaries with keys ['Name','Artist','Popularity'] (None for songs that do not exist)
+    """
+    with metrics.stage("track_details"):
+        if spotify is None:
+            spotify = newSpotifyObject()
+        # Popularity is only taken from the store while it is fresh, stale songs are fetched again
+        store = cache.get_feature_store()
+        keys = [cache.track_key(i) for i in track_ids]
+        found = store.get_tracks(keys)
+        missing = [i for i in dict.fromkeys(keys) if i not in found]
+        for count in range(0, len(missing), 50):
+            chunk = missing[count : count + 50]
+            fetched = spotify.tracks(chunk)["tracks"]
+            store.put_tracks(fetched)
+            found.update(zip(chunk, map(track_details, fetched)))
+    return [found[i] for i in keys]
+
+
+# Function to get audio features without blocking the event loop
+async def fetch_audio_features(
+    client: spotifyclient.AsyncSpotify, track_ids: list
+) -> list:
+    """
+    Async version of get_audio_features, used by the API. Chunks of 100 missing songs are fetched concurrently
+    The feature store is used from store_executor
+    Parameters Required: AsyncSpotify client, and list of song IDs
     Return Data: List of dictionary containing song features
     """
-    # Getting features
-    featurelst = []
-    count = 0
-    while count <= len(track_ids):
-        # Get 100 songs' features at a time. Getting any more will result in bad result error
-        featurelst.extend(spotify.audio_features(track_ids[count : count + 100]))
-        count = count + 100
-    return featurelst
+    with metrics.stage("features"):
+        store = cache.get_feature_store()
+        keys = [cache.track_key(i) for i in track_ids]
+        found = await metrics.run_in_executor(store_executor, store.get_features, keys)
+        missing = [i for i in dict.fromkeys(keys) if i not in found]
+        chunks = [missing[count : count + 100] for count in range(0, len(missing), 100)]
+        fetched = await asyncio.gather(*[client.audio_features(i) for i in chunks])
+        if fetched:
+            await metrics.run_in_executor(
+                store_executor,
+                store.put_features,
+                [i for features in fetched for i in features],
+            )
+        for chunk, features in zip(chunks, fetched):
+            found.update(zip(chunk, features))
+    return [found[i] for i in keys]
+
+
+# Function to get track details without blocking the event loop
+async def fetch_track_details(
+    client: spotifyclient.AsyncSpotify, track_ids: list
+) -> list:
+    """
+    Async version of get_track_details, used by the API. Chunks of 50 missing songs are fetched concurrently
+    The feature store is used from store_executor
+    Parameters Required: AsyncSpotify client, and list of song IDs
+    Return Data: List of dictionaries with keys ['Name','Artist','Popularity'] (None for songs that do not exist)
+    """
+    with metrics.stage("track_details"):
+        store = cache.get_feature_store()
+        keys = [cache.track_key(i) for i in track_ids]
+        found = await metrics.run_in_executor(store_executor, store.get_tracks, keys)
+        missing = [i for i in dict.fromkeys(keys) if i not in found]
+        chunks = [missing[count : count + 50] for count in range(0, len(missing), 50)]
+        fetched = await asyncio.gather(*[client.tracks(i) for i in chunks])
+        if fetched:
+            await metrics.run_in_executor(
+                store_executor,
+                store.put_tracks,
+                [i for tracks in fetched for i in tracks["tracks"]],
+            )
+        for chunk, tracks in zip(chunks, fetched):
+            found.update(zip(chunk, map(track_details, tracks["tracks"])))
+    return [found[i] for i in keys]
+
+
+# Record of all urls that contribute to a tag
+TAG_PLAYLISTS = {
+    # "Travel": [
+    #     "https://open.spotify.com/playlist/0yXe2Ok6uWm15lzStDZIyN?si=4q7fe4A3QHGX-gXVCLHuwg",
+    #     "https://open.spotify.com/playlist/4du84WTLemvL4Pp2DAvlby?si=xuE2b2bXQRijycPi9kLlzw",
+    # ],
+    "Study": [
+        "https://open.spotify.com/playlist/0vvXsWCC9xrXsKd4FyS8kM?si=aEAuimj4R8-7encKbkv8lg"
+    ],
+    "Gym": [
+        "https://open.spotify.com/playlist/0L33OqcgnqcdtUDhUAyfPW?si=vSKSLbnZQpig_rnjXmdLAg",
+        "https://open.spotify.com/playlist/0sPiindbOuUlsUevklWtEO?si=D9699hIAR8CejSVGeKO1Cg",
+    ],
+    "Yoga": [
+        "https://open.spotify.com/playlist/37i9dQZF1DX9uKNf5jGX6m?si=W65q_28zT0mkIwuodAQxMQ",
+        "https://open.spotify.com/playlist/59Mv9oVmx1wIQAaOoLWceY?si=Euwj3oZjQs2bugNCH67I1A",
+    ],
+    # "Meetings": [
+    #     "https://open.spotify.com/playlist/4LJ5hkgqt04IKw454SUJqV?si=_BdJz3YlS6-biDd4Kv8Fpw"
+    # ],
+    "Sleep": [
+        "https://open.spotify.com/playlist/21wbvqMl5HNxhfi2cNqsdZ?si=oalBs9Q1TyqoV1InDYeaYA",
+        "https://open.spotify.com/playlist/37i9dQZF1DWYcDQ1hSjOpY?si=cddd6iLKQVei4H4Ko-VAcg",
+    ],
+}
+
+# Directory holding one columnar chunk per playlist of the dataset, and the manifest describing them
+DATASET_CHUNKS = "datasetchunks"
+
+
+# Function to build the chunk of one playlist of the dataset
+async def build_playlist_chunk(
+    client: spotifyclient.AsyncSpotify, url: str, previous: dict = None
+) -> dict:
+    """
+    This function fetches the songs of a playlist with their features, and saves them as a parquet file
+    If the playlist has not changed since the previous build (same snapshot_id), the previous file is reused as is.
+    If it has changed, only songs that were not in the previous file are fetched
+    Features are joined to songs by their ID, so songs without features are dropped without shifting any other song
+    Parameters Required: AsyncSpotify client, playlist url, and the manifest entry of this playlist from the previous build
+    Return Data: Manifest entry of this playlist, with keys ['snapshot_id','chunk','tracks']
+    """
+    snapshot_id = (await client.playlist(url, fields="snapshot_id"))["snapshot_id"]
+    if (
+        previous is not None
+        and previous["snapshot_id"] == snapshot_id
+        and os.path.isfile(previous["chunk"])
+    ):
+        return previous
+    old = pd.DataFrame()
+    if previous is not None and os.path.isfile(previous["chunk"]):
+        old = pd.read_parquet(previous["chunk"])
+    # Getting all songs' details in a playlist
+    songs = await fetch_playlist_tracks(client, url)
+    details = {
+        cache.track_key(songs["IDs"][i]): {
+            "Name": songs["Name"][i],
+            "Artist": songs["Artist"][i],
+            "Popularity": songs["Popularity"][i],
+        }
+        for i in range(len(songs["IDs"]))
+    }
+    # Keeping songs of the previous build that are still in the playlist, and fetching the rest
+    if len(old):
+        old = old[old["id"].isin(list(details))]
+    known = set(old["id"]) if len(old) else set()
+    new_ids = [i for i in details if i not in known]
+    # Getting song paramenters
+    song_features = await fetch_audio_features(client, new_ids)
+    finalsongs = []
+    for feature in song_features:
+        # Songs without features are returned as None
+        if feature is not None and feature["id"] in details:
+            song = dict(feature)
+            song.update(details[feature["id"]])
+            finalsongs.append(song)
+    chunk = pd.concat([old, pd.DataFrame(finalsongs)], ignore_index=True)
+    # Writing to a temporary file first, so an interrupted build never leaves half a chunk behind
+    path = os.path.join(DATASET_CHUNKS, cache.track_key(url) + ".parquet")
+    chunk.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return {"snapshot_id": snapshot_id, "chunk": path, "tracks": len(chunk)}
 
 
 # Function to create dataset with certain songs
 def create_dataset() -> None:
     """
-    This function creates a csv file based on urls given below for specific tags. The csv will later be used to create the ML model,
-    which will be used to classify songs into the below tags
+    This function creates a training set based on urls in TAG_PLAYLISTS for specific tags. The training set will later be used to create
+    the ML model, which will be used to classify songs into the below tags. The whole dataset is also exported to dataset.csv
     Tags: ['Study', 'Gym','Yoga','Sleep']
+    All playlists are fetched at the same time, each into its own chunk (see build_playlist_chunk)
+    The build is incremental: datasetchunks/manifest.json records the chunks of the previous build, and playlists that have not
+    changed since are not fetched again
     Parameters Required: None
     Return Data: None
     """
-    # Record of all urls that contribute to a tag
-    playlist_dict = {
-        # "Travel": [
-        #     "https://open.spotify.com/playlist/0yXe2Ok6uWm15lzStDZIyN?si=4q7fe4A3QHGX-gXVCLHuwg",
-        #     "https://open.spotify.com/playlist/4du84WTLemvL4Pp2DAvlby?si=xuE2b2bXQRijycPi9kLlzw",
-        # ],
-        "Study": [
-            "https://open.spotify.com/playlist/0vvXsWCC9xrXsKd4FyS8kM?si=aEAuimj4R8-7encKbkv8lg"
-        ],
-        "Gym": [
-            "https://open.spotify.com/playlist/0L33OqcgnqcdtUDhUAyfPW?si=vSKSLbnZQpig_rnjXmdLAg",
-            "https://open.spotify.com/playlist/0sPiindbOuUlsUevklWtEO?si=D9699hIAR8CejSVGeKO1Cg",
-        ],
-        "Yoga": [
-            "https://open.spotify.com/playlist/37i9dQZF1DX9uKNf5jGX6m?si=W65q_28zT0mkIwuodAQxMQ",
-            "https://open.spotify.com/playlist/59Mv9oVmx1wIQAaOoLWceY?si=Euwj3oZjQs2bugNCH67I1A",
-        ],
-        # "Meetings": [
-        #     "https://open.spotify.com/playlist/4LJ5hkgqt04IKw454SUJqV?si=_BdJz3YlS6-biDd4Kv8Fpw"
-        # ],
-        "Sleep": [
-            "https://open.spotify.com/playlist/21wbvqMl5HNxhfi2cNqsdZ?si=oalBs9Q1TyqoV1InDYeaYA",
-            "https://open.spotify.com/playlist/37i9dQZF1DWYcDQ1hSjOpY?si=cddd6iLKQVei4H4Ko-VAcg",
-        ],
-    }
-    dataset = pd.DataFrame()
-
-    # Iterating through each link to download song information
-    for tag, urls in playlist_dict.items():
-        for url in urls:
-            # Getting all songs' details in a playlist
-            songs = get_playlist_tracks(newSpotifyObject(), url)
-            # Getting song paramenters
-            song_features = get_audio_features(newSpotifyObject(), songs["IDs"])
-            finalsongs = []
-
-            # Combining aquired information into one dictionary
-            for i in range(len(song_features)):
-                # Creating a temporary song dictionary to save info
-                song = {}
-                try:
-                    song.update(song_features[i])
-                    song.update(
-                        {
-                            "Name": songs["Name"][i],
-                            "Artist": songs["Artist"][i],
-                            "Popularity": songs["Popularity"][i],
-                        }
-                    )
-                    song.update({"Tag": tag})
-                    finalsongs.append(song)
-                except:
-                    pass
-            # Appending dictionary to final dataset
-            dataset = dataset.append(finalsongs, ignore_index=True)
+    os.makedirs(DATASET_CHUNKS, exist_ok=True)
+    manifest_path = os.path.join(DATASET_CHUNKS, "manifest.json")
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    urls = [(tag, url) for tag, urls in TAG_PLAYLISTS.items() for url in urls]
 
+    # Fetching with a client of its own, as this can run before the event loop of the API exists.
+    # Its calls are background calls, so they give way to API requests at the rate limiter
+    async def build_all() -> list:
+        client = spotifyclient.AsyncSpotify(
+            spotifyclient.get_manager(), priority=ratelimit.BACKGROUND
+        )
+        try:
+            return await asyncio.gather(
+                *[
+                    build_playlist_chunk(client, url, manifest.get(url))
+                    for _, url in urls
+                ]
+            )
+        finally:
+            await client.close()
+
+    entries = asyncio.run(build_all())
+    # Saving the new manifest, and removing chunks of playlists that are not used anymore
+    manifest = {url: entry for (_, url), entry in zip(urls, entries)}
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    used = set(os.path.basename(i["chunk"]) for i in entries)
+    for name in os.listdir(DATASET_CHUNKS):
+        if name.endswith(".parquet") and name not in used:
+            os.remove(os.path.join(DATASET_CHUNKS, name))
+
+    # Combining chunks in the order of TAG_PLAYLISTS, labelling every song with the tag of its playlist
+    dataset = pd.concat(
+        [
+            pd.read_parquet(entry["chunk"]).assign(Tag=tag)
+            for (tag, _), entry in zip(urls, entries)
+        ],
+        ignore_index=True,
+    )
     # Dropping duplicates of the dataset
     dataset = dataset.drop_duplicates(subset=["Name", "Artist"], keep="first")
-    # Saving dataset to csv so it is accessable later
+    # Saving features and tags as the binary training set used by create_ML_model
+    schema.save_training_set(dataset)
+    # Exporting dataset to csv so it is readable later
     dataset.to_csv("dataset.csv")
 
 
-# Function to create ML Model pickle file
-def create_ML_model() -> XGBClassifier:
+# Function to create ML Model
+def create_ML_model(
+    path: str = modelstore.MODEL_FILE, meta_path: str = modelstore.META_FILE
+) -> modelstore.BoosterModel:
     """
-    This function creates an XGBoost Classifier and trains it with 'dataset.csv' in the root directory.
-    It saves the model for future use, and also returns to model to function call
-    Parameters Required: None
-    Return Data: Trained XGBClassifier Object (xgboost.sklearn.XGBClassifier)
+    This function creates an XGBoost Classifier and trains it with the training set saved by create_dataset (see schema.py).
+    It saves the model for future use in XGBoost's native format (see modelstore.py), and also returns to model to function call
+    Parameters Required: Files to save the model to
+    Return Data: Trained model, loaded back as a modelstore.BoosterModel
     """
     # Creating new Model
     model = XGBClassifier()
-    # Opening and preprocessing dataset
-    dataset = pd.read_csv("dataset.csv")
-    columns_to_be_dropped = [
-        "Unnamed: 0",
-        "type",
-        "id",
-        "uri",
-        "track_href",
-        "analysis_url",
-        "Artist",
-        "Name",
-        "Popularity",
-        "duration_ms",
-    ]
-    # Dropping columns
-    for i in columns_to_be_dropped:
-        if i in dataset.columns:
-            dataset = dataset.drop(i, axis=1)
-    # Setting 'Tag' Column as prediction column
-    Y = dataset["Tag"]
-    # Removing 'Tag' Column for X values
-    X = dataset.drop(["Tag"], axis=1)
+    # Loading the memory mapped training set, with features already in model order
+    X, Y, training_schema = schema.load_training_set()
     # Fitting classifier with X and Y
     model.fit(X, Y)
-    # Saving classifier using pickle to root directory
-    with open("MLModel.pickle", "wb") as handle:
-        pickle.dump(model, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # Saving the booster with its classes, feature schema and the training set it was trained on
+    modelstore.save_model(
+        model,
+        schema.FeatureSchema.from_dict(training_schema).to_dict(),
+        schema.training_set_hash(),
+        path,
+        meta_path,
+    )
     # Returning model
-    return model
+    return modelstore.load_model(path, meta_path)
 
 
 # Function to give a dictionary of song properties
-def prep_songs(song_ids: list, spotify: spotipy.client.Spotify) -> pd.DataFrame:
+def prep_songs(
+    song_ids: list,
+    spotify: spotipy.client.Spotify = None,
+    models: registry.ModelSet = None,
+) -> dict:
     """
     Songs passed with IDs cannot directly be used in the model. This function preps the song for the ML model
-    Parameters Required: List of song ids (from client), authenticated spotify client
-    Return Data: Pandas DataFrame of song details, for which classes can now be predicted
-    """
-    prep_set = []
-    curr_number = 0
-    tracks = []
-    # Get all details of every song passed
-    # Can only do 50 at a time, else throws an error of too many ids passed
-    while curr_number <= len(song_ids):
-        # Checking if it is empty
-        if song_ids[curr_number : curr_number + 50]:
-            tracks.extend(
-                spotify.tracks(song_ids[curr_number : curr_number + 50])["tracks"]
-            )
-            curr_number += 50
-        else:
-            break
+    Parameters Required: List of song ids (from client), authenticated spotify client (defaults to the shared client),
+        and the models the songs are prepared for (defaults to the models in use)
+    Return Data: Dictionary of song details, for which classes can now be predicted (see combine_song_details)
+    """
+    if spotify is None:
+        spotify = newSpotifyObject()
+    # Get name, artist and popularity of every song passed
+    tracks = get_track_details(spotify, song_ids)
     # Getting audio features of all songs passed
     features = get_audio_features(spotify, song_ids)
-    # Combining obtained data into single dictionary
+    return combine_song_details(song_ids, tracks, features, models)
+
+
+# Function to give a dictionary of song properties without blocking the event loop
+async def prep_songs_async(
+    song_ids: list,
+    client: spotifyclient.AsyncSpotify = None,
+    models: registry.ModelSet = None,
+) -> dict:
+    """
+    Async version of prep_songs, used by the API. Track details and audio features are fetched at the same time
+    Parameters Required: List of song ids (from client), AsyncSpotify client (defaults to the shared client),
+        and the models the songs are prepared for (defaults to the models in use)
+    Return Data: Dictionary of song details, for which classes can now be predicted (see combine_song_details)
+    """
+    if client is None:
+        client = spotifyclient.get_async_client()
+    tracks, features = await asyncio.gather(
+        fetch_track_details(client, song_ids), fetch_audio_features(client, song_ids)
+    )
+    return combine_song_details(song_ids, tracks, features, models)
+
+
+# Function to combine track details and audio features of songs
+def combine_song_details(
+    song_ids: list, tracks: list, features: list, models: registry.ModelSet = None
+) -> dict:
+    """
+    The audio features are projected straight into the feature matrix of the ML model, in its column order
+    Parameters Required: List of song ids, the track details and audio features of those songs (in the same order),
+        and the models the songs are prepared for (defaults to the models in use)
+    Return Data: Dictionary with keys ['id','Name','Artist','Popularity'] holding lists in song order,
+        and key 'features' holding the float32 feature matrix of the songs
+    """
+    models = models or Models
+    # Checking that every song was found
     for i in range(len(features)):
-        temp_song = features[i]
-        temp_song["Popularity"] = tracks[i]["popularity"]
-        temp_song["Name"] = tracks[i]["name"]
-        temp_song["Artist"] = tracks[i]["artists"][0]["name"]
-        # Adding dictionary to list containing all processed songs
-        prep_set.append(temp_song)
-    # Converting list of dictionaries to a pandas dataframe
-    pred_data = pd.DataFrame(prep_set)
-    # Returning Dataframe
-    return pred_data
+        if features[i] is None or tracks[i] is None:
+            raise TypeError("No details found for song: " + song_ids[i])
+    return {
+        "id": [i["id"] for i in features],
+        "Name": [i["Name"] for i in tracks],
+        "Artist": [i["Artist"] for i in tracks],
+        "Popularity": [i["Popularity"] for i in tracks],
+        "features": schema.model_schema(models.ml).project(features),
+    }
 
 
 # Function to predict tags for given songs
-def predict_tag(pred_data: pd.DataFrame) -> tuple:
+def predict_tag(pred_data: dict, models: registry.ModelSet = None) -> tuple:
     """
     This function predicts a tag given a model and the data for which it needs to predict
-    Parameters Required: Prepared data of client song ids, ML model that is pretrained
+    Songs that have already been scored by the same model are taken from the prediction cache, only the rest are scored
+    Parameters Required: Prepared data of client song ids (from prep_songs), and the models to use (defaults to the models in use)
     Returned data: Tuple of multiple data
         Tuple index 0: Predicted probabilites of each song belonging to one class
         Tuple index 1: List of song ids (in order)
         Tuple index 2: List of song names (in order)
         Tuple index 3: List of classes (in order for predicted probabilities)
     """
-    global MLModel
+    model = (models or Models).ml
     # Saving names and ids for return
     names = pred_data["Name"]
     ids = pred_data["id"]
-    # Preprocessing client input data, dropping unwanted columns
-    columns_to_be_dropped = [
-        "Unnamed: 0",
-        "type",
-        "id",
-        "uri",
-        "track_href",
-        "analysis_url",
-        "Artist",
-        "Name",
-        "Popularity",
-        "duration_ms",
-    ]
-    for i in columns_to_be_dropped:
-        if i in pred_data.columns:
-            pred_data = pred_data.drop(i, axis=1)
-    # Predicting the probability of each song belonging to each class
-    # The highest probability defines its class
-    pred = MLModel.predict_proba(pred_data)
-    # predclass = model.predict(pred_data)
-    return pred, ids, names, MLModel.classes_
+    # Predictions cached for an earlier model are keyed by its fingerprint, and are never found here
+    fingerprint = model.fingerprint
+    predcache = cache.get_prediction_cache()
+    found = predcache.get(fingerprint, ids)
+    # Only songs that have not been scored before are sent to the model, each song once
+    unseen = {}
+    for row, i in enumerate(ids):
+        if i not in found:
+            unseen.setdefault(i, row)
+    if unseen:
+        # Predicting the probability of each song belonging to each class
+        # The highest probability defines its class
+        with metrics.stage("predict"):
+            scored = model.predict_proba(pred_data["features"][list(unseen.values())])
+        predcache.put(fingerprint, list(unseen), scored)
+        found.update(zip(unseen, scored))
+    # Rebuilding the probabilities in the same order as the given songs
+    pred = np.array([found[i] for i in ids]).reshape(-1, len(model.classes_))
+    return pred, ids, names, model.classes_
 
 
-# Function to get top 10 of each tag
-def get_best_match(intent: str, preds: tuple) -> str:
+# Function to get the tag that songs are matched against for an intent
+def intent_tag(intent: str) -> str:
     """
-    This funtion takes in predicted intent, and predicted probabilities, and returns the best match for both of them
-    It picks a single song from a range of top 10 best matches
-    Parameters Required: Intent of given prompt, and predicted tuple from predict_tag function
-    Return Data: Single string of song ID
+    The model only knows the tags Gym, Sleep, Study and Yoga. Other intents are matched against the closest tag
+    Parameters Required: Intent of given prompt
+    Return Data: Tag name, as used in the classes of the model
     """
-    # Get index of required intent to process specific probability
     if intent not in ["gym", "sleep", "study", "yoga"]:
         if intent == "reminder":
             intent = "yoga"
@@ -373,64 +722,513 @@ def get_best_match(intent: str, preds: tuple) -> str:
             intent = "gym"
         else:
             intent = "gym"
-    index = list(preds[3]).index(intent.capitalize())
-    combinedlist = []
-    # Combine name, probability and id lists into one list (for easy sorting)
-    for i in range(len(preds[0])):
-        combinedlist.append([preds[0][i], preds[1][i], preds[2][i]])
-
-    # Sort key function to return specific song
-    def sortlst(element):
-        return element[0][index]
-
-    # Sort combined list
-    combinedlist.sort(key=sortlst, reverse=True)
-    # Choose top 10 songs to randomize from
-    listofchosensongs = [i[1] for i in combinedlist[:10]]
+    return intent.capitalize()
+
+
+# Function to get the positions of the top songs for an intent
+def get_top_matches(intent: str, preds: tuple, k: int = 10) -> np.ndarray:
+    """
+    This function finds the k songs with the highest probability for the tag matching the given intent
+    Uses a partial sort on the probability column, so only the top k songs are ever ordered
+    Parameters Required: Intent of given prompt, predicted tuple from predict_tag function, and number of songs
+    Return Data: Array of song positions in preds, best match first
+    """
+    # Get index of required intent to process specific probability
+    index = list(preds[3]).index(intent_tag(intent))
+    column = np.asarray(preds[0])[:, index]
+    if len(column) > k:
+        top = np.argpartition(-column, k - 1)[:k]
+    else:
+        top = np.arange(len(column))
+    # Ordering only the chosen few
+    return top[np.argsort(-column[top], kind="stable")]
 
-    # Names of chosen songs, uncomment to access
-    # nameofsongs = [i[2] for i in combinedlist[:10]]
 
-    final_choice = random.choice(listofchosensongs)
+# Function to get top 10 of each tag
+def get_best_match(
+    intent: str,
+    preds: tuple,
+    k: int = 10,
+    weighting: str = "uniform",
+    temperature: float = 0.1,
+    seed: int = None,
+) -> str:
+    """
+    This funtion takes in predicted intent, and predicted probabilities, and returns the best match for both of them
+    It picks a single song from a range of top 10 best matches
+    Parameters Required: Intent of given prompt, and predicted tuple from predict_tag function
+    Optional Parameters: number of songs to pick from, how to weight the pick ("uniform", "probability" or "softmax"),
+        softmax temperature, and seed for reproducible picks
+    Return Data: Single string of song ID
+    """
+    start = time.perf_counter()
+    # Choose top 10 songs to randomize from
+    top = get_top_matches(intent, preds, k)
+    probs = np.asarray(preds[0])[top, list(preds[3]).index(intent_tag(intent))]
+    # Weights of the chosen songs, None picks uniformly
+    if weighting == "probability" and probs.sum() > 0:
+        weights = probs / probs.sum()
+    elif weighting == "softmax":
+        weights = np.exp((probs - probs.max()) / temperature)
+        weights = weights / weights.sum()
+    else:
+        weights = None
+    rng = np.random.default_rng(seed)
+    final_choice = preds[1][top[rng.choice(len(top), p=weights)]]
+    metrics.observe("match", time.perf_counter() - start)
     return "spotify:track:" + final_choice
 
 
-# Function to verify all major files are present
-def startup() -> tuple:
+# Function to yield the song IDs of a playlist, one page at a time
+async def stream_playlist_ids(
+    client: spotifyclient.AsyncSpotify,
+    playlist_id: str,
+    concurrency: int = PAGE_CONCURRENCY,
+    snapshot_id: str = None,
+    on_total: Callable[[int], None] = None,
+) -> AsyncIterator[list]:
     """
-    This function returns the NLU model and the ML model after verifying its presence in the root directory
-    It also creates a trainable dataset if it isnt present in the root directory
+    Like fetch_playlist_tracks, but every page is handed over as soon as it arrives instead of after the last one
+    Pages after the first come in the order they finish, not in playlist order. At most `concurrency` pages are
+    fetched ahead of the caller, so memory is bounded by that window and not by the size of the playlist
+    Given the snapshot_id of the playlist, the songs saved for that snapshot are handed over without fetching any page,
+    and the songs of a playlist that had to be fetched are saved for it (see cache.py)
+    As in get_playlist_tracks, the pages are fetched again if the saved Popularity of any song is stale (see saved_playlist)
+    The feature store is used from store_executor
+    Parameters required: AsyncSpotify client, playlist ID or URL, number of pages to fetch ahead of the caller at once,
+        the current snapshot_id of the playlist (None to always fetch every page),
+        and a function called with the number of songs of the playlist once it is known
+    Yield Data: List of song IDs of one page
+    """
+    if snapshot_id is not None:
+        saved = await metrics.run_in_executor(
+            store_executor, saved_playlist, playlist_id, snapshot_id
+        )
+        if saved is not None:
+            saved = saved[0]
+            admission.check_tracks(len(saved))
+            if on_total is not None:
+                on_total(len(saved))
+            for count in range(0, len(saved), 100):
+                yield ["spotify:track:" + i for i in saved[count : count + 100]]
+            return
+    results = await client.playlist_items(playlist_id)
+    # Refusing playlists that are too large before fetching any other page
+    admission.check_tracks(results["total"])
+    if on_total is not None:
+        on_total(results["total"])
+    limit = results["limit"]
+    offsets = iter(range(results["offset"] + limit, results["total"], limit))
+    # Pages being fetched, or fetched but not handed over yet. No more than `concurrency` of them at once, and the next
+    # page is only started once the caller takes one, so the pages of a large playlist never pile up in memory ahead
+    # of the scoring
+    pending = set()
+
+    # Function to start fetching pages until the window is full
+    def fill() -> None:
+        while len(pending) < concurrency:
+            offset = next(offsets, None)
+            if offset is None:
+                return
+            pending.add(
+                asyncio.ensure_future(
+                    client.playlist_items(playlist_id, limit=limit, offset=offset)
+                )
+            )
+
+    # Song IDs of every page, by offset, so the playlist order can be saved
+    pages = {}
+
+    # Function to save the songs of a page, returning their IDs
+    async def keep(results: dict) -> list:
+        # Saved before the page is scored, so scoring finds the details of its songs
+        await metrics.run_in_executor(
+            store_executor, remember_playlist_tracks, results["items"]
+        )
+        pages[results["offset"]] = playlist_details(results["items"])["IDs"]
+        return pages[results["offset"]]
+
+    try:
+        fill()
+        yield await keep(results)
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            task = done.pop()
+            pending.remove(task)
+            song_ids = await keep(task.result())
+            # The page taken frees a place in the window for the next one
+            fill()
+            yield song_ids
+        if snapshot_id is not None:
+            await metrics.run_in_executor(
+                store_executor,
+                cache.get_feature_store().put_playlist,
+                cache.track_key(playlist_id),
+                snapshot_id,
+                [cache.track_key(i) for offset in sorted(pages) for i in pages[offset]],
+            )
+    finally:
+        # Pages are not needed anymore if the caller stopped early
+        for task in pending:
+            task.cancel()
+
+
+# Function to yield a list of song IDs in chunks
+async def stream_song_ids(song_ids: list, size: int = 100) -> AsyncIterator[list]:
+    for count in range(0, len(song_ids), size):
+        yield song_ids[count : count + size]
+
+
+# Function to fetch and score one chunk of songs
+async def score_chunk(
+    song_ids: list,
+    client: spotifyclient.AsyncSpotify = None,
+    models: registry.ModelSet = None,
+) -> tuple:
+    """
+    Parameters required: List of up to 100 song IDs, AsyncSpotify client (defaults to the shared client),
+        and the models to use (defaults to the models in use)
+    Return data: Tuple returned by predict_tag for these songs
+    """
+    models = models or Models
+    # Not starting, nor predicting, once the deadline of the request has passed
+    admission.check()
+    prepared = await prep_songs_async(song_ids, client, models)
+    admission.check()
+    return await metrics.run_in_executor(executor, predict_tag, prepared, models)
+
+
+# Function to score chunks of songs as they come in
+async def score_stream(
+    chunks: AsyncIterator[list],
+    client: spotifyclient.AsyncSpotify = None,
+    concurrency: int = SCORE_CONCURRENCY,
+    models: registry.ModelSet = None,
+) -> AsyncIterator[tuple]:
+    """
+    Every chunk of song IDs is sent through feature fetching and prediction as soon as it arrives,
+    while the next chunks are still being fetched. At most `concurrency` chunks are worked on at once
+    Parameters required: Async iterator of song ID lists, AsyncSpotify client, number of chunks to work on at once,
+        and the models to use (defaults to the models in use)
+    Yield Data: Tuple returned by predict_tag for one chunk, in the order the chunks finish
+    """
+    pending = set()
+    try:
+        async for song_ids in chunks:
+            if not song_ids:
+                continue
+            pending.add(asyncio.ensure_future(score_chunk(song_ids, client, models)))
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class TopK:
+    """
+    Running top k songs of every class, fed one predict_tag tuple at a time
+    Only the songs that are in the top k of at least one class are kept, so memory does not grow with the playlist
+    Parameters required: number of songs to keep per class
+    """
+
+    def __init__(self, k: int = 10):
+        self.k = k
+        # Number of songs seen so far, and number of songs there are to see (None until known)
+        self.count = 0
+        self.total = None
+        self.probs = None
+        self.ids = []
+        self.names = []
+        self.classes = None
+
+    # Function to add the predictions of one chunk
+    def update(self, preds: tuple) -> None:
+        probs = np.asarray(preds[0])
+        self.count += len(probs)
+        self.classes = preds[3]
+        if self.probs is not None:
+            probs = np.vstack([self.probs, probs])
+        ids = self.ids + list(preds[1])
+        names = self.names + list(preds[2])
+        if len(ids) > self.k:
+            # Rows that make the top k of any class
+            keep = np.unique(
+                np.concatenate(
+                    [
+                        np.argpartition(-probs[:, i], self.k - 1)[: self.k]
+                        for i in range(probs.shape[1])
+                    ]
+                )
+            )
+            probs = probs[keep]
+            ids = [ids[i] for i in keep]
+            names = [names[i] for i in keep]
+        self.probs, self.ids, self.names = probs, ids, names
+
+    # Function to set the number of songs there are to see
+    def set_total(self, total: int) -> None:
+        self.total = total
+
+    # Function to get the kept songs in the same form as predict_tag returns them
+    def result(self) -> tuple:
+        return self.probs, self.ids, self.names, self.classes
+
+    # Function to get a copy that does not change when more songs are added
+    def copy(self) -> "TopK":
+        # update replaces the arrays and lists instead of changing them, so they can be shared
+        top = TopK(self.k)
+        top.count, top.total, top.classes = self.count, self.total, self.classes
+        top.probs, top.ids, top.names = self.probs, self.ids, self.names
+        return top
+
+
+# Function to make sure the training set exists
+def prepare_training_set() -> None:
+    """
+    This function creates a trainable dataset if it isnt present in the root directory
     Parameters Required: None
-    Return data: tuple
-        index 1: NLU Model
-        index 2: ML Model
-    """
-    # Initializing NLPU
-    if os.path.isdir("nlumodel"):
-        # If trained model exists, load it
-        nluengine = SnipsNLUEngine.from_path("nlumodel")
-        print("Loaded local nlumodel save found in directory")
+    Return data: None
+    """
+    if schema.training_set_exists():
+        # If dataset exists, proceed
+        print("Dataset Found")
+    elif os.path.isfile("dataset.csv"):
+        # Dataset was saved before the binary training set existed, convert it
+        schema.save_training_set(pd.read_csv("dataset.csv"))
+        print("Dataset converted from dataset.csv")
     else:
-        # If model doesnt exist, then create a new one
-        nluengine = create_nlp_model()
-        print("Trained and loaded new model")
-
-    # Checking for training dataset
-    if not os.path.isfile("dataset.csv"):
         # If dataset doesnt exist, create it
         create_dataset()
         print("Dataset Created and saved")
-    else:
-        # If dataset exists, proceed
-        print("Dataset Found")
 
-    if not os.path.isfile("MLModel.pickle"):
-        mlmodel = create_ML_model()
-    else:
-        # Model exists, load into program
-        with open("MLModel.pickle", "rb") as handle:
-            mlmodel = pickle.load(handle)
-    return nluengine, mlmodel
+
+# Function to build a new version of the models
+def build_models(retrain_nlu: bool = False, retrain_ml: bool = False) -> str:
+    """
+    This function saves a complete set of models as a new version in the model registry (see registry.py) and promotes it
+    Models that are not retrained are taken from the version in use, or else from the nlumodel, MLModel.json or
+    MLModel.pickle files left in the root directory by older versions of the backend. Missing models are trained
+    Only one process builds at a time. A process that waited for another one to build the first version uses that version
+    Parameters Required: whether to train the NLU model again, whether to train the ML model again
+    Return data: name of the new version
+    """
+    with registry.build_lock():
+        current = registry.current_version()
+        if current is not None and not (retrain_nlu or retrain_ml):
+            return current
+        return _build_models(current, retrain_nlu, retrain_ml)
+
+
+# Function to build a new version of the models, called with the build lock held
+def _build_models(current: str, retrain_nlu: bool, retrain_ml: bool) -> str:
+    source = registry.version_path(current) if current is not None else "."
+    staging = registry.stage()
+    try:
+        nlu_path = os.path.join(staging, registry.NLU_DIR)
+        training_path = os.path.join(staging, registry.TRAINING_DIR)
+        if not retrain_nlu and os.path.isdir(os.path.join(source, registry.NLU_DIR)):
+            # If trained model exists, keep it, with the training files it was trained on
+            shutil.copytree(os.path.join(source, registry.NLU_DIR), nlu_path)
+            kept = os.path.join(source, registry.TRAINING_DIR)
+            if not os.path.isdir(kept):
+                # Version saved before the training files were kept with it
+                kept = registry.TRAINING_DIR
+            shutil.copytree(kept, training_path)
+            print("Kept NLU model found in " + source)
+        else:
+            # If model doesnt exist, then create a new one
+            create_nlp_model().persist(nlu_path)
+            # The lexicon of the version is built from the same files as the model
+            shutil.copytree(registry.TRAINING_DIR, training_path)
+            print("Trained new NLU model")
+
+        model_path = os.path.join(staging, modelstore.MODEL_FILE)
+        meta_path = os.path.join(staging, modelstore.META_FILE)
+        if not retrain_ml and modelstore.model_exists(
+            os.path.join(source, modelstore.MODEL_FILE),
+            os.path.join(source, modelstore.META_FILE),
+        ):
+            # Model exists, keep it
+            shutil.copy(os.path.join(source, modelstore.MODEL_FILE), model_path)
+            shutil.copy(os.path.join(source, modelstore.META_FILE), meta_path)
+            print("Kept ML model found in " + source)
+        elif not retrain_ml and current is None and os.path.isfile("MLModel.pickle"):
+            # Model was pickled before the native format was used, convert it once
+            with open("MLModel.pickle", "rb") as handle:
+                mlmodel = pickle.load(handle)
+            # Checking that the column order the model was trained with matches its schema
+            feature_names = mlmodel.get_booster().feature_names
+            feature_schema = schema.model_schema(mlmodel)
+            if feature_names is not None and feature_names != feature_schema.columns:
+                raise ValueError("Features of MLModel.pickle do not match its schema")
+            modelstore.save_model(
+                mlmodel, feature_schema.to_dict(), None, model_path, meta_path
+            )
+            print("Converted MLModel.pickle to " + modelstore.MODEL_FILE)
+        else:
+            if retrain_ml:
+                # Retraining is for new songs and tags, so the dataset is fetched again instead of reusing the saved one
+                create_dataset()
+                print("Dataset fetched again and saved")
+            else:
+                # First build, the saved dataset is used if there is one
+                prepare_training_set()
+            create_ML_model(model_path, meta_path)
+            print("Trained new ML model")
+
+        # Loading and smoke testing the staged models before they become a version
+        version = registry.commit(staging)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    registry.promote(version)
+    registry.prune()
+    print("Saved models as version " + version)
+    return version
+
+
+# Function to make sure a version of the models is ready to be loaded
+def prepare_models() -> str:
+    """
+    This function builds a first version of the models if the registry is empty, without loading them
+    serve.py calls it once before starting the worker processes, so the workers only ever load models
+    Parameters Required: None
+    Return data: name of the version in use
+    """
+    version = registry.current_version()
+    if version is None:
+        version = build_models()
+    return version
+
+
+# Function to verify all major files are present
+def startup() -> registry.ModelSet:
+    """
+    This function returns the models of the version in use, after building a first version if the registry is empty
+    Parameters Required: None
+    Return data: registry.ModelSet holding the NLU model and the ML model
+    """
+    version = prepare_models()
+    models = registry.load_version(version)
+    print("Loaded models of version " + version)
+    return models
+
+
+# Function to start using a set of models
+def activate(models: registry.ModelSet) -> None:
+    """
+    The models are swapped with a single assignment. Requests already running keep the models they started with
+    Parameters Required: registry.ModelSet object
+    Return data: None
+    """
+    global Models
+    # Binding the caches drops the values of the models being replaced
+    cache.get_intent_cache().bind(models.intent_fingerprint)
+    cache.get_prediction_cache().bind(models.ml.fingerprint)
+    Models = models
+
+
+# Function to load the models into the global variable used by the API
+def load_models() -> None:
+    """
+    This function loads the models of the version in use into Models, building them first if they are missing
+    It is not run when main is imported. The API calls it in a background thread, so it can serve health checks meanwhile
+    If loading fails, the error is kept in load_error and raised again
+    Parameters Required: None
+    Return data: None
+    """
+    global load_error
+    try:
+        with _swap_lock:
+            activate(startup())
+        load_error = None
+    except Exception as e:
+        load_error = e
+        raise
+
+
+# Function to check if the models have been loaded
+def models_ready() -> bool:
+    return Models is not None
+
+
+# Function to get the version of the models in use
+def model_version() -> str:
+    return Models.version if Models is not None else None
+
+
+# Function to swap in another version of the models while requests keep being served
+def reload_models(version: str = None) -> str:
+    """
+    The version is loaded and smoke tested before it is promoted and used, so a bad version never serves a request
+    Called without a version, it picks up the version promoted in the registry, for example by another worker
+    Parameters Required: name of the version to use (defaults to the version in use in the registry)
+    Return data: name of the version now in use
+    """
+    with _swap_lock:
+        if version is None:
+            version = registry.current_version()
+        if version is None:
+            raise ValueError("No model version has been promoted yet")
+        if Models is not None and Models.version == version:
+            return version
+        models = registry.load_version(version)
+        registry.promote(version)
+        activate(models)
+    print("Swapped to models of version " + version)
+    return version
+
+
+# Function to go back to the models used before the current ones
+def rollback_models() -> str:
+    """
+    Parameters Required: None
+    Return data: name of the version now in use
+    Raises ValueError if there is no earlier version
+    """
+    with _swap_lock:
+        earlier = registry.history()
+        if not earlier:
+            raise ValueError("No earlier model version to roll back to")
+        models = registry.load_version(earlier[0])
+        registry.rollback()
+        activate(models)
+    print("Rolled back to models of version " + models.version)
+    return models.version
+
+
+# Function to train new models and swap them in
+def retrain_models(retrain_nlu: bool = True, retrain_ml: bool = True) -> str:
+    """
+    Training runs while the old models keep serving, they are only replaced once the new version passed its smoke test
+    Retraining the ML model fetches its dataset from spotify again, the saved training set is only used on first startup
+    Parameters Required: whether to train the NLU model again, whether to train the ML model again
+    Return data: name of the new version
+    """
+    return reload_models(build_models(retrain_nlu, retrain_ml))
+
+
+# Function to pick up a version promoted outside of this process
+def check_for_new_models() -> bool:
+    """
+    Parameters Required: None
+    Return data: True if another version was swapped in
+    """
+    if Models is None or registry.current_version() in (None, Models.version):
+        return False
+    reload_models()
+    return True
 
 
 # Function that is called only when the file is directly run
@@ -438,16 +1236,16 @@ def main():
     """
     This function is used for testing purposes, and is run only when the main file is run
     """
-    global NLUModel, MLModel
-    NLUModel, MLModel = startup()
+    load_models()
 
     # Testing all functions
     phrase = input("Enter a prompt: ")
     playlist_link = input("Enter a playlist url: ")
     intent = detect_intent(phrase)["intent"]
+    spotify = newSpotifyObject()
     prepared = prep_songs(
-        get_playlist_tracks(newSpotifyObject(), playlist_link)["IDs"],
-        newSpotifyObject(),
+        get_playlist_tracks(spotify, playlist_link)["IDs"],
+        spotify,
     )
     ret = predict_tag(prepared)
     print(get_best_match(intent, ret))
@@ -459,19 +1257,27 @@ def apicall_playlist(prompt: str, songlist: str) -> dict:
     This function is called when a request with a playlist link is received
     It runs calls all nesessary functions to finally return the best song choice for the given prompt
     Parameters required: (sent from received request) given prompt and playlist link
-    Return Data: Dictionary containing best match and detected intent
+    Return Data: Dictionary containing best match, detected intent and the version of the models used
     """
+    # Using the same models for the whole request
+    models = Models
     # Obtain intent
-    intent = detect_intent(prompt)["intent"]
+    intent = detect_intent(prompt, models)["intent"]
     # Obtain dataframe of prepared data
+    spotify = newSpotifyObject()
     prepared = prep_songs(
-        get_playlist_tracks(newSpotifyObject(), songlist)["IDs"],
-        newSpotifyObject(),
+        get_playlist_tracks(spotify, songlist)["IDs"],
+        spotify,
+        models,
     )
     # Get predicted tags
-    ret = predict_tag(prepared)
+    ret = predict_tag(prepared, models)
     # Get best match from predicted data and return
-    return {"song": get_best_match(intent, ret), "intent": intent}
+    return {
+        "song": get_best_match(intent, ret),
+        "intent": intent,
+        "model_version": models.version,
+    }
 
 
 # Function called by an api to compute best match from list of song IDs
@@ -480,28 +1286,219 @@ def apicall_songlist(prompt: str, songlist: str) -> dict:
     This function is called when a request with a list of songs is received
     It runs calls all nesessary functions to finally return the best song choice for the given prompt
     Parameters required: (sent from received request) given prompt and a list of songs
-    Return Data: Dictionary containing best match and detected intent
+    Return Data: Dictionary containing best match, detected intent and the version of the models used
     """
+    # Using the same models for the whole request
+    models = Models
     # Obtain intent
-    intent = detect_intent(prompt)["intent"]
+    intent = detect_intent(prompt, models)["intent"]
     # Create list of songs from a string
     songs = songlist.split(";")[:-1]
     # Obtain dataframe of prepared data
-    prepared = prep_songs(
-        songs,
-        newSpotifyObject(),
-    )
+    prepared = prep_songs(songs, newSpotifyObject(), models)
     # Get predicted tags
-    ret = predict_tag(prepared)
+    ret = predict_tag(prepared, models)
     # Get best match from predicted data and return
-    return {"song": get_best_match(intent, ret), "intent": intent}
+    return {
+        "song": get_best_match(intent, ret),
+        "intent": intent,
+        "model_version": models.version,
+    }
+
+
+# Function to score chunks of songs, keeping only the best songs so far
+async def collect_top(
+    chunks: AsyncIterator[list],
+    client: spotifyclient.AsyncSpotify,
+    models: registry.ModelSet,
+    top: TopK = None,
+) -> TopK:
+    """
+    Parameters required: Async iterator of song ID lists, AsyncSpotify client, the models to use,
+        and the TopK to fill in (a new one if not given), which can be looked at while the songs are scored
+    Return Data: TopK object holding the best songs of every tag
+    """
+    top = top or TopK()
+    async for ret in score_stream(chunks, client, models=models):
+        top.update(ret)
+    return top
+
+
+# Function to wait for scoring to finish, settling for the songs scored so far once the latency budget runs out
+async def best_so_far(work: asyncio.Future, top: TopK, budget: float) -> TopK:
+    """
+    The budget ends early at the deadline of the request (see admission.py). If no song has been scored by then,
+    the first scored chunk is waited for, as there is nothing to answer with before it
+    Parameters required: future of the TopK of every song, the TopK it is filling in, and seconds to wait
+    Return Data: TopK of every song if scoring finished in time, else a copy of the TopK of the songs scored so far
+    """
+    left = admission.remaining()
+    wait = budget if left is None else min(budget, left)
+    try:
+        await asyncio.wait([work], timeout=max(wait, 0))
+        while not work.done() and top.count == 0:
+            admission.check()
+            await asyncio.wait([work], timeout=FIRST_CHUNK_POLL)
+        if not work.done():
+            return top.copy()
+        try:
+            return work.result()
+        except admission.DeadlineExceeded:
+            # Scoring ran out of time, but the songs scored before that still make an answer
+            if top.count == 0:
+                raise
+            return top.copy()
+    finally:
+        # Stopping the work of this request. A playlist job shared with other requests keeps running for them,
+        # and is cancelled by cache.SingleFlight once the last of them stopped waiting
+        if not work.done():
+            work.cancel()
+
+
+# Function to fetch and score all songs of a playlist or song list, without blocking the event loop
+async def score_songs_async(
+    playlist: str = None,
+    songlist: str = None,
+    models: registry.ModelSet = None,
+    budget: float = None,
+) -> TopK:
+    """
+    Every page or chunk of songs is scored as soon as it arrives, keeping only the best songs so far
+    Concurrent requests for the same snapshot of a playlist share one job, and its result is reused for a short time
+    (see cache.SingleFlight). The returned TopK can therefore be shared, and must not be changed
+    Given a latency budget, the songs scored so far are returned once it runs out (see best_so_far).
+    TopK.count then tells how many of the TopK.total songs were considered
+    Raises admission.TooManyTracks for more than admission.MAX_TRACKS songs, and admission.DeadlineExceeded once the
+    deadline of the request has passed
+    Parameters required: playlist link, or a list of song IDs seperated with a semicolon,
+        the models to use (defaults to the models in use), and seconds to wait for every song (None for no limit)
+    Return Data: TopK object holding the best songs of every tag
+    """
+    # The budget counts from here, so it includes the snapshot_id call
+    started = time.monotonic()
+    models = models or Models
+    client = spotifyclient.get_async_client()
+    top = TopK()
+    if playlist is None:
+        # Create list of songs from a string
+        song_ids = songlist.split(";")[:-1]
+        admission.check_tracks(len(song_ids))
+        top.set_total(len(song_ids))
+        work = asyncio.ensure_future(
+            collect_top(stream_song_ids(song_ids), client, models, top)
+        )
+    else:
+        # The snapshot_id changes whenever the playlist does
+        snapshot_id = (await client.playlist(playlist, fields="snapshot_id"))[
+            "snapshot_id"
+        ]
+        key = (cache.track_key(playlist), snapshot_id, models.version)
+        work, progress = cache.get_playlist_results().start(
+            key,
+            lambda: collect_top(
+                stream_playlist_ids(
+                    client, playlist, snapshot_id=snapshot_id, on_total=top.set_total
+                ),
+                client,
+                models,
+                top,
+            ),
+            top,
+        )
+        # A request that joined a running job looks at the songs scored by that job
+        top = progress or top
+    if budget is not None:
+        return await best_so_far(work, top, budget - (time.monotonic() - started))
+    # A shared playlist job carries no deadline of its own (see cache.SingleFlight), every request stops waiting at its own
+    return await admission.within(work)
+
+
+# Function called by api to compute best match from playlist, without blocking the event loop
+async def apicall_playlist_async(
+    prompt: str, songlist: str, budget: float = None
+) -> dict:
+    """
+    Async version of apicall_playlist, used by the API
+    Spotify calls are awaited, while intent detection and prediction run in the bounded executor
+    Parameters required: (sent from received request) given prompt and playlist link,
+        and seconds after which the best match among the songs scored so far is taken (None to score every song)
+    Return Data: Dictionary containing best match, detected intent, the path that detected it (lexicon or snips),
+        the number of songs considered out of the total, and the version of the models used
+    """
+    # Using the same models for the whole request, even if they are swapped meanwhile
+    models = Models
+    # Detecting intent while the songs are being fetched
+    intent = metrics.run_in_executor(executor, detect_intent, prompt, models)
+    top = await score_songs_async(playlist=songlist, models=models, budget=budget)
+    intent = await admission.within(intent)
+    return {
+        "song": get_best_match(intent["intent"], top.result()),
+        "intent": intent["intent"],
+        "path": intent["path"],
+        "considered": top.count,
+        "total": top.total,
+        "model_version": models.version,
+    }
+
+
+# Function called by an api to compute best match from list of song IDs, without blocking the event loop
+async def apicall_songlist_async(
+    prompt: str, songlist: str, budget: float = None
+) -> dict:
+    """
+    Async version of apicall_songlist, used by the API
+    Parameters required: (sent from received request) given prompt and a list of songs,
+        and seconds after which the best match among the songs scored so far is taken (None to score every song)
+    Return Data: Dictionary containing best match, detected intent, the path that detected it (lexicon or snips),
+        the number of songs considered out of the total, and the version of the models used
+    """
+    models = Models
+    intent = metrics.run_in_executor(executor, detect_intent, prompt, models)
+    top = await score_songs_async(songlist=songlist, models=models, budget=budget)
+    intent = await admission.within(intent)
+    return {
+        "song": get_best_match(intent["intent"], top.result()),
+        "intent": intent["intent"],
+        "path": intent["path"],
+        "considered": top.count,
+        "total": top.total,
+        "model_version": models.version,
+    }
+
+
+# Function called by api to compute best matches for many prompts against one set of songs
+async def apicall_batch_async(
+    prompts: list, playlist: str = None, songlist: str = None, budget: float = None
+) -> dict:
+    """
+    This function is called when a request with several prompts is received
+    The songs are fetched and scored only once, and every prompt is matched against the same predictions
+    Parameters required: (sent from received request) list of prompts, a playlist link or a list of songs,
+        and seconds after which the best matches among the songs scored so far are taken (None to score every song)
+    Return Data: Dictionary with a list of results, each containing best match, detected intent and the path that
+        detected it, in prompt order, the number of songs considered out of the total, and the version of the models used
+    """
+    models = Models
+    intents = metrics.run_in_executor(executor, detect_intents, prompts, models)
+    top = await score_songs_async(playlist, songlist, models, budget)
+    results = []
+    for intent in await admission.within(intents):
+        results.append(
+            {
+                "song": get_best_match(intent["intent"], top.result()),
+                "intent": intent["intent"],
+                "path": intent["path"],
+            }
+        )
+    return {
+        "results": results,
+        "considered": top.count,
+        "total": top.total,
+        "model_version": models.version,
+    }
 
 
 # Start main function
 if __name__ == "__main__":
     # This is only for running tests
     main()
-else:
-    # Creating Global variables to hold NLU and ML models, as they can be accessed from anywhere
-    global NLUModel, MLModel
-    NLUModel, MLModel = startup()
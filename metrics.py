@@ -0,0 +1,269 @@
+"""
+metrics.py
+Latency histograms and counters of the server backend, exposed in the Prometheus text format
+
+Stages:
+ -> Every stage of the pipeline (token refresh, spotify calls, audio features, track details, intent detection,
+    prediction, matching) is timed with `with metrics.stage("name"):`, or reported with metrics.observe
+ -> The time is added to the histogram of the stage, and to the timings of the request being served, if there is one
+ -> The timings of a request are the time spent in every stage, summed over calls made at the same time.
+    api.py sends them back in the Server-Timing header of the response
+Counters:
+ -> Spotify calls by endpoint and status, retries, 429 responses, hedges and circuit breaker trips,
+    and requests served by path and status
+ -> Cache counters, the state of the spotify rate limiter and the state of admission control are not kept here,
+    they are read from cache.py, ratelimit.py and admission.py when the metrics are rendered
+
+Recording a value takes a lock and a few dictionary lookups, so the metrics are always on
+Metrics are kept per worker process, and every process answers '/metrics' with its own
+"""
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Help text of every metric, rendered in the HELP line
+DESCRIPTIONS = {
+    "cadence_stage_seconds": "Time spent in every stage of the pipeline",
+    "cadence_request_seconds": "Time taken to answer a request",
+    "cadence_requests_total": "Requests answered, by path and status",
+    "cadence_spotify_requests_total": "Calls made to the spotify web API, by endpoint and status",
+    "cadence_spotify_retries_total": "Spotify calls retried after a 429 response",
+    "cadence_spotify_throttled_total": "Spotify calls answered with 429",
+    "cadence_spotify_error_retries_total": "Spotify calls retried after a transient error",
+    "cadence_spotify_hedges_total": "Hedged spotify calls that answered, by endpoint and winner (hedge or primary)",
+    "cadence_spotify_circuit_trips_total": "Times the circuit breaker of the spotify calls opened",
+    "cadence_spotify_queue_depth": "Spotify calls of this worker waiting for the rate limiter, by priority",
+    "cadence_spotify_tokens": "Tokens left in the shared spotify rate limiter",
+    "cadence_spotify_blocked_seconds": "Seconds every spotify call is still held for after a 429 response",
+    "cadence_rejected_total": "Scoring requests turned away, by reason",
+    "cadence_requests_in_flight": "Scoring requests being served by this worker",
+    "cadence_requests_queued": "Scoring requests of this worker waiting for a slot",
+}
+
+
+class Histogram:
+    """
+    Count of observed values in every bucket, and their sum
+    Parameters required: upper bounds of the buckets, in increasing order
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    # Function to add one value
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+_lock = threading.Lock()
+# (metric name, labels) -> Histogram, labels being a tuple of (label, value) pairs
+_histograms = {}
+# (metric name, labels) -> value
+_counters = {}
+# Timings of the request being served, stage -> seconds
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+# Function to add a value to a histogram
+def observe_histogram(name: str, value: float, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+# Function to add to a counter
+def count(name: str, value: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# Function to record the time spent in a stage
+def observe(stage: str, seconds: float) -> None:
+    """
+    Parameters required: name of the stage, seconds spent in it
+    Return data: None
+    """
+    observe_histogram("cadence_stage_seconds", seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        with _lock:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+# Function to time a block of code as a stage
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Context manager recording the time spent inside it, also when it raises
+    Parameters required: name of the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+# Function to start collecting the timings of a request
+def start_request() -> dict:
+    """
+    Stages timed from now on in this context, and in the tasks and executor calls started from it, add to the timings
+    Parameters required: None
+    Return data: dictionary of stage -> seconds, filled in while the request is served
+    """
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+# Function to run a function in an executor, keeping the timings of the request being served
+def run_in_executor(executor, function, *args):
+    """
+    loop.run_in_executor does not carry context variables over to the thread, so the context is copied by hand
+    Parameters required: executor (None for the default one), function and its arguments
+    Return data: asyncio future of the result
+    """
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor, context.run, function, *args)
+
+
+# Function to get the number of times every stage ran and the time spent in it
+def stage_totals() -> dict:
+    """
+    Parameters required: None
+    Return data: dictionary of stage -> (count, seconds), since the process started
+    """
+    with _lock:
+        return {
+            dict(labels)["stage"]: (sum(i.counts), i.sum)
+            for (name, labels), i in _histograms.items()
+            if name == "cadence_stage_seconds"
+        }
+
+
+# Function to format timings for the Server-Timing header
+def server_timing(timings: dict) -> str:
+    """
+    Parameters required: dictionary of stage -> seconds
+    Return data: header value, with durations in milliseconds
+    """
+    with _lock:
+        items = list(timings.items())
+    return ", ".join("%s;dur=%.1f" % (name, seconds * 1e3) for name, seconds in items)
+
+
+# Function to format a set of labels
+def _labels(labels: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (name, value) for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{%s}" % ",".join(parts) if parts else ""
+
+
+# Function to render every metric in the Prometheus text format
+def render(caches: dict = None, limiter: dict = None, gate: dict = None) -> str:
+    """
+    Parameters required: dictionary of cache name -> stats() of the cache, rendered as cadence_cache_* metrics,
+        stats() of the spotify rate limiter, stats() of the admission gate
+    Return data: text to send back on '/metrics'
+    """
+    lines = []
+    with _lock:
+        histograms = {
+            key: (list(i.counts), i.sum, i.buckets) for key, i in _histograms.items()
+        }
+        counters = dict(_counters)
+
+    for name in sorted(set(i[0] for i in histograms)):
+        lines.append("# HELP %s %s" % (name, DESCRIPTIONS.get(name, name)))
+        lines.append("# TYPE %s histogram" % name)
+        for (metric, labels), (counts, total, buckets) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(buckets, counts):
+                cumulative += bucket
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, _labels(labels, 'le="%s"' % bound), cumulative)
+                )
+            cumulative += counts[-1]
+            lines.append(
+                "%s_bucket%s %d" % (name, _labels(labels, 'le="+Inf"'), cumulative)
+            )
+            lines.append("%s_sum%s %f" % (name, _labels(labels), total))
+            lines.append("%s_count%s %d" % (name, _labels(labels), cumulative))
+
+    for name in sorted(set(i[0] for i in counters)):
+        lines.append("# HELP %s %s" % (name, DESCRIPTIONS.get(name, name)))
+        lines.append("# TYPE %s counter" % name)
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append("%s%s %s" % (name, _labels(labels), value))
+
+    # Counters of the caches, as returned by their stats(), grouped by metric
+    # A cache made of several tables gives the counters of each table as a dictionary under its name
+    samples = {}
+    for cache_name, stats in sorted((caches or {}).items()):
+        tables = sorted((k, v) for k, v in stats.items() if isinstance(v, dict))
+        for table, values in [(None, stats)] + tables:
+            labels = 'cache="%s"' % cache_name
+            if table is not None:
+                labels += ',table="%s"' % table
+            for stat, value in sorted(values.items()):
+                if not isinstance(value, (int, float)) or stat in (
+                    "capacity",
+                    "hit_ratio",
+                ):
+                    continue
+                if stat in ("size", "running"):
+                    metric = ("cadence_cache_%s" % stat, "gauge")
+                else:
+                    metric = ("cadence_cache_%s_total" % stat, "counter")
+                samples.setdefault(metric, []).append((labels, value))
+    for (name, kind), values in sorted(samples.items()):
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in values:
+            lines.append("%s{%s} %s" % (name, labels, value))
+
+    # Queue depth and state of the spotify rate limiter
+    if limiter is not None:
+        name = "cadence_spotify_queue_depth"
+        lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+        lines.append("# TYPE %s gauge" % name)
+        for priority, waiting in sorted(limiter["waiting"].items()):
+            lines.append('%s{priority="%s"} %d' % (name, priority, waiting))
+        for name, stat in [
+            ("cadence_spotify_tokens", "tokens"),
+            ("cadence_spotify_blocked_seconds", "blocked_for"),
+        ]:
+            lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %f" % (name, limiter[stat]))
+
+    # Scoring requests being served and waiting
+    if gate is not None:
+        for name, stat in [
+            ("cadence_requests_in_flight", "in_flight"),
+            ("cadence_requests_queued", "waiting"),
+        ]:
+            lines.append("# HELP %s %s" % (name, DESCRIPTIONS[name]))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %d" % (name, gate[stat]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,102 @@
+"""
+modelstore.py
+Saving and loading the ML model in XGBoost's native format
+
+Pickling the whole XGBClassifier is slow to load, ties the file to the installed library versions, and runs arbitrary code
+when loaded. The model is instead saved as:
+ -> MLModel.json: the trained booster, in XGBoost's own JSON format
+ -> MLModel.meta.json: classes (in the order of the predicted probabilities), feature schema and a hash of the training set
+Loading gives a BoosterModel, which predicts with Booster.inplace_predict straight on the float32 feature matrix,
+without the sklearn wrapper and without building a DMatrix for every call
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import xgboost
+
+# Files the model is saved to
+MODEL_FILE = "MLModel.json"
+META_FILE = "MLModel.meta.json"
+
+
+class BoosterModel:
+    """
+    Trained booster with the metadata needed to use it
+    Offers the parts of the XGBClassifier interface used by the backend: classes_, feature_schema and predict_proba
+    Parameters required: xgboost Booster, metadata dictionary, fingerprint of the saved files
+    """
+
+    def __init__(self, booster: xgboost.Booster, meta: dict, fingerprint: str):
+        self.booster = booster
+        self.meta = meta
+        self.fingerprint = fingerprint
+        self.classes_ = np.asarray(meta["classes"])
+        self.feature_schema = meta["schema"]
+
+    # Function to predict the probability of every class
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """
+        Parameters required: float32 feature matrix, columns in schema order
+        Return data: matrix of probabilities, one column per class in classes_ order
+        """
+        if len(features) == 0:
+            return np.empty((0, len(self.classes_)), dtype=np.float32)
+        probs = self.booster.inplace_predict(features, validate_features=False)
+        # Models with two classes only give the probability of the second one
+        if probs.ndim == 1:
+            probs = np.column_stack([1 - probs, probs])
+        return probs
+
+
+# Function to save a trained classifier in the native format
+def save_model(
+    model: xgboost.XGBClassifier,
+    feature_schema: dict,
+    training_hash: str,
+    path: str = MODEL_FILE,
+    meta_path: str = META_FILE,
+) -> None:
+    """
+    Parameters required: trained XGBClassifier, feature schema dictionary, hash of the training set, and files to save to
+    Return data: None
+    """
+    booster = model.get_booster()
+    # Feature order is kept by the schema, the booster works on plain matrices
+    booster.feature_names = None
+    meta = {
+        "format": "xgboost-json",
+        "classes": [str(i) for i in model.classes_],
+        "schema": feature_schema,
+        "training_hash": training_hash,
+    }
+    # Saving to temporary files first, so a loader never sees half a model
+    booster.save_model(path + ".tmp.json")
+    with open(meta_path + ".tmp", "w") as file:
+        json.dump(meta, file, indent=2)
+    os.replace(path + ".tmp.json", path)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+# Function to check if a model has been saved in the native format
+def model_exists(path: str = MODEL_FILE, meta_path: str = META_FILE) -> bool:
+    return os.path.isfile(path) and os.path.isfile(meta_path)
+
+
+# Function to load a model saved by save_model
+def load_model(path: str = MODEL_FILE, meta_path: str = META_FILE) -> BoosterModel:
+    """
+    Parameters required: files the model was saved to
+    Return data: BoosterModel object
+    """
+    with open(path, "rb") as file:
+        raw = file.read()
+    with open(meta_path, "rb") as file:
+        meta_raw = file.read()
+    booster = xgboost.Booster()
+    booster.load_model(bytearray(raw))
+    # The fingerprint changes whenever the model is trained again
+    fingerprint = hashlib.sha1(raw + meta_raw).hexdigest()
+    return BoosterModel(booster, json.loads(meta_raw), fingerprint)
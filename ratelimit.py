@@ -0,0 +1,240 @@
+"""
+ratelimit.py
+Scheduler of the calls made to the spotify web API, shared by every worker process
+
+Spotify rate limits the whole app, not single requests, so every call takes a token from one token bucket:
+ -> The bucket lives in a small state file (SPOTIFY_RATE_FILE), locked with flock while it is read and written, so every
+    worker process on the machine shares it
+ -> Tokens are added at SPOTIFY_RATE per second, up to SPOTIFY_BURST. A caller that finds no token waits until the next
+    one is due, instead of sending the call and getting a 429
+ -> A 429 response stops every caller, in every worker, until its Retry-After has passed
+ -> Interactive calls (API requests) always come first. Background calls (dataset builds) leave SPOTIFY_RESERVE tokens
+    in the bucket for interactive calls, and wait while interactive calls of their own process are waiting
+The number of callers waiting, by priority, is the queue depth reported on '/stats' and '/metrics'
+Locking and reading the state file can block, so async callers do it on a thread of the limiter, never on the event loop
+
+Spotify does not publish its limit. It counts the calls of an app over a rolling 30 second window, and apps in
+development mode are reported to be throttled from about 180 calls a minute. The defaults stay below that: 3 calls a
+second, with a burst of 30, so at most 120 calls in any 30 seconds. Apps with extended quota can raise SPOTIFY_RATE
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl. The bucket is then only safe to share between threads of one process
+    fcntl = None
+
+# Priorities of the calls, highest first
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every process using the same state file
+    Parameters required: path of the state file, tokens added per second, most tokens held,
+        tokens background calls leave for interactive calls
+    """
+
+    def __init__(self, path: str, rate: float, burst: float, reserve: float):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        # Lock for the threads of this process, flock is for the other processes
+        self._lock = threading.Lock()
+        self._file = None
+        # Thread the state file is used from by async callers, so the event loop never waits on the file lock
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ratelimit"
+        )
+        # State of the bucket as last read, for stats() to report without touching the file
+        self._state = {"tokens": burst, "at": time.time(), "blocked_until": 0}
+        # Number of callers of this process waiting for a token, and the lock for changing it,
+        # never held while the file is used
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._waiting_lock = threading.Lock()
+        self._counters = {"granted": 0, "delayed": 0, "throttled": 0}
+
+    # Function to read the bucket, change it, and write it back, holding the file lock
+    def _update(self, change):
+        """
+        Parameters required: function taking the state dictionary and the current time, changing the state in place
+        Return data: what the function returned
+        """
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a+")
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._file.seek(0)
+                try:
+                    state = json.loads(self._file.read())
+                except ValueError:
+                    # A new or damaged file starts with a full bucket
+                    state = {
+                        "tokens": self.burst,
+                        "at": time.time(),
+                        "blocked_until": 0,
+                    }
+                now = time.time()
+                # Adding the tokens due since the last update
+                state["tokens"] = min(
+                    self.burst, state["tokens"] + (now - state["at"]) * self.rate
+                )
+                state["at"] = now
+                result = change(state, now)
+                self._file.seek(0)
+                self._file.truncate()
+                self._file.write(json.dumps(state))
+                self._file.flush()
+                self._state = state
+                return result
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    # Function to take a token if there is one
+    def try_acquire(self, priority: str = INTERACTIVE) -> float:
+        """
+        Parameters required: priority of the call
+        Return data: 0 if a token was taken and the call can be sent, else seconds to wait before trying again
+        """
+        # Background calls give way to interactive calls waiting in this process
+        if priority == BACKGROUND and self.waiting[INTERACTIVE]:
+            return 1 / self.rate
+        floor = self.reserve if priority == BACKGROUND else 0
+
+        def take(state: dict, now: float) -> float:
+            if now < state["blocked_until"]:
+                return state["blocked_until"] - now
+            if state["tokens"] >= 1 + floor:
+                state["tokens"] -= 1
+                return 0
+            return (1 + floor - state["tokens"]) / self.rate
+
+        return self._update(take)
+
+    # Function to run a call of the limiter on its own thread, from the event loop
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    # Function to wait for a token without blocking the event loop
+    async def acquire(self, priority: str = INTERACTIVE) -> None:
+        wait = await self._run(self.try_acquire, priority)
+        if wait == 0:
+            self._counters["granted"] += 1
+            return
+        self._counters["delayed"] += 1
+        start = time.perf_counter()
+        with self._waiting_lock:
+            self.waiting[priority] += 1
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                wait = await self._run(self.try_acquire, priority)
+        finally:
+            with self._waiting_lock:
+                self.waiting[priority] -= 1
+        self._counters["granted"] += 1
+        metrics.observe("spotify_wait", time.perf_counter() - start)
+
+    # Function to wait for a token, blocking the calling thread
+    def acquire_sync(self, priority: str = INTERACTIVE) -> None:
+        wait = self.try_acquire(priority)
+        if wait == 0:
+            self._counters["granted"] += 1
+            return
+        self._counters["delayed"] += 1
+        start = time.perf_counter()
+        with self._waiting_lock:
+            self.waiting[priority] += 1
+        try:
+            while wait:
+                time.sleep(wait)
+                wait = self.try_acquire(priority)
+        finally:
+            with self._waiting_lock:
+                self.waiting[priority] -= 1
+        self._counters["granted"] += 1
+        metrics.observe("spotify_wait", time.perf_counter() - start)
+
+    # Function to stop every caller after a 429 response
+    def throttled(self, retry_after: float) -> None:
+        """
+        Parameters required: seconds spotify asked to wait, from the Retry-After header
+        Return data: None
+        """
+        self._counters["throttled"] += 1
+
+        def block(state: dict, now: float) -> None:
+            state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+            state["tokens"] = 0
+
+        self._update(block)
+
+    # Function to stop every caller after a 429 response, without blocking the event loop
+    async def throttled_async(self, retry_after: float) -> None:
+        await self._run(self.throttled, retry_after)
+
+    # Function to get the queue depth and counters
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with the callers waiting by priority, the tokens left in the bucket,
+            the seconds every caller is still blocked for after a 429, and the granted, delayed and throttled counters
+            The tokens and block are as this process last saw them, so reading them never waits on the file lock
+        """
+        state = self._state
+        now = time.time()
+        stats = dict(self._counters)
+        stats.update(
+            {
+                "waiting": dict(self.waiting),
+                "tokens": min(
+                    self.burst, state["tokens"] + (now - state["at"]) * self.rate
+                ),
+                "blocked_for": max(0, state["blocked_until"] - now),
+                "rate": self.rate,
+                "burst": self.burst,
+            }
+        )
+        return stats
+
+
+# Rate limiter used by the whole process, created on first use
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+# Function to get the process wide rate limiter
+def get_limiter() -> RateLimiter:
+    """
+    Returns the process wide RateLimiter, creating it on the first call
+    It is configured with the SPOTIFY_RATE_FILE, SPOTIFY_RATE, SPOTIFY_BURST and SPOTIFY_RESERVE environment variables
+    Parameters required: None
+    Return data: RateLimiter object
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    os.environ.get("SPOTIFY_RATE_FILE", "spotifyrate.json"),
+                    float(os.environ.get("SPOTIFY_RATE", 3)),
+                    float(os.environ.get("SPOTIFY_BURST", 30)),
+                    float(os.environ.get("SPOTIFY_RESERVE", 5)),
+                )
+    return _limiter
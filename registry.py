@@ -0,0 +1,268 @@
+"""
+registry.py
+Versioned store of the NLU and ML models, so new models can be swapped in while the API keeps serving
+
+Every version is a directory in models/ holding a complete set of artifacts:
+ -> nlumodel: the persisted SnipsNLUEngine
+ -> nlputrain: the yaml files the engine was trained on, the keyword lexicon (see lexicon.py) is built from them
+ -> MLModel.json and MLModel.meta.json: the ML model, in the native format of modelstore.py
+models/current.json names the version in use, and the versions used before it (newest first) for rollback
+A version is built in a staging directory and only renamed into models/ once it loads and passes the smoke test.
+Its directory is never changed afterwards, so a worker loading it never sees half written files
+Building a version holds models/.build.lock, so when several worker processes start at once only one of them trains
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl. Models are then only safe to build from a single process
+    fcntl = None
+
+import numpy as np
+from snips_nlu import SnipsNLUEngine
+
+import lexicon
+import modelstore
+
+# Directory holding every version
+REGISTRY = "models"
+# Name of the NLU model inside a version
+NLU_DIR = "nlumodel"
+# Name of the NLU training files inside a version, and in the root directory
+TRAINING_DIR = "nlputrain"
+# Prompt parsed by the smoke test of every loaded NLU model
+SMOKE_PROMPT = "play something for the gym"
+# Number of earlier versions kept for rollback, older versions are deleted by prune
+HISTORY = 5
+
+
+class ModelSet:
+    """
+    NLU model, keyword lexicon and ML model of one version, always used together
+    Swapping the models is a single assignment of a new ModelSet, so a request never mixes models of two versions
+    Parameters required: version name, SnipsNLUEngine object, modelstore.BoosterModel object, lexicon.Lexicon object
+    """
+
+    def __init__(
+        self,
+        version: str,
+        nlu: SnipsNLUEngine,
+        ml: modelstore.BoosterModel,
+        keywords: lexicon.Lexicon,
+    ):
+        self.version = version
+        self.nlu = nlu
+        self.ml = ml
+        self.lexicon = keywords
+        # Prompts parsed by one engine and lexicon are never served for another (see cache.IntentCache)
+        digest = hashlib.sha1(nlu.to_byte_array())
+        digest.update(keywords.fingerprint.encode())
+        self.intent_fingerprint = digest.hexdigest()
+
+
+# Function to get the directory of a version
+def version_path(version: str, directory: str = REGISTRY) -> str:
+    return os.path.join(directory, version)
+
+
+# Function to list the versions in the registry, oldest first
+def list_versions(directory: str = REGISTRY) -> list:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        i
+        for i in os.listdir(directory)
+        if not i.startswith(".") and os.path.isdir(os.path.join(directory, i))
+    )
+
+
+# Function to read current.json
+def _read_pointer(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, "current.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"version": None, "history": []}
+
+
+# Function to write current.json
+def _write_pointer(state: dict, directory: str) -> None:
+    # Saving to a temporary file first, so current.json always names a single version
+    with open(os.path.join(directory, "current.json.tmp"), "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(
+        os.path.join(directory, "current.json.tmp"),
+        os.path.join(directory, "current.json"),
+    )
+
+
+# Function to get the version in use
+def current_version(directory: str = REGISTRY) -> str:
+    """
+    Parameters required: registry directory
+    Return data: name of the version in use, None if no version has been promoted yet
+    """
+    return _read_pointer(directory)["version"]
+
+
+# Function to get the versions used before the current one
+def history(directory: str = REGISTRY) -> list:
+    """
+    Parameters required: registry directory
+    Return data: list of version names, the one rollback goes back to first
+    """
+    return _read_pointer(directory)["history"]
+
+
+# Function to run a prediction through both models of a version
+def smoke_test(models: ModelSet) -> None:
+    """
+    Raises ValueError if either model does not give a well formed answer
+    Parameters required: ModelSet object
+    Return data: None
+    """
+    parsed = models.nlu.parse(SMOKE_PROMPT)
+    if "intent" not in parsed or "slots" not in parsed:
+        raise ValueError(
+            "NLU model of version %s failed the smoke test" % models.version
+        )
+    width = len(models.ml.feature_schema["features"])
+    probs = models.ml.predict_proba(np.zeros((1, width), dtype=np.float32))
+    if probs.shape != (1, len(models.ml.classes_)) or not np.all(np.isfinite(probs)):
+        raise ValueError(
+            "ML model of version %s failed the smoke test" % models.version
+        )
+
+
+# Function to load the models saved in a directory
+def _load(path: str, version: str) -> ModelSet:
+    training = os.path.join(path, TRAINING_DIR)
+    if not os.path.isdir(training):
+        # Versions saved before the training files were kept with them
+        training = TRAINING_DIR
+    models = ModelSet(
+        version,
+        SnipsNLUEngine.from_path(os.path.join(path, NLU_DIR)),
+        modelstore.load_model(
+            os.path.join(path, modelstore.MODEL_FILE),
+            os.path.join(path, modelstore.META_FILE),
+        ),
+        lexicon.Lexicon.from_directory(training),
+    )
+    smoke_test(models)
+    return models
+
+
+# Function to load a version
+def load_version(version: str, directory: str = REGISTRY) -> ModelSet:
+    """
+    Parameters required: version name, registry directory
+    Return data: ModelSet object, after it passed the smoke test
+    """
+    path = version_path(version, directory)
+    if not os.path.isdir(path):
+        raise ValueError("Model version %s does not exist" % version)
+    return _load(path, version)
+
+
+# Function to hold the build lock of the registry
+@contextlib.contextmanager
+def build_lock(directory: str = REGISTRY):
+    """
+    Context manager that blocks until no other process is building models in this registry
+    The lock is released by the operating system if the process holding it dies
+    Parameters required: registry directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".build.lock"), "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+# Function to create a staging directory for a new version
+def stage(directory: str = REGISTRY) -> str:
+    """
+    The NLU model is saved to NLU_DIR and the ML model to modelstore.MODEL_FILE and META_FILE inside this directory
+    Parameters required: registry directory
+    Return data: path of an empty staging directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.mkdtemp(prefix=".staging-", dir=directory)
+
+
+# Function to add a staged set of models to the registry
+def commit(staging: str, directory: str = REGISTRY) -> str:
+    """
+    The staged models are loaded and smoke tested first, a staging directory that fails is left untouched
+    The new version is not used until it is promoted
+    Parameters required: staging directory made by stage, registry directory
+    Return data: name of the new version
+    """
+    _load(staging, "staged")
+    version = time.strftime("v%Y%m%d-%H%M%S")
+    name, suffix = version, 1
+    while os.path.exists(version_path(name, directory)):
+        suffix += 1
+        name = "%s-%d" % (version, suffix)
+    os.rename(staging, version_path(name, directory))
+    return name
+
+
+# Function to make a version the one in use
+def promote(version: str, directory: str = REGISTRY) -> None:
+    """
+    The version in use before is kept in the history, so it can be rolled back to
+    Parameters required: version name, registry directory
+    Return data: None
+    """
+    if not os.path.isdir(version_path(version, directory)):
+        raise ValueError("Model version %s does not exist" % version)
+    state = _read_pointer(directory)
+    if state["version"] == version:
+        return
+    previous = [state["version"]] if state["version"] is not None else []
+    versions = previous + [i for i in state["history"] if i != version]
+    _write_pointer({"version": version, "history": versions[:HISTORY]}, directory)
+
+
+# Function to go back to the version used before the current one
+def rollback(directory: str = REGISTRY) -> str:
+    """
+    Parameters required: registry directory
+    Return data: name of the version now in use
+    Raises ValueError if there is no earlier version
+    """
+    state = _read_pointer(directory)
+    if not state["history"]:
+        raise ValueError("No earlier model version to roll back to")
+    _write_pointer(
+        {"version": state["history"][0], "history": state["history"][1:]}, directory
+    )
+    return state["history"][0]
+
+
+# Function to delete versions that can no longer be rolled back to
+def prune(directory: str = REGISTRY) -> list:
+    """
+    Parameters required: registry directory
+    Return data: list of deleted version names
+    """
+    state = _read_pointer(directory)
+    keep = set([state["version"]] + state["history"])
+    deleted = [i for i in list_versions(directory) if i not in keep]
+    for version in deleted:
+        shutil.rmtree(version_path(version, directory), ignore_errors=True)
+    return deleted
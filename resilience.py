@@ -0,0 +1,293 @@
+"""
+resilience.py
+Hedged and retried spotify calls behind a circuit breaker, so one slow or failed chunk does not hold up a whole request
+
+Used for the reads of AsyncSpotify: the chunked calls of prep_songs_async (tracks and audio features), and the playlist
+pages and snapshot_id. They are all safe to send twice:
+ -> Hedging: if a call has not answered after the HEDGE_PERCENTILE latency of recent calls to its endpoint, the same call
+    is sent again and the first answer wins, the other call is cancelled. Hedges are only sent once HEDGE_SAMPLES calls
+    were timed, and not while calls are queued at the rate limiter, as they would only add to the queue
+ -> Retries: a call that failed with a transient error (5xx, connection error, timeout) is retried up to CALL_RETRIES
+    times, after a random wait of up to RETRY_BACKOFF * 2^attempt seconds, so retries of many calls do not line up
+ -> Circuit breaker: after BREAKER_FAILURES transient errors in a row the breaker opens, and calls fail at once for
+    BREAKER_COOLDOWN seconds instead of piling up on a failing upstream. One trial call is then let through, and the
+    breaker closes again if it succeeds
+429 responses are not retried here, the rate limiter in ratelimit.py deals with them
+How often hedges were sent and won is counted in cadence_spotify_hedges_total, by endpoint and winner
+"""
+
+import asyncio
+import math
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+import spotipy
+
+import admission
+import metrics
+import ratelimit
+
+# Latency percentile after which a call is hedged
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+# Shortest wait before a hedge, in seconds
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.05))
+# Number of timed calls to an endpoint needed before its calls are hedged
+HEDGE_SAMPLES = int(os.environ.get("HEDGE_SAMPLES", 20))
+# Number of retries after a transient error
+CALL_RETRIES = int(os.environ.get("CALL_RETRIES", 2))
+# Seconds the random wait before the first retry is at most, doubling with every retry
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 0.1))
+# Transient errors in a row that open the circuit breaker
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+# Seconds the circuit breaker stays open
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 10))
+
+
+class CircuitOpen(spotipy.exceptions.SpotifyException):
+    """
+    Raised instead of calling spotify while the circuit breaker is open
+    Parameters required: seconds until the breaker lets a call through again
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            503,
+            -1,
+            "Spotify keeps failing, calls are paused",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+        self.retry_after = retry_after
+
+
+# Function to check if a failed call is worth retrying
+def transient(error: Exception) -> bool:
+    """
+    Parameters required: error raised by the call
+    Return data: True for 5xx responses, connection errors and timeouts
+    """
+    if isinstance(error, CircuitOpen):
+        return False
+    if isinstance(error, spotipy.exceptions.SpotifyException):
+        return error.http_status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class LatencyTracker:
+    """
+    Latencies of the most recent successful calls to one endpoint
+    Parameters required: number of calls kept
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    # Function to add the latency of a call
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    # Function to get a percentile of the kept latencies
+    def percentile(self, percent: float) -> float:
+        """
+        Parameters required: percentile, between 0 and 100
+        Return data: latency in seconds, None if fewer than HEDGE_SAMPLES calls were timed
+        """
+        if len(self._samples) < HEDGE_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream that keeps failing
+    States: closed (calls go through), open (calls fail at once), half open (one trial call goes through)
+    Parameters required: transient errors in a row that open the breaker, seconds it stays open
+    """
+
+    def __init__(
+        self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN
+    ):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        # Transient errors in a row, time the breaker opened, and time the trial call was let through
+        self._failed = 0
+        self._opened_at = 0.0
+        self._trial_at = 0.0
+        self._counters = {"trips": 0, "rejected": 0}
+
+    # Function to let a call through, or refuse it
+    def allow(self) -> None:
+        """
+        Raises CircuitOpen if the breaker is open, or a trial call is already running
+        A trial call that never reported back (it was cancelled) is given up on after the cooldown
+        Parameters required: None
+        Return data: None
+        """
+        now = time.monotonic()
+        if self.state == "open":
+            left = self._opened_at + self.cooldown - now
+            if left > 0:
+                self._counters["rejected"] += 1
+                raise CircuitOpen(left)
+            self.state = "half_open"
+            self._trial_at = 0.0
+        if self.state == "half_open":
+            left = self._trial_at + self.cooldown - now
+            if self._trial_at and left > 0:
+                self._counters["rejected"] += 1
+                raise CircuitOpen(left)
+            self._trial_at = now
+
+    # Function to record a call that spotify answered
+    def success(self) -> None:
+        self._failed = 0
+        self.state = "closed"
+        self._trial_at = 0.0
+
+    # Function to record a call that failed with a transient error
+    def failure(self) -> None:
+        self._failed += 1
+        if self.state == "half_open" or self._failed >= self.failures:
+            if self.state != "open":
+                self._counters["trips"] += 1
+                metrics.count("cadence_spotify_circuit_trips_total")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._trial_at = 0.0
+
+    # Function to get the state and counters
+    def stats(self) -> dict:
+        stats = dict(self._counters)
+        stats.update({"state": self.state, "failures_in_a_row": self._failed})
+        return stats
+
+
+class ResilientCaller:
+    """
+    Sends idempotent spotify calls with hedging, retries with jitter, and a circuit breaker
+    Used from the event loop only, so it does not need a lock
+    Parameters required: latency percentile after which calls are hedged, number of retries after a transient error,
+        longest first wait before a retry, and the circuit breaker to use
+    """
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_PERCENTILE,
+        retries: int = CALL_RETRIES,
+        backoff: float = RETRY_BACKOFF,
+        breaker: CircuitBreaker = None,
+    ):
+        self.percentile = percentile
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        # endpoint -> LatencyTracker
+        self._latency = {}
+        self._counters = {"hedged": 0, "hedge_won": 0, "hedge_skipped": 0, "retried": 0}
+
+    # Function to get the seconds to wait before hedging a call
+    def hedge_delay(self, endpoint: str) -> float:
+        """
+        Parameters required: name of the endpoint
+        Return data: seconds, None if the endpoint has not been timed often enough yet
+        """
+        tracker = self._latency.setdefault(endpoint, LatencyTracker())
+        delay = tracker.percentile(self.percentile)
+        return None if delay is None else max(delay, HEDGE_MIN_DELAY)
+
+    # Function to send one call, recording its latency and outcome
+    async def _attempt(self, endpoint: str, request):
+        start = time.perf_counter()
+        try:
+            result = await request()
+        except spotipy.exceptions.SpotifyException as e:
+            # Any other error status still means spotify is up and answering
+            if transient(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except httpx.TransportError:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        self._latency[endpoint].observe(time.perf_counter() - start)
+        return result
+
+    # Function to send a call, and the same call again if it is slow
+    async def _hedged(self, endpoint: str, request):
+        delay = self.hedge_delay(endpoint)
+        tasks = [asyncio.ensure_future(self._attempt(endpoint, request))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    # Hedges take rate limiter tokens, so none are sent while calls are queued for them
+                    if any(ratelimit.get_limiter().waiting.values()):
+                        self._counters["hedge_skipped"] += 1
+                    else:
+                        self._counters["hedged"] += 1
+                        tasks.append(
+                            asyncio.ensure_future(self._attempt(endpoint, request))
+                        )
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        continue
+                    if len(tasks) > 1:
+                        winner = "hedge" if task is tasks[1] else "primary"
+                        if winner == "hedge":
+                            self._counters["hedge_won"] += 1
+                        metrics.count(
+                            "cadence_spotify_hedges_total",
+                            endpoint=endpoint,
+                            winner=winner,
+                        )
+                    return task.result()
+            # Every call failed, the error of the first one is raised
+            raise tasks[0].exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    # Function to send an idempotent call
+    async def call(self, endpoint: str, request):
+        """
+        Parameters required: name of the endpoint, function with no arguments returning the coroutine of the call
+        Return data: result of the call
+        Raises CircuitOpen while the breaker is open, and the error of the last attempt if every retry failed
+        """
+        for attempt in range(self.retries + 1):
+            self.breaker.allow()
+            try:
+                return await self._hedged(endpoint, request)
+            except Exception as e:
+                if not transient(e) or attempt == self.retries:
+                    raise
+            self._counters["retried"] += 1
+            metrics.count("cadence_spotify_error_retries_total", endpoint=endpoint)
+            # Full jitter, and never waiting past the deadline of the request
+            await admission.within(
+                asyncio.sleep(random.uniform(0, self.backoff * 2**attempt))
+            )
+
+    # Function to get the counters and the state of the breaker
+    def stats(self) -> dict:
+        """
+        Parameters required: None
+        Return data: dictionary with the hedged, hedge_won, hedge_skipped and retried counters, the current hedge delay
+            of every endpoint, and the state of the circuit breaker
+        """
+        stats = dict(self._counters)
+        stats["hedge_delay"] = {i: self.hedge_delay(i) for i in list(self._latency)}
+        stats["breaker"] = self.breaker.stats()
+        return stats
@@ -0,0 +1,193 @@
+"""
+schema.py
+Feature schema of the ML model, and the binary training set stored with it
+
+The feature schema lists the features the model is trained on, in order. The same FeatureSchema object:
+ -> selects the columns of the training set when it is saved
+ -> is stored inside the trained model (as its feature_schema attribute), so the model always carries its own column order
+ -> turns raw audio feature payloads from spotify straight into the float32 matrix the model predicts on
+
+The training set is kept in the trainingset directory as:
+ -> features.npy: float32 matrix with one row per song and one column per feature, in FEATURE_COLUMNS order
+ -> labels.npy: tag of every song, as an index into the classes listed in schema.json
+ -> schema.json: schema version, feature columns, classes and number of rows
+Both matrices are memory mapped when loaded, so the features are never parsed or copied before training
+schema.json is written last, so a training set without it is incomplete and is built again
+dataset.csv is still written by create_dataset, but only as a readable export
+"""
+
+import hashlib
+import json
+import operator
+import os
+
+import numpy as np
+import pandas as pd
+
+# Version of the training set layout. Training sets saved with another version are rejected when loaded
+SCHEMA_VERSION = 1
+
+# Features the ML model is trained on, in the order the model expects them
+FEATURE_COLUMNS = [
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "time_signature",
+]
+
+# Directory holding the training set
+TRAINING_SET = "trainingset"
+
+
+class IncompleteFeatures(ValueError):
+    """
+    Raised when the audio features of a song lack a feature the model needs
+    """
+
+
+class FeatureSchema:
+    """
+    Ordered list of model features, with a precompiled projection from audio feature payloads to a matrix
+    Parameters required: feature names in model order, schema version
+    """
+
+    def __init__(self, columns: list, version: int = SCHEMA_VERSION):
+        self.columns = list(columns)
+        self.version = version
+        getter = operator.itemgetter(*self.columns)
+        # itemgetter returns a bare value instead of a tuple when given one name
+        self._getter = getter if len(self.columns) > 1 else lambda i: (getter(i),)
+
+    # Function to turn audio feature payloads into a feature matrix
+    def project(self, payloads: list) -> np.ndarray:
+        """
+        Parameters required: list of audio feature dictionaries, as returned by spotify.audio_features
+        Return data: C contiguous float32 matrix, one row per payload, columns in model order
+        Raises IncompleteFeatures if a payload is missing a feature, or has None for it
+        """
+        matrix = np.empty((len(payloads), len(self.columns)), dtype=np.float32)
+        for row, payload in enumerate(payloads):
+            try:
+                values = self._getter(payload)
+            except KeyError as e:
+                raise IncompleteFeatures(
+                    "Feature %s missing for song: %s" % (e, payload.get("id"))
+                )
+            if None in values:
+                raise IncompleteFeatures(
+                    "Feature %s is None for song: %s"
+                    % (self.columns[values.index(None)], payload.get("id"))
+                )
+            matrix[row] = values
+        return matrix
+
+    # Function to get the schema as a dictionary, to be saved with a model
+    def to_dict(self) -> dict:
+        return {"version": self.version, "features": self.columns}
+
+    # Function to create a schema from a dictionary made by to_dict
+    @classmethod
+    def from_dict(cls, data: dict) -> "FeatureSchema":
+        return cls(data["features"], data["version"])
+
+
+# Schema of models trained by this version of the backend
+DEFAULT_SCHEMA = FeatureSchema(FEATURE_COLUMNS)
+
+
+# Function to get the feature schema of a trained model
+def model_schema(model) -> FeatureSchema:
+    """
+    Models trained before the schema was stored with them were trained on FEATURE_COLUMNS, in that order
+    Parameters required: trained model
+    Return data: FeatureSchema object
+    """
+    data = getattr(model, "feature_schema", None)
+    return FeatureSchema.from_dict(data) if data else DEFAULT_SCHEMA
+
+
+# Function to check if a complete training set has been saved
+def training_set_exists(directory: str = TRAINING_SET) -> bool:
+    return os.path.isfile(os.path.join(directory, "schema.json"))
+
+
+# Function to save a dataset as a binary training set
+def save_training_set(
+    dataset: pd.DataFrame,
+    directory: str = TRAINING_SET,
+    feature_schema: FeatureSchema = DEFAULT_SCHEMA,
+) -> None:
+    """
+    This function saves the features and tags of a dataset made by create_dataset
+    Parameters Required: Dataset with every feature column and a 'Tag' column, the directory to save it in, and the schema
+    Return Data: None
+    """
+    os.makedirs(directory, exist_ok=True)
+    features = np.ascontiguousarray(
+        dataset[feature_schema.columns].to_numpy(np.float32)
+    )
+    classes, labels = np.unique(dataset["Tag"].astype(str), return_inverse=True)
+    for name, data in [("features.npy", features), ("labels.npy", labels)]:
+        # Saving to a temporary file first, so a reader never sees half a matrix
+        with open(os.path.join(directory, name + ".tmp"), "wb") as file:
+            np.save(file, data)
+        os.replace(
+            os.path.join(directory, name + ".tmp"), os.path.join(directory, name)
+        )
+    schema = feature_schema.to_dict()
+    schema.update({"classes": classes.tolist(), "rows": len(features)})
+    with open(os.path.join(directory, "schema.json.tmp"), "w") as file:
+        json.dump(schema, file, indent=2)
+    os.replace(
+        os.path.join(directory, "schema.json.tmp"),
+        os.path.join(directory, "schema.json"),
+    )
+
+
+# Function to get a hash of a saved training set
+def training_set_hash(directory: str = TRAINING_SET) -> str:
+    """
+    Saved with every model, so it is known which training set a model was trained on
+    Parameters Required: Directory the training set was saved in
+    Return Data: Hex digest of the training set files
+    """
+    digest = hashlib.sha1()
+    for name in ["schema.json", "features.npy", "labels.npy"]:
+        with open(os.path.join(directory, name), "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+# Function to load a binary training set
+def load_training_set(directory: str = TRAINING_SET) -> tuple:
+    """
+    This function loads a training set saved by save_training_set, after checking its schema
+    Parameters Required: Directory the training set was saved in
+    Return Data: Tuple of multiple data
+        Tuple index 0: Memory mapped float32 matrix of features, in FEATURE_COLUMNS order
+        Tuple index 1: Array of the tag of every song
+        Tuple index 2: Schema dictionary
+    Raises ValueError if the training set was saved with another schema
+    """
+    with open(os.path.join(directory, "schema.json")) as file:
+        schema = json.load(file)
+    if schema["version"] != SCHEMA_VERSION or schema["features"] != FEATURE_COLUMNS:
+        raise ValueError(
+            "Training set in %s has schema version %s, expected %s. Run create_dataset() again"
+            % (directory, schema["version"], SCHEMA_VERSION)
+        )
+    features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+    labels = np.load(os.path.join(directory, "labels.npy"), mmap_mode="r")
+    rows = (schema["rows"], len(FEATURE_COLUMNS))
+    if features.shape != rows or len(labels) != len(features):
+        raise ValueError("Training set in %s is incomplete" % directory)
+    return features, np.asarray(schema["classes"])[labels], schema
@@ -0,0 +1,107 @@
+"""
+serve.py
+Starts the API with several worker processes
+Running `uvicorn api:app --workers N` directly makes every worker check, and possibly build, the models on its own.
+This program prepares the models once (see main.prepare_models), before any worker is started. Building is also guarded
+by a file lock (see registry.py), so workers started some other way never train at the same time either
+
+Where the system can fork (Linux, macOS), the models are also loaded once, in this process, and the workers are forked
+from it afterwards. The pages holding the Snips engine and the XGBoost booster are then shared copy-on-write by every
+worker, instead of each worker holding a copy of its own. A worker only gets its own copy of a version it swaps in later
+(see /models/reload), until it is restarted. Without fork, or with PRELOAD=0, uvicorn starts the workers itself and every
+one of them loads the models: memory use then grows by a full set of models for every worker
+
+The program is configured with environment variables:
+ -> WORKERS: number of worker processes, defaults to 1
+ -> HOST and PORT: address to listen on, default to 0.0.0.0 and 80
+ -> PRELOAD: load the models before forking the workers, defaults to 1
+ -> OMP_NUM_THREADS: threads used by XGBoost in each worker, defaults to the CPU count divided between the workers
+"""
+
+import gc
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import uvicorn
+
+import main
+import registry
+
+
+# Function to run the workers forked from this process, once the models are loaded in it
+def serve_preloaded(config: uvicorn.Config, workers: int) -> None:
+    """
+    Workers that exit while the server is not stopping are started again
+    Parameters required: uvicorn config of the workers, number of workers
+    Return data: None, once every worker stopped after SIGTERM or SIGINT
+    """
+    if registry.current_version() is None:
+        # Building opens the feature store and starts the threads of the executors, which the workers must not inherit,
+        # so the first version is built in a process of its own
+        builder = multiprocessing.get_context("spawn").Process(
+            target=main.prepare_models
+        )
+        builder.start()
+        builder.join()
+        if builder.exitcode != 0:
+            sys.exit("Could not build the models")
+    main.load_models()
+    # The API is imported before forking too, so the workers share it
+    config.load()
+    # Objects created so far are never collected, so the collector does not write to their pages in the workers and
+    # unshare them
+    gc.freeze()
+    sock = config.bind_socket()
+    children = set()
+    stopping = []
+
+    # Function to fork one worker
+    def start() -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        children.add(pid)
+
+    # Function to stop every worker
+    def stop(signum, frame) -> None:
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        start()
+    while children:
+        pid, _ = os.wait()
+        # The resource tracker of the build process is a child as well
+        if pid not in children:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print("Worker %d exited, starting another" % pid)
+            # Not restarting in a tight loop if the workers keep failing
+            time.sleep(1)
+            start()
+
+
+if __name__ == "__main__":
+    workers = int(os.environ.get("WORKERS", 1))
+    # Every worker predicts with its own XGBoost threads, so the cores are split between them instead of oversubscribed
+    # Set before the workers are started, as they inherit the environment
+    os.environ.setdefault(
+        "OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+    )
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", 80))
+    if workers > 1 and hasattr(os, "fork") and os.environ.get("PRELOAD", "1") == "1":
+        serve_preloaded(uvicorn.Config("api:app", host=host, port=port), workers)
+    else:
+        main.prepare_models()
+        uvicorn.run("api:app", host=host, port=port, workers=workers)
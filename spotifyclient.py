@@ -0,0 +1,404 @@
+"""
+spotifyclient.py
+Shared Spotify client for the server backend
+
+Creating a spotify client means reading creds.yaml, parsing it and exchanging the client credentials for an access token.
+Doing that for every call costs extra round trips and gets the token endpoint rate limited, so this module keeps one client
+per process and only fetches a new token shortly before the old one expires.
+
+Flow:
+ -> The first call to get_client() reads creds.yaml once and fetches a token
+ -> Later calls return the same client as long as the token is still valid
+ -> When the token is about to expire, exactly one caller refreshes it while the others wait for the new client
+ -> Every client created shares a single pooled HTTP session
+
+The API server uses AsyncSpotify instead, which makes the same calls with an async HTTP client, so the event loop is never
+blocked on spotify. It takes its token from the same manager, and limits the number of calls in flight at once.
+
+Both clients can be pointed at another server, such as the offline stand-in in tests/fakespotify.py, with the
+SPOTIFY_API_URL and SPOTIFY_ACCOUNTS_URL environment variables.
+
+Every call to the web API, from either client, first takes a token from the shared rate limiter in ratelimit.py, and a
+429 response pauses every caller until its Retry-After has passed. Token requests to the accounts service are not limited.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import httpx
+import requests
+import spotipy
+import spotipy.oauth2 as oauth2
+import yaml
+from requests.adapters import HTTPAdapter
+
+import admission
+import cache
+import metrics
+import ratelimit
+import resilience
+
+# Base URLs of the spotify web API and of the accounts service that hands out tokens
+API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+ACCOUNTS_URL = os.environ.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com/")
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that takes a token from the shared rate limiter before every call to the web API
+    Calls from spotipy go through it, so they share the rate with the async client
+    spotipy only retries calls on the sessions it builds itself, so calls answered with 429 or 5xx are retried here.
+    Every retry waits for the rate limiter again, which a 429 has paused for its Retry-After
+    Parameters required: priority of the calls, number of retries, seconds before the first retry after a 5xx
+        (doubling with every retry), and the arguments of HTTPAdapter
+    """
+
+    def __init__(
+        self,
+        priority: str = ratelimit.INTERACTIVE,
+        retries: int = 3,
+        backoff: float = 0.3,
+        **kwargs
+    ):
+        self.priority = priority
+        self.retries = retries
+        self.backoff = backoff
+        super().__init__(**kwargs)
+
+    # Function to send a request, waiting for the rate limiter first
+    def send(self, request, **kwargs):
+        if not request.url.startswith(API_URL):
+            return super().send(request, **kwargs)
+        limiter = ratelimit.get_limiter()
+        for attempt in range(self.retries + 1):
+            limiter.acquire_sync(self.priority)
+            response = super().send(request, **kwargs)
+            if response.status_code == 429:
+                limiter.throttled(retry_wait(response.headers, attempt))
+            elif response.status_code not in (500, 502, 503, 504):
+                return response
+            if attempt == self.retries:
+                break
+            response.close()
+            if response.status_code != 429:
+                time.sleep(self.backoff * 2**attempt)
+        return response
+
+
+class SpotifyClientManager:
+    """
+    Process wide holder of an authenticated Spotify client
+    Parameters required: path to the credentials file, seconds before expiry at which the token is refreshed,
+        size of the HTTP connection pool
+    """
+
+    def __init__(
+        self,
+        creds_path: str = "creds.yaml",
+        refresh_margin: int = 60,
+        pool_size: int = 20,
+    ):
+        self.creds_path = creds_path
+        self.refresh_margin = refresh_margin
+        # Lock so that only one thread fetches a new token at a time
+        self._lock = threading.Lock()
+        self._auth = None
+        self._token = None
+        self._client = None
+        self._expires_at = 0
+        # One pooled session shared by every client this manager creates
+        self.session = requests.Session()
+        adapter = ScheduledAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # Function to check if the current token can still be used
+    def _valid(self) -> bool:
+        return (
+            self._client is not None
+            and time.time() < self._expires_at - self.refresh_margin
+        )
+
+    # Function to create the auth object from the credentials file
+    def _load_auth(self) -> oauth2.SpotifyClientCredentials:
+        """
+        Reads creds.yaml and creates the client credentials auth object. Only called once per manager
+        Parameters required: None
+        Return data: spotipy.oauth2.SpotifyClientCredentials object
+        """
+        with open(self.creds_path) as file:
+            creds = yaml.safe_load(file)
+        auth = oauth2.SpotifyClientCredentials(
+            client_id=creds["spotify client id"],
+            client_secret=creds["spotify client secret"],
+            requests_session=self.session,
+        )
+        auth.OAUTH_TOKEN_URL = ACCOUNTS_URL + "api/token"
+        return auth
+
+    # Function to get a fresh token and build a client with it
+    def _refresh(self) -> None:
+        if self._auth is None:
+            self._auth = self._load_auth()
+        # Asking for the dict so the expiry time is known
+        with metrics.stage("token"):
+            token = self._auth.get_access_token(as_dict=True)
+        self._token = token["access_token"]
+        self._client = spotipy.Spotify(auth=self._token, requests_session=self.session)
+        self._client.prefix = API_URL
+        self._expires_at = token["expires_at"]
+
+    # Function to get the shared client
+    def get_client(self) -> spotipy.client.Spotify:
+        """
+        Returns the shared Spotify client, refreshing the token first if it is about to expire
+        Parameters required: None
+        Return data: Authenticated Spotify Object (spotipy.client.Spotify)
+        """
+        # Fast path, no locking needed while the token is valid
+        if self._valid():
+            return self._client
+        with self._lock:
+            # Another thread may have refreshed while this one was waiting
+            if not self._valid():
+                self._refresh()
+            return self._client
+
+    # Function to get the current access token
+    def get_token(self) -> str:
+        """
+        Returns the access token of the shared client, refreshing it first if it is about to expire
+        Parameters required: None
+        Return data: access token string
+        """
+        with self._lock:
+            if not self._valid():
+                self._refresh()
+            return self._token
+
+    # Function to get the current access token without waiting on the lock
+    def cached_token(self) -> str:
+        """
+        Used from the event loop, which must not wait while another thread refreshes the token
+        Parameters required: None
+        Return data: access token string, None if it has to be refreshed first
+        """
+        return self._token if self._valid() else None
+
+    # Function to drop the current token, so that the next call fetches a new one
+    def invalidate(self) -> None:
+        with self._lock:
+            self._client = None
+            self._expires_at = 0
+
+
+# Function to get the number of seconds to wait before retrying a rate limited call
+def retry_wait(headers: dict, attempt: int, longest: float = 30) -> float:
+    """
+    Spotify sends the wait in the Retry-After header. If it is missing, the wait doubles with every attempt
+    Parameters required: response headers, number of attempts already retried, longest wait allowed
+    Return data: seconds to wait
+    """
+    try:
+        wait = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        wait = 2**attempt
+    return min(max(wait, 0), longest)
+
+
+class AsyncSpotify:
+    """
+    Minimal async spotify client covering the calls made by the backend
+    Responses have the same shape as the matching spotipy calls, and errors are raised as spotipy SpotifyException
+    Every call waits for the shared rate limiter first. Calls answered with 429 pause the limiter for the number of
+    seconds given in the Retry-After header, and are retried once it lets them through
+    Reads of playlists, tracks and audio features are also hedged, retried after transient errors, and stopped by a
+    circuit breaker while spotify keeps failing (see resilience.py)
+    Parameters required: client manager to take tokens from, maximum number of calls in flight, timeout in seconds,
+        number of retries after a 429, longest wait in seconds before a retry,
+        priority of the calls (ratelimit.INTERACTIVE or ratelimit.BACKGROUND)
+    """
+
+    base_url = API_URL
+
+    def __init__(
+        self,
+        manager: SpotifyClientManager,
+        max_concurrency: int = 10,
+        timeout: float = 10,
+        max_retries: int = 3,
+        max_retry_wait: float = 30,
+        priority: str = ratelimit.INTERACTIVE,
+    ):
+        self.manager = manager
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+        self.priority = priority
+        # Hedging, retries and circuit breaker of the reads (playlists, tracks and audio features)
+        self.resilient = resilience.ResilientCaller()
+        # Both are created on first use, inside the event loop that uses them
+        self._http = None
+        self._semaphore = None
+
+    # Function to send a GET request to the spotify web API
+    async def _get(self, url: str, params: dict = None, endpoint: str = "next") -> dict:
+        """
+        Parameters required: path or full url, query parameters, and name of the endpoint used in the metrics
+        Return data: decoded JSON response
+        """
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Refreshing a token is a blocking call, and so is waiting for another thread refreshing it,
+        # so both are done outside the event loop
+        token = self.manager.cached_token()
+        if token is None:
+            token = await asyncio.get_running_loop().run_in_executor(
+                None, self.manager.get_token
+            )
+        if not url.startswith("http"):
+            url = self.base_url + url
+        limiter = ratelimit.get_limiter()
+        for attempt in range(self.max_retries + 1):
+            # Waiting for the rate limiter before the semaphore, so no slot is held while waiting
+            # Both waits end at the deadline of the request being served, if it has one
+            await admission.within(limiter.acquire(self.priority))
+            async with self._semaphore:
+                with metrics.stage("spotify_" + endpoint):
+                    response = await admission.within(
+                        self._http.get(
+                            url,
+                            params=params,
+                            headers={"Authorization": "Bearer " + token},
+                        )
+                    )
+            metrics.count(
+                "cadence_spotify_requests_total",
+                endpoint=endpoint,
+                status=response.status_code,
+            )
+            if response.status_code != 429:
+                break
+            metrics.count("cadence_spotify_throttled_total", endpoint=endpoint)
+            # Pausing every caller, a retry then waits for the limiter like any other call
+            await limiter.throttled_async(
+                retry_wait(response.headers, attempt, self.max_retry_wait)
+            )
+            if attempt == self.max_retries:
+                break
+            metrics.count("cadence_spotify_retries_total", endpoint=endpoint)
+        if response.status_code >= 400:
+            try:
+                message = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = "error"
+            raise spotipy.exceptions.SpotifyException(
+                response.status_code,
+                -1,
+                "%s:\n %s" % (response.url, message),
+                headers=response.headers,
+            )
+        return response.json()
+
+    # Function to get one page of a playlist's items
+    async def playlist_items(
+        self, playlist_id: str, limit: int = 100, offset: int = 0
+    ) -> dict:
+        return await self.resilient.call(
+            "playlist_items",
+            lambda: self._get(
+                "playlists/%s/tracks" % cache.track_key(playlist_id),
+                {"limit": limit, "offset": offset, "additional_types": "track"},
+                "playlist_items",
+            ),
+        )
+
+    # Function to get details of a playlist, optionally only some fields of it
+    async def playlist(self, playlist_id: str, fields: str = None) -> dict:
+        params = {"fields": fields} if fields else None
+        return await self.resilient.call(
+            "playlist",
+            lambda: self._get(
+                "playlists/%s" % cache.track_key(playlist_id), params, "playlist"
+            ),
+        )
+
+    # Function to get the page after a given page
+    async def next(self, result: dict) -> dict:
+        return await self._get(result["next"]) if result["next"] else None
+
+    # Function to get details of up to 50 tracks
+    async def tracks(self, track_ids: list) -> dict:
+        params = {"ids": ",".join(cache.track_key(i) for i in track_ids)}
+        return await self.resilient.call(
+            "tracks", lambda: self._get("tracks", params, "tracks")
+        )
+
+    # Function to get audio features of up to 100 tracks
+    async def audio_features(self, track_ids: list) -> list:
+        params = {"ids": ",".join(cache.track_key(i) for i in track_ids)}
+        result = await self.resilient.call(
+            "audio_features",
+            lambda: self._get("audio-features", params, "audio_features"),
+        )
+        return result["audio_features"]
+
+    # Function to close the HTTP client
+    async def close(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+# Manager and async client used by the whole process, created on first use
+_manager = None
+_manager_lock = threading.Lock()
+_async_client = None
+
+
+# Function to get the process wide client manager
+def get_manager() -> SpotifyClientManager:
+    """
+    Returns the process wide SpotifyClientManager, creating it on the first call
+    Parameters required: None
+    Return data: SpotifyClientManager object
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = SpotifyClientManager()
+    return _manager
+
+
+# Function to get the shared client from the process wide manager
+def get_client() -> spotipy.client.Spotify:
+    """
+    Shortcut for get_manager().get_client()
+    Parameters required: None
+    Return data: Authenticated Spotify Object (spotipy.client.Spotify)
+    """
+    return get_manager().get_client()
+
+
+# Function to get the process wide async client
+def get_async_client() -> AsyncSpotify:
+    """
+    Returns the process wide AsyncSpotify, creating it on the first call
+    The number of spotify calls in flight can be set with the SPOTIFY_CONCURRENCY environment variable
+    Parameters required: None
+    Return data: AsyncSpotify object
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncSpotify(
+            get_manager(), int(os.environ.get("SPOTIFY_CONCURRENCY", 10))
+        )
+    return _async_client
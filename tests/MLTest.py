@@ -1,4 +1,6 @@
+import os
 import pickle
+import sys
 
 import numpy as np
 import pandas as pd
@@ -9,31 +11,15 @@ from sklearn.metrics import accuracy_score
 from sklearn.model_selection import train_test_split
 from xgboost import XGBClassifier
 
-data = pd.read_csv("dataset.csv")
-data = data.drop("Unnamed: 0", axis=1)
-
-print(data.columns)
-columns_to_be_dropped = [
-    "type",
-    "id",
-    "uri",
-    "track_href",
-    "analysis_url",
-    "Artist",
-    "Name",
-    "Popularity",
-    "duration_ms",
-]
-for i in columns_to_be_dropped:
-    if i in data.columns:
-        data = data.drop(i, axis=1)
-print(data.columns)
-
-# data = data[(data['Tag'] != 'Travel') & (data['Tag'] != 'Meetings')]
-print(data["Tag"].unique())
-
-Y = data["Tag"]
-X = data.drop("Tag", axis=1)
+# Run from the root directory of the project, so the training set and schema module are found
+sys.path.insert(0, os.getcwd())
+import schema
+
+# Loading the binary training set saved by create_dataset, features are already in model order
+features, Y, training_schema = schema.load_training_set()
+X = pd.DataFrame(features, columns=schema.FEATURE_COLUMNS, copy=False)
+print(X.columns)
+print(training_schema["classes"])
 
 X_train, X_test, y_train, y_test = train_test_split(
     X, Y, test_size=0.25, random_state=2
@@ -82,11 +68,7 @@ def songpred(model, X, Y):
     token = auth.get_access_token(as_dict=False)
     # Create spotify object
     spotify = spotipy.Spotify(auth=token)
-    song_x = pd.DataFrame(spotify.audio_features([song_url]))
-    keys = list(song_x.keys())
-    for i in keys:
-        if i in columns_to_be_dropped:
-            del song_x[i]
+    song_x = pd.DataFrame(spotify.audio_features([song_url]))[schema.FEATURE_COLUMNS]
     y_pred = model.predict(song_x)
 
     y_pred2 = model.predict_proba(song_x)
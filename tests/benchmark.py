@@ -0,0 +1,198 @@
+"""
+Standalone end to end benchmark of the API, run against the offline spotify stand-in in tests/fakespotify.py
+No credentials or network access are needed: the models are trained on playlists served by the stand-in, in a temporary
+directory, so the models, training set and caches of the project are never touched
+
+For every playlist size, requests are sent to POST /playlist at a fixed concurrency in two rounds:
+ -> cold: every request asks for another playlist with songs never seen before, so every stage runs in full
+ -> warm: every request asks for the same playlist, so the playlist and prediction caches answer
+Every round reports p50/p95/p99 latency, throughput, spotify calls per request, hedged and retried spotify calls
+(see resilience.py), and the mean time spent in every stage of the pipeline per request (see metrics.py)
+
+Run from anywhere: python tests/benchmark.py --sizes 10,100,1000,10000 --requests 20 --concurrency 4 --latency 0.02
+Give --json to also save the results, so runs can be compared
+Tail latency can be injected with --slow 0.02 --slow-delay 1, and server errors with --errors 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+sys.path.insert(0, os.path.join(PROJECT, "tests"))
+import fakespotify
+
+parser = argparse.ArgumentParser(description="End to end benchmark of the API")
+parser.add_argument("--sizes", default="10,100,1000,10000")
+parser.add_argument("--requests", type=int, default=20)
+parser.add_argument("--concurrency", type=int, default=4)
+parser.add_argument("--latency", type=float, default=0.02)
+parser.add_argument("--jitter", type=float, default=0.01)
+parser.add_argument("--throttle", type=float, default=0.0)
+parser.add_argument("--errors", type=float, default=0.0)
+parser.add_argument("--slow", type=float, default=0.0)
+parser.add_argument("--slow-delay", type=float, default=1.0)
+parser.add_argument("--json", default=None)
+args = parser.parse_args()
+json_path = os.path.abspath(args.json) if args.json else None
+
+# Starting the stand-in and pointing the backend at it, before spotifyclient is imported
+fake = fakespotify.FakeSpotify(
+    args.latency, args.jitter, throttle=args.throttle, slow_delay=args.slow_delay
+)
+url = fakespotify.start_server(fake)
+os.environ["SPOTIFY_API_URL"] = url + "v1/"
+os.environ["SPOTIFY_ACCOUNTS_URL"] = url
+# The stand-in has no rate limit of its own, so the backend is not held to the defaults meant for spotify
+os.environ.setdefault("SPOTIFY_RATE", "1000")
+os.environ.setdefault("SPOTIFY_BURST", "1000")
+
+# Working in a temporary directory, with the NLU training files and a credentials file
+directory = tempfile.mkdtemp(prefix="cadence-benchmark-")
+shutil.copytree(
+    os.path.join(PROJECT, "nlputrain"), os.path.join(directory, "nlputrain")
+)
+shutil.copy(
+    os.path.join(PROJECT, "tests", "sample_creds.yaml"),
+    os.path.join(directory, "creds.yaml"),
+)
+os.chdir(directory)
+
+import httpx
+
+import api
+import main
+import metrics
+import spotifyclient
+
+PROMPTS = ["gym time", "help me sleep", "study session", "morning yoga", "wake me up"]
+
+start = time.perf_counter()
+main.load_models()
+print(
+    "Models built and loaded in %.1f s, version %s"
+    % (time.perf_counter() - start, main.model_version())
+)
+# Slow and failing calls only start now, so the models are always built
+fake.errors, fake.slow = args.errors, args.slow
+
+
+# Function to count the calls the stand-in answered, leaving out its counts of throttled, failed and slow calls
+def spotify_calls() -> int:
+    return sum(
+        count
+        for endpoint, count in fake.calls.items()
+        if endpoint not in ("throttled", "failed", "slow")
+    )
+
+
+# Function to send requests at a fixed concurrency
+async def run_round(client: httpx.AsyncClient, playlists: list) -> dict:
+    """
+    Parameters required: client of the API, playlist of every request
+    Return data: dictionary of results of the round
+    """
+    queue = list(enumerate(playlists))
+    latencies = []
+    errors = 0
+    calls = spotify_calls()
+    resilient = spotifyclient.get_async_client().resilient.stats()
+    stages = metrics.stage_totals()
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            number, playlist = queue.pop(0)
+            sent = time.perf_counter()
+            response = await client.post(
+                "/playlist",
+                json={"prompt": PROMPTS[number % len(PROMPTS)], "playlist": playlist},
+            )
+            latencies.append(time.perf_counter() - sent)
+            if response.status_code != 200 or "error" in response.json():
+                errors += 1
+
+    began = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - began
+    after = metrics.stage_totals()
+    resilient_after = spotifyclient.get_async_client().resilient.stats()
+    return {
+        "requests": len(playlists),
+        "errors": errors,
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p95_ms": float(np.percentile(latencies, 95) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "throughput_rps": len(playlists) / elapsed,
+        "spotify_calls_per_request": (spotify_calls() - calls) / len(playlists),
+        "hedged": resilient_after["hedged"] - resilient["hedged"],
+        "hedge_won": resilient_after["hedge_won"] - resilient["hedge_won"],
+        "retried": resilient_after["retried"] - resilient["retried"],
+        "stage_ms_per_request": {
+            name: (seconds - stages.get(name, (0, 0.0))[1]) * 1e3 / len(playlists)
+            for name, (count, seconds) in sorted(after.items())
+            if count != stages.get(name, (0, 0.0))[0]
+        },
+    }
+
+
+# Function to run every round
+async def run() -> list:
+    # The lifespan of the API is not run by the transport, the models are already loaded
+    api.app.state.models_loaded = asyncio.Event()
+    api.app.state.models_loaded.set()
+    api.app.state.load_failed = False
+    results = []
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://cadence", timeout=600
+    ) as client:
+        for size in [int(i) for i in args.sizes.split(",")]:
+            cold = ["p%dxc%d" % (size, i) for i in range(args.requests)]
+            warm = ["p%dxw" % size] * args.requests
+            for name, playlists in [("cold", cold), ("warm", warm)]:
+                result = await run_round(client, playlists)
+                result.update({"size": size, "round": name})
+                results.append(result)
+                print(
+                    "%6d songs %-4s | p50 %8.1f ms | p95 %8.1f ms | p99 %8.1f ms | %6.2f req/s | "
+                    "%6.1f spotify calls/req | %d errors | %d hedged, %d won, %d retried"
+                    % (
+                        size,
+                        name,
+                        result["p50_ms"],
+                        result["p95_ms"],
+                        result["p99_ms"],
+                        result["throughput_rps"],
+                        result["spotify_calls_per_request"],
+                        result["errors"],
+                        result["hedged"],
+                        result["hedge_won"],
+                        result["retried"],
+                    )
+                )
+                print(
+                    "             stages ms/req: "
+                    + ", ".join(
+                        "%s %.1f" % i for i in result["stage_ms_per_request"].items()
+                    )
+                )
+    return results
+
+
+results = asyncio.run(run())
+if json_path:
+    with open(json_path, "w") as file:
+        json.dump(
+            {"settings": vars(args), "results": results}, file, indent=2, default=str
+        )
+    print("Saved results to " + json_path)
+shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,65 @@
+"""
+Shared fixtures of the pytest cases in this directory
+Run from the root directory of the project: python -m pytest -q tests
+The spotify calls are answered by the stand-in server of fakespotify.py, so no credentials or network are needed
+"""
+
+import os
+import sys
+
+import pytest
+
+# The modules under test live in the root directory of the project
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import fakespotify
+import ratelimit
+import spotifyclient
+
+
+# Function to start one stand-in spotify server for the whole test session
+@pytest.fixture(scope="session")
+def fake_server():
+    """
+    Return data: tuple of (FakeSpotify object, base url of the server)
+    """
+    fake = fakespotify.FakeSpotify()
+    return fake, fakespotify.start_server(fake)
+
+
+# Function to give every test its own rate limiter and admission gate
+@pytest.fixture(autouse=True)
+def fresh_limits(tmp_path, monkeypatch):
+    """
+    The process wide limiter and gate keep state between calls, so a test never sees what another one left behind
+    The limiter is loose enough that it never holds a call back
+    """
+    monkeypatch.setattr(
+        ratelimit,
+        "_limiter",
+        ratelimit.RateLimiter(str(tmp_path / "rate.json"), 1000, 1000, 0),
+    )
+    monkeypatch.setattr(admission, "_gate", admission.Gate())
+
+
+# Function to get an async client pointed at the stand-in server
+@pytest.fixture
+def fake_client(fake_server, tmp_path, monkeypatch):
+    """
+    The stand-in answers every call normally unless the test changes its errors, throttle or slow settings,
+    which are put back afterwards
+    Return data: tuple of (FakeSpotify object, AsyncSpotify object)
+    """
+    fake, url = fake_server
+    # spotipy caches the token in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(spotifyclient, "ACCOUNTS_URL", url)
+    for setting in ("errors", "throttle", "slow"):
+        monkeypatch.setattr(fake, setting, 0.0)
+    creds = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "sample_creds.yaml"
+    )
+    client = spotifyclient.AsyncSpotify(spotifyclient.SpotifyClientManager(creds))
+    client.base_url = url + "v1/"
+    return fake, client
@@ -0,0 +1,307 @@
+"""
+Offline stand-in for the parts of the spotify web API used by the backend
+Serves synthetic playlists, tracks and audio features, optionally mixed with recorded ones, with configurable latency,
+page size, injected 429 and 500 responses, and injected slow calls. Nothing is sent to spotify, and no credentials are
+needed
+
+Synthetic playlists:
+ -> A playlist ID of the form p<size>x<seed> (for example p1000x3) has <size> songs, every other ID has DEFAULT_SIZE
+ -> Songs of a playlist get their own IDs, and their features are random but the same on every run
+Recorded data is a JSON file in the form:
+    {
+        "playlists": {"playlist id": ["track id", ...]},
+        "tracks": {"track id": {"name": "..", "artist": "..", "popularity": 0}},
+        "features": {"track id": {"danceability": 0.5, ...}}
+    }
+
+Run as a server: python tests/fakespotify.py --port 8001 --latency 0.02 --throttle 0.01
+and point the backend at it:
+    SPOTIFY_API_URL=http://127.0.0.1:8001/v1/ SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8001/ python serve.py
+creds.yaml still has to exist, but its client id and secret are not checked
+tests/benchmark.py starts it in a thread with start_server
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Number of songs of a playlist whose ID does not give its size
+DEFAULT_SIZE = 200
+# Largest number of IDs spotify accepts in one call
+TRACKS_LIMIT = 50
+FEATURES_LIMIT = 100
+
+
+class FakeSpotify:
+    """
+    Data and behaviour of the stand-in
+    Parameters required: seconds added to every call, random extra seconds on top, largest page of playlist items,
+        share of calls answered with 429, Retry-After sent with them, path of a recorded data file,
+        share of calls answered with 500, share of calls that are slow, and seconds a slow call takes on top
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        page_limit: int = 100,
+        throttle: float = 0.0,
+        retry_after: float = 0.05,
+        recorded: str = None,
+        errors: float = 0.0,
+        slow: float = 0.0,
+        slow_delay: float = 1.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_limit = page_limit
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.errors = errors
+        self.slow = slow
+        self.slow_delay = slow_delay
+        self.recorded = {"playlists": {}, "tracks": {}, "features": {}}
+        if recorded is not None:
+            with open(recorded) as file:
+                self.recorded.update(json.load(file))
+        # Snapshot of every playlist, changed with change_playlist
+        self.snapshots = {}
+        self.calls = {}
+        self._random = random.Random(0)
+
+    # Function to wait like a remote call would, and pick calls to throttle or fail
+    async def delay(self, endpoint: str) -> int:
+        """
+        Parameters required: name of the endpoint called
+        Return data: status the call must be answered with instead of its data (429 or 500), None to answer it
+        """
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        wait = self.latency + self._random.random() * self.jitter
+        if self.slow and self._random.random() < self.slow:
+            self.calls["slow"] = self.calls.get("slow", 0) + 1
+            wait += self.slow_delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.throttle and self._random.random() < self.throttle:
+            self.calls["throttled"] = self.calls.get("throttled", 0) + 1
+            return 429
+        if self.errors and self._random.random() < self.errors:
+            self.calls["failed"] = self.calls.get("failed", 0) + 1
+            return 500
+        return None
+
+    # Function to get the track IDs of a playlist
+    def playlist_tracks(self, playlist_id: str) -> list:
+        if playlist_id in self.recorded["playlists"]:
+            return self.recorded["playlists"][playlist_id]
+        match = re.fullmatch(r"p(\d+)x\w+", playlist_id)
+        size = int(match.group(1)) if match else DEFAULT_SIZE
+        return ["%st%d" % (playlist_id, i) for i in range(size)]
+
+    # Function to get the snapshot_id of a playlist
+    def snapshot(self, playlist_id: str) -> str:
+        return self.snapshots.get(playlist_id, "snapshot-" + playlist_id)
+
+    # Function to give a playlist a new snapshot_id, as if its songs had changed
+    def change_playlist(self, playlist_id: str) -> None:
+        self.snapshots[playlist_id] = "snapshot-%s-%f" % (playlist_id, time.time())
+
+    # Function to get the track object of a song
+    def track(self, track_id: str) -> dict:
+        record = self.recorded["tracks"].get(track_id)
+        if record is None:
+            generator = random.Random("track" + track_id)
+            record = {
+                "name": "Song " + track_id,
+                "artist": "Artist %d" % generator.randint(0, 500),
+                "popularity": generator.randint(0, 100),
+            }
+        return {
+            "id": track_id,
+            "type": "track",
+            "uri": "spotify:track:" + track_id,
+            "name": record["name"],
+            "artists": [{"name": record["artist"]}],
+            "popularity": record["popularity"],
+        }
+
+    # Function to get the audio features of a song
+    def features(self, track_id: str) -> dict:
+        record = self.recorded["features"].get(track_id)
+        if record is None:
+            generator = random.Random("features" + track_id)
+            record = {
+                name: generator.random()
+                for name in [
+                    "danceability",
+                    "energy",
+                    "speechiness",
+                    "acousticness",
+                    "instrumentalness",
+                    "liveness",
+                    "valence",
+                ]
+            }
+            record.update(
+                {
+                    "key": generator.randint(0, 11),
+                    "loudness": -30 + generator.random() * 30,
+                    "mode": generator.randint(0, 1),
+                    "tempo": 60 + generator.random() * 120,
+                    "time_signature": generator.choice([3, 4, 4, 4, 5]),
+                    "duration_ms": generator.randint(120000, 360000),
+                }
+            )
+        features = dict(record)
+        features.update(
+            {
+                "id": track_id,
+                "type": "audio_features",
+                "uri": "spotify:track:" + track_id,
+                "track_href": "",
+                "analysis_url": "",
+            }
+        )
+        return features
+
+
+# Function to answer a call with 429 or 500
+def throttled(fake: FakeSpotify, status: int) -> JSONResponse:
+    if status == 500:
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"status": 500, "message": "Server error"}},
+        )
+    return JSONResponse(
+        status_code=429,
+        content={"error": {"status": 429, "message": "API rate limit exceeded"}},
+        headers={"Retry-After": str(fake.retry_after)},
+    )
+
+
+# Function to answer a call with a bad request error
+def bad_request(message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=400, content={"error": {"status": 400, "message": message}}
+    )
+
+
+# Function to create the FastAPI app serving a FakeSpotify
+def create_app(fake: FakeSpotify) -> FastAPI:
+    app = FastAPI(title="Fake Spotify")
+
+    @app.post("/api/token")
+    async def token():
+        return {"access_token": "fake", "token_type": "Bearer", "expires_in": 3600}
+
+    @app.get("/v1/playlists/{playlist_id}")
+    async def playlist(playlist_id: str):
+        status = await fake.delay("playlist")
+        if status:
+            return throttled(fake, status)
+        return {"id": playlist_id, "snapshot_id": fake.snapshot(playlist_id)}
+
+    @app.get("/v1/playlists/{playlist_id}/tracks")
+    async def playlist_items(
+        request: Request, playlist_id: str, limit: int = 100, offset: int = 0
+    ):
+        status = await fake.delay("playlist_items")
+        if status:
+            return throttled(fake, status)
+        limit = min(limit, fake.page_limit)
+        tracks = fake.playlist_tracks(playlist_id)
+        following = None
+        if offset + limit < len(tracks):
+            following = str(
+                request.url.include_query_params(limit=limit, offset=offset + limit)
+            )
+        return {
+            "items": [
+                {"track": fake.track(i)} for i in tracks[offset : offset + limit]
+            ],
+            "total": len(tracks),
+            "limit": limit,
+            "offset": offset,
+            "next": following,
+        }
+
+    @app.get("/v1/tracks")
+    async def tracks(ids: str):
+        status = await fake.delay("tracks")
+        if status:
+            return throttled(fake, status)
+        ids = ids.split(",")
+        if len(ids) > TRACKS_LIMIT:
+            return bad_request("Too many ids requested")
+        return {"tracks": [fake.track(i) for i in ids]}
+
+    @app.get("/v1/audio-features")
+    async def audio_features(ids: str):
+        status = await fake.delay("audio_features")
+        if status:
+            return throttled(fake, status)
+        ids = ids.split(",")
+        if len(ids) > FEATURES_LIMIT:
+            return bad_request("Too many ids requested")
+        return {"audio_features": [fake.features(i) for i in ids]}
+
+    return app
+
+
+# Function to serve a FakeSpotify from a background thread
+def start_server(fake: FakeSpotify, port: int = 0) -> str:
+    """
+    Parameters required: FakeSpotify object, port to listen on (0 picks a free one)
+    Return data: base url of the server, once it accepts connections
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    server = uvicorn.Server(
+        uvicorn.Config(create_app(fake), log_level="warning", access_log=False)
+    )
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return "http://127.0.0.1:%d/" % sock.getsockname()[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--page-limit", type=int, default=100)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.05)
+    parser.add_argument("--recorded", default=None)
+    parser.add_argument("--errors", type=float, default=0.0)
+    parser.add_argument("--slow", type=float, default=0.0)
+    parser.add_argument("--slow-delay", type=float, default=1.0)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(
+            FakeSpotify(
+                args.latency,
+                args.jitter,
+                args.page_limit,
+                args.throttle,
+                args.retry_after,
+                args.recorded,
+                args.errors,
+                args.slow,
+                args.slow_delay,
+            )
+        ),
+        host="127.0.0.1",
+        port=args.port,
+    )
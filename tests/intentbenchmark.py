@@ -0,0 +1,108 @@
+"""
+Standalone program to compare the two paths that can detect the intent of a prompt
+ - Lexicon: keyword and phrase lookup built from the nlputrain yaml files of the version (lexicon.py)
+ - Snips: full SnipsNLUEngine.parse, including builtin entity extraction
+Every utterance in the training files, and a few extra prompts, is run through both paths
+For every prompt the lexicon answers, it checks that Snips detects the same intent
+The training utterances are the ones the lexicon was built from, so held out prompts with a known intent are checked as
+well: any of them the lexicon answers wrongly is reported as a misroute
+Reports the share of prompts the lexicon answers, how often it agrees with Snips, and the mean latency of each path
+Both are loaded from the version of the models in use in the registry (registry.py)
+Run from the root directory of the project, after a version has been promoted: python tests/intentbenchmark.py
+"""
+import os
+import re
+import sys
+import time
+
+import yaml
+
+sys.path.insert(0, os.getcwd())
+import registry
+
+version = registry.current_version()
+if version is None:
+    sys.exit(
+        "No model version has been promoted yet, start the server once to train one"
+    )
+models = registry.load_version(version)
+training = os.path.join(registry.version_path(version), registry.TRAINING_DIR)
+if not os.path.isdir(training):
+    # Version saved before the training files were kept with it
+    training = registry.TRAINING_DIR
+
+# Held out prompts not present in the training files, with the intent they mean. The lexicon must answer these
+# correctly or leave them to Snips, a wrong answer skips Snips entirely
+held_out = [
+    ("Gym time", "gym"),
+    ("Sleep", "sleep"),
+    ("study", "study"),
+    ("Time to sleep", "sleep"),
+    ("yoga at 6", "yoga"),
+    ("Go for a jog at 6 am", "gym"),
+    ("remind me to call the maid", "reminder"),
+    ("going to the airport", "travel"),
+    ("finish the chemistry chapter", "study"),
+    ("wake me up", "sleep"),
+    ("Wake up for the flight", "travel"),
+    ("call mom", "reminder"),
+    ("go for a walk", "gym"),
+    ("have lunch with Ananya", "reminder"),
+    ("morning stretches", "yoga"),
+    ("revise for the history test", "study"),
+    ("bus to the office", "travel"),
+    ("nap after lunch", "sleep"),
+]
+extra = [i[0] for i in held_out] + ["party"]
+# Collecting every utterance of the training files, without slot annotations
+prompts = list(extra)
+for name in os.listdir(training):
+    with open(os.path.join(training, name)) as file:
+        for document in yaml.safe_load_all(file):
+            if document and document.get("type") == "intent":
+                prompts.extend(
+                    re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"\2", i)
+                    for i in document["utterances"]
+                )
+
+engine = models.nlu
+fast = models.lexicon
+rounds = 20
+
+start = time.perf_counter()
+for _ in range(rounds):
+    fast_results = [fast.classify(i) for i in prompts]
+fast_time = (time.perf_counter() - start) / (rounds * len(prompts))
+
+start = time.perf_counter()
+for _ in range(rounds):
+    snips_results = [engine.parse(i)["intent"]["intentName"] for i in prompts]
+snips_time = (time.perf_counter() - start) / (rounds * len(prompts))
+
+answered = [(i, j, k) for i, j, k in zip(prompts, fast_results, snips_results) if j]
+agreed = [i for i in answered if i[1] == i[2]]
+print("Model version: %s" % version)
+print("Prompts: %d" % len(prompts))
+print(
+    "Answered by lexicon: %d (%.1f%%)"
+    % (len(answered), 100.0 * len(answered) / len(prompts))
+)
+print("Agreement with snips: %d of %d" % (len(agreed), len(answered)))
+print("Lexicon mean latency: %.1f us" % (fast_time * 1e6))
+print("Snips mean latency: %.1f us" % (snips_time * 1e6))
+for prompt, fast_intent, snips_intent in answered:
+    if fast_intent != snips_intent:
+        print(
+            "Disagreement: %r lexicon=%s snips=%s" % (prompt, fast_intent, snips_intent)
+        )
+expected = dict(held_out)
+checked = [i for i in answered if i[0] in expected]
+misroutes = [i for i in checked if i[1] != expected[i[0]]]
+print(
+    "Held out prompts answered by lexicon: %d of %d, misrouted: %d"
+    % (len(checked), len(held_out), len(misroutes))
+)
+for prompt, fast_intent, snips_intent in misroutes:
+    print(
+        "Misroute: %r lexicon=%s expected=%s" % (prompt, fast_intent, expected[prompt])
+    )
@@ -0,0 +1,73 @@
+"""
+Standalone program to compare the pickled XGBClassifier with the native booster format used by modelstore.py
+ - Cold start: time to load the model from disk
+ - Predict latency: time of one predict_proba call, for batches of different sizes
+A model is trained on the saved training set (see schema.py) and saved in both formats in a temporary directory,
+so the comparison does not touch MLModel.json or MLModel.pickle
+Run from the root directory of the project, after the training set has been created: python tests/modelbenchmark.py
+"""
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import numpy as np
+from xgboost import XGBClassifier
+
+sys.path.insert(0, os.getcwd())
+import modelstore
+import schema
+
+
+# Function to get the fastest time of a number of runs
+def best_time(function, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+X, Y, training_schema = schema.load_training_set()
+model = XGBClassifier()
+model.fit(X, Y)
+directory = tempfile.mkdtemp()
+pickle_path = os.path.join(directory, "MLModel.pickle")
+with open(pickle_path, "wb") as handle:
+    pickle.dump(model, handle, protocol=pickle.HIGHEST_PROTOCOL)
+native_path = os.path.join(directory, "MLModel.json")
+meta_path = os.path.join(directory, "MLModel.meta.json")
+modelstore.save_model(
+    model, training_schema, schema.training_set_hash(), native_path, meta_path
+)
+
+
+# Function to load the pickled model
+def load_pickle():
+    with open(pickle_path, "rb") as handle:
+        return pickle.load(handle)
+
+
+pickled = load_pickle()
+native = modelstore.load_model(native_path, meta_path)
+print("Cold start, pickle: %.2f ms" % (best_time(load_pickle, 10) * 1e3))
+print(
+    "Cold start, native: %.2f ms"
+    % (best_time(lambda: modelstore.load_model(native_path, meta_path), 10) * 1e3)
+)
+
+rng = np.random.default_rng(0)
+for size in [1, 10, 100, 1000, 10000]:
+    batch = np.ascontiguousarray(X[rng.integers(0, len(X), size)], dtype=np.float32)
+    # Both paths must give the same probabilities
+    assert np.allclose(
+        pickled.predict_proba(batch), native.predict_proba(batch), atol=1e-6
+    )
+    pickle_time = best_time(lambda: pickled.predict_proba(batch), 20)
+    native_time = best_time(lambda: native.predict_proba(batch), 20)
+    print(
+        "Batch of %5d songs, pickle: %8.3f ms, native: %8.3f ms"
+        % (size, pickle_time * 1e3, native_time * 1e3)
+    )
@@ -0,0 +1,139 @@
+"""
+pytest cases of admission.py: bounded queue, deadlines, and the 503 answers of the API
+"""
+
+import asyncio
+
+import pytest
+
+import admission
+import cache
+
+
+def test_request_is_rejected_when_slots_and_queue_are_full():
+    gate = admission.Gate(limit=1, queue=0, wait=1)
+
+    async def run():
+        async with gate.admit():
+            with pytest.raises(admission.Rejected) as rejected:
+                async with gate.admit():
+                    pass
+        return rejected.value
+
+    error = asyncio.run(run())
+    assert error.retry_after >= 1
+    assert gate.stats()["rejected"] == 1
+    assert gate.stats()["in_flight"] == 0
+
+
+def test_queued_request_is_rejected_after_the_queue_wait():
+    gate = admission.Gate(limit=1, queue=1, wait=0.05)
+
+    async def run():
+        async with gate.admit():
+            with pytest.raises(admission.Rejected):
+                async with gate.admit():
+                    pass
+
+    asyncio.run(run())
+    assert gate.stats()["timed_out"] == 1
+    assert gate.stats()["waiting"] == 0
+
+
+def test_queued_request_gets_the_slot_that_frees_up():
+    gate = admission.Gate(limit=1, queue=1, wait=1)
+    order = []
+
+    async def serve(name: str, seconds: float):
+        async with gate.admit():
+            order.append(name)
+            await asyncio.sleep(seconds)
+
+    async def run():
+        await asyncio.gather(serve("first", 0.05), serve("second", 0))
+
+    asyncio.run(run())
+    assert order == ["first", "second"]
+    assert gate.stats()["admitted"] == 2
+
+
+def test_work_stops_at_the_deadline():
+    async def run():
+        admission.start_deadline(0.05)
+        with pytest.raises(admission.DeadlineExceeded):
+            await admission.within(asyncio.sleep(1))
+        with pytest.raises(admission.DeadlineExceeded):
+            admission.check()
+
+    asyncio.run(run())
+
+
+def test_deadline_is_carried_into_tasks_only():
+    async def run():
+        admission.start_deadline(10)
+        inside = await asyncio.ensure_future(asyncio.sleep(0, admission.remaining()))
+        return inside
+
+    assert 0 < asyncio.run(run()) <= 10
+    # asyncio.run gives the request its own context, nothing is left outside of it
+    assert admission.remaining() is None
+
+
+def test_too_many_tracks_are_refused():
+    admission.check_tracks(10, limit=10)
+    with pytest.raises(admission.TooManyTracks):
+        admission.check_tracks(11, limit=10)
+
+
+def test_api_answers_503_with_retry_after_when_overloaded(monkeypatch):
+    # The API loads the NLU engine when imported
+    pytest.importorskip("snips_nlu")
+    import httpx
+
+    import api
+
+    gate = admission.Gate(limit=1, queue=0, wait=1)
+    monkeypatch.setattr(admission, "_gate", gate)
+
+    async def run():
+        api.app.state.models_loaded = asyncio.Event()
+        api.app.state.models_loaded.set()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            # Holding the only slot, as a request being served would
+            async with gate.admit():
+                return await c.post("/", json={"prompt": "gym", "songlist": "a;"})
+
+    response = asyncio.run(run())
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_shared_job_is_not_cut_short_by_the_deadline_of_its_first_caller():
+    flight = cache.SingleFlight(60, 8)
+    seen = {}
+
+    async def job():
+        seen["deadline"] = admission.remaining()
+        for _ in range(5):
+            admission.check()
+            await asyncio.sleep(0.1)
+        return 42
+
+    async def caller(seconds: float, delay: float):
+        admission.start_deadline(seconds)
+        await asyncio.sleep(delay)
+        return await admission.within(flight.start("playlist", job)[0])
+
+    async def run():
+        # Every caller runs in a task of its own, with a context and deadline of its own
+        return await asyncio.gather(
+            caller(0.3, 0), caller(10, 0.05), return_exceptions=True
+        )
+
+    first, joined = asyncio.run(run())
+    assert isinstance(first, admission.DeadlineExceeded)
+    assert joined == 42
+    # The job did not see the deadline of the caller that started it
+    assert seen["deadline"] is None
+    assert flight.stats()["abandoned"] == 0
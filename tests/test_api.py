@@ -0,0 +1,53 @@
+"""
+pytest cases of the endpoints of api.py that answer without any Spotify call
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+# The API loads the NLU engine when imported
+pytest.importorskip("snips_nlu")
+import admission
+import api
+
+
+# Function to send one request to the API
+def post(path: str, data: dict, headers: dict = None) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            return await c.post(path, json=data, headers=headers)
+
+    return asyncio.run(run())
+
+
+def test_batch_without_prompts_is_refused():
+    response = post("/batch", {"prompts": [], "songlist": "a;"})
+    assert response.status_code == 400
+    assert response.json()["error"] == "No prompts in the request"
+
+
+def test_batch_with_too_many_prompts_is_refused(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_PROMPTS", 3)
+    response = post("/batch", {"prompts": ["gym"] * 4, "songlist": "a;"})
+    assert response.status_code == 413
+
+
+def test_model_administration_needs_the_admin_token(monkeypatch):
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    assert post("/models/rollback", {}).status_code == 403
+    wrong = {"X-Admin-Token": "guess"}
+    assert post("/models/reload", {}, wrong).status_code == 403
+
+
+def test_failed_reload_and_rollback_say_why(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    # An empty registry
+    monkeypatch.chdir(tmp_path)
+    token = {"X-Admin-Token": "secret"}
+    response = post("/models/reload", {"version": "v9"}, token).json()
+    assert response["errormessage"] == "Model version v9 does not exist"
+    response = post("/models/rollback", {}, token).json()
+    assert response["errormessage"] == "No earlier model version to roll back to"
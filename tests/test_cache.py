@@ -0,0 +1,231 @@
+"""
+pytest cases of the caches of cache.py
+"""
+
+import asyncio
+import time
+
+import cache
+
+
+# Function to make a track object like the tracks endpoint returns
+def make_track(track_id: str, popularity: int = 50) -> dict:
+    return {
+        "id": track_id,
+        "name": "Song " + track_id,
+        "artists": [{"name": "Artist " + track_id}],
+        "popularity": popularity,
+    }
+
+
+def test_track_references_share_one_key():
+    assert cache.track_key("abc") == "abc"
+    assert cache.track_key("spotify:track:abc") == "abc"
+    assert cache.track_key("https://open.spotify.com/track/abc?si=xyz") == "abc"
+
+
+def test_features_are_counted_as_hits_and_misses(tmp_path):
+    store = cache.FeatureStore(str(tmp_path / "store.sqlite"))
+    store.put_features([{"id": "a", "energy": 0.5}, None])
+    assert store.get_features(["a", "b", "a"]) == {"a": {"id": "a", "energy": 0.5}}
+    stats = store.stats()
+    # Repeated IDs are looked up once
+    assert stats["features"] == {"hits": 1, "misses": 1}
+    assert stats["tracks"] == {"hits": 0, "misses": 0, "expired": 0}
+
+
+def test_store_survives_a_restart(tmp_path):
+    path = str(tmp_path / "store.sqlite")
+    store = cache.FeatureStore(path)
+    store.put_features([{"id": "a", "energy": 0.5}])
+    store.put_tracks([make_track("a")])
+    again = cache.FeatureStore(path)
+    assert again.get_features(["a"]) == {"a": {"id": "a", "energy": 0.5}}
+    assert again.get_tracks(["a"]) == {
+        "a": {"Name": "Song a", "Artist": "Artist a", "Popularity": 50}
+    }
+
+
+def test_popularity_expires_after_its_ttl_and_is_counted_once(tmp_path):
+    store = cache.FeatureStore(str(tmp_path / "store.sqlite"), popularity_ttl=0.1)
+    store.put_features([{"id": "a", "energy": 0.5}])
+    store.put_tracks([make_track("a")])
+    assert store.get_tracks(["a"])["a"]["Popularity"] == 50
+    time.sleep(0.15)
+    assert store.get_tracks(["a"]) == {}
+    assert store.get_tracks(["a"]) == {}
+    stats = store.stats()
+    assert stats["tracks"] == {"hits": 1, "misses": 2, "expired": 1}
+    # Audio features never expire
+    assert store.get_features(["a"]) != {}
+    # Fetched again, the track is fresh and can expire again
+    store.put_tracks([make_track("a", 60)])
+    assert store.get_tracks(["a"])["a"]["Popularity"] == 60
+    time.sleep(0.15)
+    store.get_tracks(["a"])
+    assert store.stats()["tracks"]["expired"] == 2
+
+
+def test_memory_holds_the_most_recent_tracks(tmp_path):
+    store = cache.FeatureStore(str(tmp_path / "store.sqlite"), capacity=2)
+    store.put_features([{"id": i} for i in "abc"])
+    store.get_features(["a", "b", "c"])
+    stats = store.stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    # Evicted records are still read back from SQLite
+    assert set(store.get_features(["a", "b", "c"])) == {"a", "b", "c"}
+
+
+def test_predictions_of_an_old_model_are_dropped_when_a_new_one_is_bound():
+    predictions = cache.PredictionCache(capacity=10)
+    predictions.bind("model1")
+    predictions.put("model1", ["a", "b"], [[0.1, 0.9], [0.8, 0.2]])
+    assert predictions.get("model1", ["a", "b", "c"]) == {
+        "a": [0.1, 0.9],
+        "b": [0.8, 0.2],
+    }
+    # Binding the same model again keeps its rows
+    predictions.bind("model1")
+    assert predictions.stats()["size"] == 2
+    predictions.bind("model2")
+    assert predictions.get("model2", ["a"]) == {}
+    assert predictions.get("model1", ["a"]) == {}
+    stats = predictions.stats()
+    assert stats["size"] == 0
+    assert stats["invalidations"] == 1
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+
+
+def test_predictions_of_a_replaced_model_are_not_saved():
+    predictions = cache.PredictionCache(capacity=10)
+    predictions.bind("model2")
+    # A request still scoring with the old model finishes after the swap
+    predictions.put("model1", ["a"], [[0.5, 0.5]])
+    assert predictions.stats()["size"] == 0
+
+
+def test_prediction_cache_keeps_the_most_recent_rows():
+    predictions = cache.PredictionCache(capacity=2)
+    predictions.bind("model1")
+    predictions.put("model1", ["a", "b"], [1, 2])
+    predictions.get("model1", ["a"])
+    predictions.put("model1", ["c"], [3])
+    assert set(predictions.get("model1", ["a", "b", "c"])) == {"a", "c"}
+    assert predictions.stats()["evictions"] == 1
+
+
+def test_prompts_differing_in_case_and_spacing_share_one_key():
+    assert cache.normalize_prompt("  Gym   TIME ") == cache.normalize_prompt("gym time")
+
+
+def test_intent_cache_reports_hit_ratio_and_parse_latency():
+    intents = cache.IntentCache(capacity=10)
+    intents.bind("engine1")
+    assert intents.get("engine1", ["gym time"]) == {}
+    intents.put("engine1", ["gym time"], [{"intent": "gym"}])
+    intents.record_parse("lexicon", 2, 0.002)
+    intents.record_parse("snips", 1, 0.05)
+    assert intents.get("engine1", ["gym time"]) == {"gym time": {"intent": "gym"}}
+    stats = intents.stats()
+    assert stats["hit_ratio"] == 0.5
+    assert stats["parses"]["lexicon"] == {"count": 2, "seconds_mean": 0.001}
+    assert stats["parses"]["snips"]["count"] == 1
+    # A retrained engine parses every prompt again
+    intents.bind("engine2")
+    assert intents.get("engine2", ["gym time"]) == {}
+
+
+# Function to make a job that counts how often it started and whether it was cancelled
+def counted_job(state: dict, seconds: float = 0.2, result=42):
+    async def job():
+        state["started"] = state.get("started", 0) + 1
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+        return result
+
+    return job
+
+
+def test_callers_of_one_key_share_the_job():
+    async def run():
+        flight = cache.SingleFlight(60, 8)
+        state = {}
+        results = await asyncio.gather(
+            *[flight.run("key", counted_job(state)) for _ in range(5)]
+        )
+        return flight, state, results
+
+    flight, state, results = asyncio.run(run())
+    assert results == [42] * 5
+    assert state["started"] == 1
+    assert flight.stats()["misses"] == 1
+    assert flight.stats()["joined"] == 4
+
+
+def test_kept_result_is_served_without_running_again():
+    async def run():
+        flight = cache.SingleFlight(60, 8)
+        state = {}
+        await flight.run("key", counted_job(state, 0))
+        return flight, state, await flight.run("key", counted_job(state, 0))
+
+    flight, state, result = asyncio.run(run())
+    assert result == 42
+    assert state["started"] == 1
+    assert flight.stats()["hits"] == 1
+
+
+def test_failed_job_is_raised_to_every_caller_and_not_kept():
+    async def run():
+        flight = cache.SingleFlight(60, 8)
+
+        async def job():
+            raise ValueError("failed")
+
+        results = await asyncio.gather(
+            flight.run("key", job), flight.run("key", job), return_exceptions=True
+        )
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert all(isinstance(i, ValueError) for i in results)
+    assert flight.stats()["size"] == 0
+
+
+def test_caller_leaving_does_not_cancel_job_of_others():
+    async def run():
+        flight = cache.SingleFlight(60, 8)
+        state = {}
+        first, _ = flight.start("key", counted_job(state))
+        second, _ = flight.start("key", counted_job(state))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        return state, await second
+
+    state, result = asyncio.run(run())
+    assert result == 42
+    assert "cancelled" not in state
+
+
+def test_job_is_cancelled_when_last_caller_leaves():
+    async def run():
+        flight = cache.SingleFlight(60, 8)
+        state = {}
+        futures = [flight.start("key", counted_job(state))[0] for _ in range(3)]
+        await asyncio.sleep(0.05)
+        for future in futures:
+            future.cancel()
+        await asyncio.sleep(0.01)
+        return flight, state
+
+    flight, state = asyncio.run(run())
+    assert state["cancelled"]
+    assert flight.stats()["abandoned"] == 1
+    assert flight.stats()["running"] == 0
+    # A cancelled job leaves no result behind
+    assert flight.stats()["size"] == 0
@@ -0,0 +1,89 @@
+"""
+pytest cases of the keyword lexicon of lexicon.py, built from the nlputrain yaml files
+"""
+
+import os
+
+import pytest
+
+import lexicon
+
+TRAINING = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nlputrain"
+)
+
+
+# Function to build the lexicon once for every test of this file
+@pytest.fixture(scope="module")
+def keywords():
+    return lexicon.Lexicon.from_directory(TRAINING)
+
+
+@pytest.mark.parametrize(
+    "prompt, intent",
+    [
+        ("Gym time", "gym"),
+        ("Sleep", "sleep"),
+        ("  STUDY  ", "study"),
+        ("yoga at 6", "yoga"),
+        ("remind me to call the maid", "reminder"),
+        ("Travel at 5", "travel"),
+    ],
+)
+def test_obvious_prompts_are_answered(keywords, prompt, intent):
+    assert keywords.classify(prompt) == intent
+
+
+@pytest.mark.parametrize(
+    "prompt",
+    [
+        # Words of a single training line do not decide
+        "wake me up",
+        "Wake up for the flight",
+        "call mom",
+        "go for a walk",
+        # Deciding words of different intents
+        "gym and then sleep",
+        # A deciding word, next to a word of another intent
+        "stretch after the gym",
+        # Nothing known
+        "party",
+        "",
+    ],
+)
+def test_ambiguous_prompts_fall_through_to_snips(keywords, prompt):
+    assert keywords.classify(prompt) is None
+
+
+def test_words_shared_by_intents_do_not_block_an_answer(keywords):
+    # "time" appears in gym, study and reminder utterances
+    assert keywords.classify("study time") == "study"
+
+
+def test_support_is_counted_per_utterance(tmp_path):
+    (tmp_path / "walk.yaml").write_text(
+        "type: intent\n"
+        "name: outdoor\n"
+        "utterances:\n"
+        "  - walk walk walk\n"
+        "  - a long hike\n"
+    )
+    keywords = lexicon.Lexicon.from_directory(str(tmp_path))
+    # Repeated in one utterance only, "walk" is not enough to decide
+    assert keywords.classify("walk") is None
+    (tmp_path / "walk.yaml").write_text(
+        "type: intent\n"
+        "name: outdoor\n"
+        "utterances:\n"
+        "  - walk walk walk\n"
+        "  - a long walk\n"
+    )
+    assert lexicon.Lexicon.from_directory(str(tmp_path)).classify("walk") == "outdoor"
+
+
+def test_fingerprint_follows_the_training_files(tmp_path):
+    (tmp_path / "a.yaml").write_text("type: intent\nname: gym\nutterances:\n  - gym\n")
+    first = lexicon.Lexicon.from_directory(str(tmp_path)).fingerprint
+    assert lexicon.Lexicon.from_directory(str(tmp_path)).fingerprint == first
+    (tmp_path / "a.yaml").write_text("type: intent\nname: gym\nutterances:\n  - lift\n")
+    assert lexicon.Lexicon.from_directory(str(tmp_path)).fingerprint != first
@@ -0,0 +1,272 @@
+"""
+pytest cases of main.py: intent detection, song picking, streaming of playlist pages and the dataset builder
+"""
+
+import asyncio
+import os
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# main loads the NLU engine when imported
+pytest.importorskip("snips_nlu")
+import cache
+import fakespotify
+import lexicon
+import main
+
+CLASSES = ["Gym", "Sleep", "Study", "Yoga"]
+
+
+class CountingEngine:
+    """
+    Stand-in of SnipsNLUEngine that answers every prompt with the "study" intent, counting the prompts parsed
+    """
+
+    def __init__(self):
+        self.parsed = []
+
+    def parse(self, prompt: str) -> dict:
+        self.parsed.append(prompt)
+        return {"intent": {"intentName": "study"}, "slots": []}
+
+
+# Function to make the models used for intent detection, with a fresh intent cache bound to them
+def make_intent_models(monkeypatch, fingerprint: str = "engine1"):
+    models = types.SimpleNamespace(
+        intent_fingerprint=fingerprint,
+        nlu=CountingEngine(),
+        lexicon=lexicon.Lexicon.from_directory(
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "nlputrain")
+        ),
+    )
+    intents = cache.IntentCache()
+    intents.bind(fingerprint)
+    monkeypatch.setattr(cache, "_intent_cache", intents)
+    return models
+
+
+def test_each_distinct_prompt_is_parsed_once(monkeypatch):
+    models = make_intent_models(monkeypatch)
+    results = main.detect_intents(
+        ["Gym time", "gym  TIME", "Party tonight", "party tonight"],
+        models,
+    )
+    assert [i["intent"] for i in results] == ["gym", "gym", "study", "study"]
+    assert [i["path"] for i in results] == ["lexicon", "lexicon", "snips", "snips"]
+    # Only the prompt the lexicon could not answer reached the engine, once
+    assert models.nlu.parsed == ["Party tonight"]
+    main.detect_intents(["PARTY tonight"], models)
+    assert models.nlu.parsed == ["Party tonight"]
+    assert cache.get_intent_cache().stats()["hits"] == 1
+
+
+# Function to make a predict_tag tuple of random probabilities
+def make_preds(count: int, seed: int = 0, offset: int = 0) -> tuple:
+    probs = np.random.default_rng(seed).random((count, len(CLASSES)))
+    ids = ["t%d" % (offset + i) for i in range(count)]
+    return probs, ids, ["Song %s" % i for i in ids], CLASSES
+
+
+def test_top_matches_are_the_k_best_in_order():
+    preds = make_preds(500)
+    top = main.get_top_matches("sleep", preds, k=10)
+    column = preds[0][:, CLASSES.index("Sleep")]
+    assert list(top) == list(np.argsort(-column, kind="stable")[:10])
+
+
+def test_top_matches_of_a_short_list_keep_every_song():
+    preds = make_preds(4)
+    assert sorted(main.get_top_matches("gym", preds, k=10)) == [0, 1, 2, 3]
+
+
+def test_running_topk_matches_scoring_every_song_at_once():
+    everything = make_preds(1000, seed=1)
+    top = main.TopK(k=10)
+    for count in range(0, 1000, 100):
+        top.update(
+            (
+                everything[0][count : count + 100],
+                everything[1][count : count + 100],
+                everything[2][count : count + 100],
+                CLASSES,
+            )
+        )
+    assert top.count == 1000
+    for intent in ["gym", "sleep", "study", "yoga"]:
+        expected = [everything[1][i] for i in main.get_top_matches(intent, everything)]
+        kept = top.result()
+        assert [kept[1][i] for i in main.get_top_matches(intent, kept)] == expected
+
+
+def test_topk_copy_does_not_change_with_later_chunks():
+    top = main.TopK(k=5)
+    top.update(make_preds(50, seed=2))
+    snapshot = top.copy()
+    top.update(make_preds(50, seed=3, offset=50))
+    assert snapshot.count == 50
+    assert all(int(i[1:]) < 50 for i in snapshot.ids)
+
+
+@pytest.mark.parametrize("weighting", ["uniform", "probability", "softmax"])
+def test_best_match_is_reproducible_with_a_seed(weighting):
+    preds = make_preds(300, seed=4)
+    picks = {
+        main.get_best_match("study", preds, weighting=weighting, seed=7)
+        for _ in range(5)
+    }
+    assert len(picks) == 1
+    best = [preds[1][i] for i in main.get_top_matches("study", preds)]
+    assert picks.pop() in ["spotify:track:" + i for i in best]
+
+
+def test_best_match_differs_between_seeds():
+    preds = make_preds(300, seed=5)
+    picks = {main.get_best_match("yoga", preds, seed=i) for i in range(50)}
+    assert len(picks) > 1
+
+
+def test_intents_without_a_tag_use_the_closest_one():
+    assert main.intent_tag("reminder") == "Yoga"
+    assert main.intent_tag("travel") == "Gym"
+    assert main.intent_tag("sleep") == "Sleep"
+
+
+class PagedClient:
+    """
+    Stand-in of AsyncSpotify answering playlist_items from a FakeSpotify, counting the pages asked for
+    Parameters required: number of songs of the playlist, songs per page
+    """
+
+    def __init__(self, size: int, limit: int):
+        self.fake = fakespotify.FakeSpotify()
+        self.size = size
+        self.limit = limit
+        self.started = 0
+
+    async def playlist_items(
+        self, playlist_id: str, limit: int = None, offset: int = 0
+    ):
+        self.started += 1
+        await asyncio.sleep(0.001)
+        ids = ["%st%d" % (playlist_id, i) for i in range(self.size)]
+        return {
+            "items": [
+                {"track": self.fake.track(i)} for i in ids[offset : offset + self.limit]
+            ],
+            "total": self.size,
+            "limit": self.limit,
+            "offset": offset,
+        }
+
+
+def test_pages_are_fetched_no_further_ahead_than_the_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cache, "_feature_store", cache.FeatureStore(str(tmp_path / "store.sqlite"))
+    )
+    client = PagedClient(size=1000, limit=10)
+
+    async def run():
+        taken = []
+        async for song_ids in main.stream_playlist_ids(client, "p", concurrency=3):
+            taken.extend(song_ids)
+            # A slow consumer, every fetched page is done long before it takes the next one
+            await asyncio.sleep(0.005)
+            assert client.started - len(taken) // 10 <= 3
+        return taken
+
+    taken = asyncio.run(run())
+    assert sorted(taken) == sorted("spotify:track:pt%d" % i for i in range(1000))
+    assert client.started == 100
+
+
+def test_dataset_chunk_only_fetches_songs_it_does_not_have(
+    fake_client, tmp_path, monkeypatch
+):
+    fake, client = fake_client
+    monkeypatch.setattr(
+        cache, "_feature_store", cache.FeatureStore(str(tmp_path / "store.sqlite"))
+    )
+    os.makedirs(main.DATASET_CHUNKS)
+    # Recording every song whose features are fetched
+    fetched = []
+    fetch = main.fetch_audio_features
+
+    async def recording(client, track_ids):
+        fetched.append(list(track_ids))
+        return await fetch(client, track_ids)
+
+    monkeypatch.setattr(main, "fetch_audio_features", recording)
+    songs = ["chunk%d" % i for i in range(20)]
+    monkeypatch.setitem(fake.recorded["playlists"], "chunked", songs)
+
+    async def run(previous):
+        try:
+            return await main.build_playlist_chunk(client, "chunked", previous)
+        finally:
+            await client.close()
+
+    first = asyncio.run(run(None))
+    assert first["tracks"] == 20
+    assert fetched == [songs]
+    # Unchanged playlist: the previous chunk is used as is
+    calls = fake.calls.get("playlist_items", 0)
+    assert asyncio.run(run(first)) == first
+    assert fake.calls.get("playlist_items", 0) == calls
+    assert len(fetched) == 1
+    # Changed playlist: five songs removed and three added, only the new ones are fetched
+    changed = songs[5:] + ["new0", "new1", "new2"]
+    monkeypatch.setitem(fake.recorded["playlists"], "chunked", changed)
+    fake.change_playlist("chunked")
+    second = asyncio.run(run(first))
+    assert fetched[1] == ["new0", "new1", "new2"]
+    assert second["tracks"] == 18
+    chunk = pd.read_parquet(second["chunk"])
+    assert sorted(chunk["id"]) == sorted(changed)
+
+
+def test_saved_playlist_is_reused_until_its_popularity_is_stale(
+    fake_client, tmp_path, monkeypatch
+):
+    fake, client = fake_client
+    store = cache.FeatureStore(str(tmp_path / "store.sqlite"), popularity_ttl=0.3)
+    monkeypatch.setattr(cache, "_feature_store", store)
+    monkeypatch.setitem(
+        fake.recorded["playlists"], "saved", ["saved%d" % i for i in range(150)]
+    )
+
+    async def read(snapshot_id: str) -> list:
+        song_ids = []
+        async for page in main.stream_playlist_ids(
+            client, "saved", snapshot_id=snapshot_id
+        ):
+            song_ids.extend(page)
+        return song_ids
+
+    async def run():
+        try:
+            # The first read pages through the playlist and saves it, the second only reads the saved songs
+            first = await read("snap1")
+            calls = fake.calls.get("playlist_items", 0)
+            second = await read("snap1")
+            reused = fake.calls.get("playlist_items", 0) == calls
+            # Once the saved Popularity is stale, the pages are fetched again to refresh it
+            await asyncio.sleep(0.35)
+            assert main.saved_playlist("saved", "snap1") is None
+            await read("snap1")
+            refreshed = fake.calls.get("playlist_items", 0) - calls
+            # A new snapshot is never served from the songs saved for another one
+            assert main.saved_playlist("saved", "snap2") is None
+            return first, second, reused, refreshed
+        finally:
+            await client.close()
+
+    first, second, reused, refreshed = asyncio.run(run())
+    assert first == second == ["spotify:track:saved%d" % i for i in range(150)]
+    assert reused
+    assert refreshed == 2
+    saved, found = main.saved_playlist("saved", "snap1")
+    assert saved == ["saved%d" % i for i in range(150)]
+    assert found["saved0"]["Name"] == "Song saved0"
@@ -0,0 +1,91 @@
+"""
+pytest cases of metrics.py: the Prometheus text format of '/metrics', and the timings of a request
+"""
+
+import asyncio
+import concurrent.futures
+
+import pytest
+
+import metrics
+
+
+# Function to give every test empty histograms and counters
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_counters", {})
+
+
+def test_histogram_is_rendered_with_cumulative_buckets():
+    for seconds in [0.002, 0.02, 0.02, 20]:
+        metrics.observe_histogram("cadence_request_seconds", seconds, path="/")
+    lines = metrics.render().splitlines()
+    assert lines[0] == "# HELP cadence_request_seconds Time taken to answer a request"
+    assert lines[1] == "# TYPE cadence_request_seconds histogram"
+    assert 'cadence_request_seconds_bucket{path="/",le="0.001"} 0' in lines
+    assert 'cadence_request_seconds_bucket{path="/",le="0.0025"} 1' in lines
+    assert 'cadence_request_seconds_bucket{path="/",le="0.025"} 3' in lines
+    assert 'cadence_request_seconds_bucket{path="/",le="10"} 3' in lines
+    assert 'cadence_request_seconds_bucket{path="/",le="+Inf"} 4' in lines
+    assert 'cadence_request_seconds_sum{path="/"} 20.042000' in lines
+    assert 'cadence_request_seconds_count{path="/"} 4' in lines
+
+
+def test_counters_are_rendered_by_label():
+    metrics.count("cadence_requests_total", path="/", status=200)
+    metrics.count("cadence_requests_total", path="/", status=200)
+    metrics.count("cadence_requests_total", path="/batch", status=413)
+    lines = metrics.render().splitlines()
+    assert "# TYPE cadence_requests_total counter" in lines
+    assert 'cadence_requests_total{path="/",status="200"} 2' in lines
+    assert 'cadence_requests_total{path="/batch",status="413"} 1' in lines
+
+
+def test_cache_tables_limiter_and_gate_are_rendered():
+    caches = {
+        "features": {
+            "tracks": {"hits": 3, "misses": 1, "expired": 1},
+            "evictions": 2,
+            "size": 10,
+            "capacity": 100,
+        },
+        "intents": {"hits": 5, "misses": 5, "hit_ratio": 0.5, "size": 4},
+    }
+    limiter = {
+        "waiting": {"interactive": 2, "background": 0},
+        "tokens": 4.5,
+        "blocked_for": 0,
+    }
+    gate = {"in_flight": 3, "waiting": 1}
+    lines = metrics.render(caches, limiter, gate).splitlines()
+    assert 'cadence_cache_hits_total{cache="features",table="tracks"} 3' in lines
+    assert 'cadence_cache_expired_total{cache="features",table="tracks"} 1' in lines
+    assert 'cadence_cache_evictions_total{cache="features"} 2' in lines
+    assert "# TYPE cadence_cache_size gauge" in lines
+    assert 'cadence_cache_size{cache="intents"} 4' in lines
+    # Ratios and capacities are not counters
+    assert not any("hit_ratio" in i or "capacity" in i for i in lines)
+    assert 'cadence_spotify_queue_depth{priority="interactive"} 2' in lines
+    assert "cadence_spotify_tokens 4.500000" in lines
+    assert "cadence_requests_in_flight 3" in lines
+    assert "cadence_requests_queued 1" in lines
+    # Every metric is typed exactly once
+    types = [i.split()[2] for i in lines if i.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+
+
+def test_stages_add_to_the_timings_of_the_request():
+    async def run():
+        timings = metrics.start_request()
+        with metrics.stage("features"):
+            pass
+        # Executor calls of the request add to its timings as well
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            await metrics.run_in_executor(executor, metrics.observe, "predict", 0.25)
+        return timings
+
+    timings = asyncio.run(run())
+    assert set(timings) == {"features", "predict"}
+    assert metrics.server_timing({"predict": 0.25}) == "predict;dur=250.0"
+    assert metrics.stage_totals()["predict"] == (1, 0.25)
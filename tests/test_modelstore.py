@@ -0,0 +1,68 @@
+"""
+pytest cases of modelstore.py: saving the ML model in XGBoost's native format and loading it back
+"""
+
+import numpy as np
+import xgboost
+
+import modelstore
+import schema
+
+
+# Function to train a small classifier on random features
+def train(classes: int = 3, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    features = rng.random((60, len(schema.FEATURE_COLUMNS))).astype(np.float32)
+    labels = np.arange(60) % classes
+    model = xgboost.XGBClassifier(n_estimators=5, max_depth=2, random_state=seed)
+    model.fit(features, labels)
+    return model, features
+
+
+# Function to save a model to a temporary directory and load it back
+def round_trip(tmp_path, model) -> modelstore.BoosterModel:
+    path = str(tmp_path / modelstore.MODEL_FILE)
+    meta_path = str(tmp_path / modelstore.META_FILE)
+    modelstore.save_model(
+        model, schema.DEFAULT_SCHEMA.to_dict(), "hash", path, meta_path
+    )
+    assert modelstore.model_exists(path, meta_path)
+    return modelstore.load_model(path, meta_path)
+
+
+def test_loaded_model_predicts_like_the_trained_one(tmp_path):
+    model, features = train()
+    loaded = round_trip(tmp_path, model)
+    np.testing.assert_allclose(
+        loaded.predict_proba(features), model.predict_proba(features), atol=1e-6
+    )
+    assert list(loaded.classes_) == ["0", "1", "2"]
+    assert loaded.feature_schema == schema.DEFAULT_SCHEMA.to_dict()
+    assert loaded.meta["training_hash"] == "hash"
+    # No temporary file is left behind
+    assert sorted(i.name for i in tmp_path.iterdir()) == sorted(
+        [modelstore.MODEL_FILE, modelstore.META_FILE]
+    )
+
+
+def test_two_class_model_gives_both_probabilities(tmp_path):
+    model, features = train(classes=2)
+    probs = round_trip(tmp_path, model).predict_proba(features)
+    assert probs.shape == (60, 2)
+    np.testing.assert_allclose(probs.sum(axis=1), 1, atol=1e-6)
+
+
+def test_no_songs_give_no_rows(tmp_path):
+    loaded = round_trip(tmp_path, train()[0])
+    empty = np.empty((0, len(schema.FEATURE_COLUMNS)), dtype=np.float32)
+    assert loaded.predict_proba(empty).shape == (0, 3)
+
+
+def test_fingerprint_changes_only_when_the_model_does(tmp_path):
+    for name in ["a", "b"]:
+        (tmp_path / name).mkdir()
+    model = train()[0]
+    first = round_trip(tmp_path / "a", model)
+    assert round_trip(tmp_path / "a", model).fingerprint == first.fingerprint
+    other = round_trip(tmp_path / "b", train(seed=1)[0])
+    assert other.fingerprint != first.fingerprint
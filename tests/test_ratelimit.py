@@ -0,0 +1,70 @@
+"""
+pytest cases of the token bucket of ratelimit.py: refill, burst, priorities and 429 pauses
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import ratelimit
+
+
+# Function to make a limiter with its own state file
+def make_limiter(tmp_path, rate: float, burst: float, reserve: float = 0):
+    return ratelimit.RateLimiter(str(tmp_path / "bucket.json"), rate, burst, reserve)
+
+
+def test_burst_is_granted_at_once_then_calls_wait(tmp_path):
+    limiter = make_limiter(tmp_path, rate=10, burst=3)
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    wait = limiter.try_acquire()
+    # The next token is due after about 1 / rate seconds
+    assert 0 < wait <= 0.1
+
+
+def test_bucket_refills_at_rate_up_to_burst(tmp_path):
+    limiter = make_limiter(tmp_path, rate=50, burst=2)
+    while limiter.try_acquire() == 0:
+        pass
+    time.sleep(0.1)
+    # 5 tokens are due after 0.1 seconds, but the bucket holds no more than 2
+    assert [limiter.try_acquire() for _ in range(3)][:2] == [0, 0]
+    assert limiter.try_acquire() > 0
+
+
+def test_bucket_is_shared_through_the_state_file(tmp_path):
+    first = make_limiter(tmp_path, rate=1, burst=2)
+    second = make_limiter(tmp_path, rate=1, burst=2)
+    assert first.try_acquire() == 0
+    assert second.try_acquire() == 0
+    assert first.try_acquire() > 0
+
+
+def test_background_calls_leave_the_reserve(tmp_path):
+    limiter = make_limiter(tmp_path, rate=1, burst=3, reserve=2)
+    assert limiter.try_acquire(ratelimit.BACKGROUND) == 0
+    # One token is left for background calls before the reserve is reached
+    assert limiter.try_acquire(ratelimit.BACKGROUND) > 0
+    assert limiter.try_acquire(ratelimit.INTERACTIVE) == 0
+
+
+def test_throttled_pauses_every_caller(tmp_path):
+    limiter = make_limiter(tmp_path, rate=1000, burst=10)
+    limiter.throttled(0.2)
+    wait = limiter.try_acquire()
+    assert wait == pytest.approx(0.2, abs=0.05)
+    assert limiter.stats()["blocked_for"] > 0
+
+
+def test_async_acquire_waits_for_the_next_token(tmp_path):
+    limiter = make_limiter(tmp_path, rate=20, burst=1)
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*[limiter.acquire() for _ in range(3)])
+        return time.perf_counter() - start
+
+    # One token at once, then two more 0.05 seconds apart
+    assert 0.08 <= asyncio.run(run()) < 0.5
+    assert limiter.stats()["delayed"] == 2
@@ -0,0 +1,65 @@
+"""
+pytest cases of the version pointer of registry.py: promote, rollback and prune
+"""
+
+import os
+
+import pytest
+
+# The registry loads NLU engines with snips_nlu
+pytest.importorskip("snips_nlu")
+import registry
+
+
+# Function to make a registry holding empty version directories
+def make_registry(tmp_path, count: int) -> tuple:
+    directory = str(tmp_path / "models")
+    versions = ["v%d" % i for i in range(count)]
+    for version in versions:
+        os.makedirs(registry.version_path(version, directory))
+    return directory, versions
+
+
+def test_promote_keeps_the_version_before_for_rollback(tmp_path):
+    directory, versions = make_registry(tmp_path, 3)
+    assert registry.current_version(directory) is None
+    for version in versions:
+        registry.promote(version, directory)
+    assert registry.current_version(directory) == "v2"
+    assert registry.history(directory) == ["v1", "v0"]
+    # Promoting the version in use changes nothing
+    registry.promote("v2", directory)
+    assert registry.history(directory) == ["v1", "v0"]
+    # Promoting a version of the history moves it out of the history
+    registry.promote("v0", directory)
+    assert registry.history(directory) == ["v2", "v1"]
+
+
+def test_missing_version_cannot_be_promoted(tmp_path):
+    directory, _ = make_registry(tmp_path, 1)
+    with pytest.raises(ValueError, match="does not exist"):
+        registry.promote("v9", directory)
+
+
+def test_rollback_goes_back_one_version_at_a_time(tmp_path):
+    directory, versions = make_registry(tmp_path, 3)
+    for version in versions:
+        registry.promote(version, directory)
+    assert registry.rollback(directory) == "v1"
+    assert registry.rollback(directory) == "v0"
+    assert registry.current_version(directory) == "v0"
+    with pytest.raises(ValueError, match="No earlier model version"):
+        registry.rollback(directory)
+
+
+def test_prune_deletes_versions_that_cannot_be_rolled_back_to(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "HISTORY", 2)
+    directory, versions = make_registry(tmp_path, 5)
+    os.makedirs(os.path.join(directory, ".staging-build"))
+    for version in versions:
+        registry.promote(version, directory)
+    assert registry.history(directory) == ["v3", "v2"]
+    assert sorted(registry.prune(directory)) == ["v0", "v1"]
+    assert registry.list_versions(directory) == ["v2", "v3", "v4"]
+    # A version being built is not a version yet, and is left alone
+    assert os.path.isdir(os.path.join(directory, ".staging-build"))
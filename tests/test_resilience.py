@@ -0,0 +1,99 @@
+"""
+pytest cases of resilience.py: circuit breaker states, and retries of calls to the stand-in spotify server
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import resilience
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    breaker = resilience.CircuitBreaker(failures=3, cooldown=10)
+    for _ in range(2):
+        breaker.allow()
+        breaker.failure()
+    assert breaker.state == "closed"
+    breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    with pytest.raises(resilience.CircuitOpen) as refused:
+        breaker.allow()
+    assert 0 < refused.value.retry_after <= 10
+    assert breaker.stats()["trips"] == 1
+
+
+def test_success_resets_the_failures_in_a_row():
+    breaker = resilience.CircuitBreaker(failures=2, cooldown=10)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_lets_one_trial_through_and_closes_on_success():
+    breaker = resilience.CircuitBreaker(failures=1, cooldown=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == "half_open"
+    # Only the trial call goes through until it reports back
+    with pytest.raises(resilience.CircuitOpen):
+        breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    breaker.allow()
+
+
+def test_half_open_breaker_opens_again_when_the_trial_fails():
+    breaker = resilience.CircuitBreaker(failures=1, cooldown=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.stats()["trips"] == 2
+
+
+def test_transient_errors_are_retried(fake_client, monkeypatch):
+    fake, client = fake_client
+    # Half the calls fail with a 500, retries get the rest through
+    monkeypatch.setattr(fake, "errors", 0.5)
+    client.resilient = resilience.ResilientCaller(
+        retries=8, backoff=0, breaker=resilience.CircuitBreaker(failures=100)
+    )
+
+    async def run():
+        try:
+            return await asyncio.gather(*[client.tracks(["a", "b"]) for _ in range(10)])
+        finally:
+            await client.close()
+
+    results = asyncio.run(run())
+    assert all(len(i["tracks"]) == 2 for i in results)
+    assert client.resilient.stats()["retried"] > 0
+
+
+def test_breaker_stops_calls_to_a_failing_server(fake_client, monkeypatch):
+    fake, client = fake_client
+    monkeypatch.setattr(fake, "errors", 1.0)
+    client.resilient = resilience.ResilientCaller(
+        retries=0, breaker=resilience.CircuitBreaker(failures=3, cooldown=10)
+    )
+
+    async def run():
+        errors = []
+        for _ in range(5):
+            try:
+                await client.tracks(["a"])
+            except Exception as e:
+                errors.append(type(e))
+        await client.close()
+        return errors
+
+    errors = asyncio.run(run())
+    # Three calls reach the server and fail, the breaker then answers the others at once
+    assert errors[3:] == [resilience.CircuitOpen] * 2
+    assert client.resilient.breaker.state == "open"
@@ -0,0 +1,104 @@
+"""
+pytest cases of schema.py: the binary training set and the feature projection
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import schema
+
+
+# Function to make a dataset like create_dataset builds, with every feature column and a Tag column
+def make_dataset(rows: int = 6) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    dataset = pd.DataFrame(
+        rng.random((rows, len(schema.FEATURE_COLUMNS))), columns=schema.FEATURE_COLUMNS
+    )
+    dataset["Tag"] = ["Gym", "Sleep", "Study"] * (rows // 3)
+    return dataset
+
+
+def test_training_set_round_trip(tmp_path):
+    dataset = make_dataset()
+    schema.save_training_set(dataset, str(tmp_path))
+    assert schema.training_set_exists(str(tmp_path))
+    features, labels, saved = schema.load_training_set(str(tmp_path))
+    assert isinstance(features, np.memmap)
+    np.testing.assert_allclose(
+        features, dataset[schema.FEATURE_COLUMNS].to_numpy(np.float32)
+    )
+    assert list(labels) == list(dataset["Tag"])
+    assert saved["rows"] == 6
+
+
+def test_training_set_of_another_schema_is_rejected(tmp_path):
+    schema.save_training_set(make_dataset(), str(tmp_path))
+    path = os.path.join(str(tmp_path), "schema.json")
+    with open(path) as file:
+        saved = json.load(file)
+    for change in [{"version": 0}, {"features": schema.FEATURE_COLUMNS[::-1]}]:
+        with open(path, "w") as file:
+            json.dump(dict(saved, **change), file)
+        with pytest.raises(ValueError, match="schema version"):
+            schema.load_training_set(str(tmp_path))
+
+
+def test_incomplete_training_set_is_rejected(tmp_path):
+    schema.save_training_set(make_dataset(), str(tmp_path))
+    path = os.path.join(str(tmp_path), "schema.json")
+    with open(path) as file:
+        saved = json.load(file)
+    with open(path, "w") as file:
+        json.dump(dict(saved, rows=7), file)
+    with pytest.raises(ValueError, match="incomplete"):
+        schema.load_training_set(str(tmp_path))
+
+
+# Function to make an audio feature payload like spotify.audio_features returns
+def make_payload(song_id: str) -> dict:
+    payload = {name: float(i) for i, name in enumerate(schema.FEATURE_COLUMNS)}
+    payload.update({"id": song_id, "type": "audio_features", "uri": "x"})
+    return payload
+
+
+def test_payloads_are_projected_in_model_order():
+    matrix = schema.DEFAULT_SCHEMA.project([make_payload("a"), make_payload("b")])
+    assert matrix.dtype == np.float32
+    assert matrix.flags["C_CONTIGUOUS"]
+    assert matrix.shape == (2, len(schema.FEATURE_COLUMNS))
+    assert list(matrix[0]) == list(range(len(schema.FEATURE_COLUMNS)))
+    # A schema of its own order, as saved with a model
+    reordered = schema.FeatureSchema(["tempo", "energy"])
+    assert list(reordered.project([make_payload("a")])[0]) == [10, 1]
+
+
+def test_missing_feature_is_rejected():
+    payload = make_payload("a")
+    del payload["tempo"]
+    with pytest.raises(schema.IncompleteFeatures, match="tempo.*a"):
+        schema.DEFAULT_SCHEMA.project([make_payload("b"), payload])
+
+
+def test_none_feature_is_rejected():
+    payload = make_payload("a")
+    payload["energy"] = None
+    with pytest.raises(schema.IncompleteFeatures, match="energy is None for song: a"):
+        schema.DEFAULT_SCHEMA.project([payload])
+
+
+def test_single_feature_schema_projects_a_column():
+    single = schema.FeatureSchema(["energy"])
+    assert single.project([make_payload("a")]).shape == (1, 1)
+
+
+def test_schema_survives_being_saved_with_a_model():
+    class Model:
+        feature_schema = schema.FeatureSchema(["tempo", "energy"]).to_dict()
+
+    assert schema.model_schema(Model()).columns == ["tempo", "energy"]
+    # Models saved before the schema was stored with them
+    assert schema.model_schema(object()).columns == schema.FEATURE_COLUMNS
@@ -0,0 +1,82 @@
+"""
+pytest cases of the shared client of spotifyclient.py: one token per process, refreshed shortly before it expires
+"""
+
+import threading
+import time
+
+import spotifyclient
+
+
+class CountingAuth:
+    """
+    Stand-in of spotipy's SpotifyClientCredentials, handing out numbered tokens that live for a set time
+    Parameters required: seconds every token lives
+    """
+
+    def __init__(self, lifetime: float):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    def get_access_token(self, as_dict: bool = True) -> dict:
+        self.calls += 1
+        # Slow enough that concurrent callers would all fetch one without the lock
+        time.sleep(0.02)
+        return {
+            "access_token": "token%d" % self.calls,
+            "expires_at": time.time() + self.lifetime,
+        }
+
+
+# Function to make a manager whose tokens come from a CountingAuth
+def make_manager(monkeypatch, lifetime: float, margin: float) -> tuple:
+    auth = CountingAuth(lifetime)
+    manager = spotifyclient.SpotifyClientManager(refresh_margin=margin)
+    monkeypatch.setattr(manager, "_load_auth", lambda: auth)
+    return manager, auth
+
+
+def test_one_token_is_shared_while_it_is_valid(monkeypatch):
+    manager, auth = make_manager(monkeypatch, lifetime=3600, margin=60)
+    client = manager.get_client()
+    assert manager.get_client() is client
+    assert manager.get_token() == "token1"
+    assert manager.cached_token() == "token1"
+    assert auth.calls == 1
+
+
+def test_concurrent_callers_fetch_one_token(monkeypatch):
+    manager, auth = make_manager(monkeypatch, lifetime=3600, margin=60)
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(manager.get_client()))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert auth.calls == 1
+    assert all(i is clients[0] for i in clients)
+
+
+def test_token_is_refreshed_within_the_margin_of_its_expiry(monkeypatch):
+    # Every token is already within the margin once 0.1 seconds have passed
+    manager, auth = make_manager(monkeypatch, lifetime=0.2, margin=0.1)
+    first = manager.get_client()
+    assert manager.get_token() == "token1"
+    time.sleep(0.15)
+    # The event loop never waits for a refresh, it is told to fetch one instead
+    assert manager.cached_token() is None
+    assert manager.get_client() is not first
+    assert manager.get_token() == "token2"
+    assert auth.calls == 2
+
+
+def test_invalidated_token_is_fetched_again(monkeypatch):
+    manager, auth = make_manager(monkeypatch, lifetime=3600, margin=60)
+    manager.get_token()
+    manager.invalidate()
+    assert manager.cached_token() is None
+    assert manager.get_token() == "token2"
+    assert auth.calls == 2